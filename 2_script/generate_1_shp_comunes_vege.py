@@ -12,10 +12,19 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
 
 from utils.logger import setup_logger
-from utils.functions import format_elapsed_time
+from utils.functions import format_elapsed_time, count_vertices, snap_to_grid
+from utils.dataset_catalog import DatasetCatalog
+from utils.clip_mask import TiledMask
+from utils.stage_cache import StageCache
+from utils.run_history import record_run, record_stage
 from utils.constants import (
     INPUT_DATA_DIR,
     OUTPUT_DATA_DIR,
+    DATASET_CATALOG_DIR,
+    DATASET_CATALOG_MAX_SIZE,
+    CLIP_MASK_DIR,
+    CLIP_MASK_MAX_SIZE,
+    CLIP_MASK_TILE_SIZE,
 )
 
 import warnings
@@ -31,14 +40,18 @@ logger = setup_logger(
 
 
 def batch_clip_concat(
-    input_dir: str,
+    input_dir: str | None,
     origin_input_dir: str,
     clip_file: str,
-    output_name: str,
+    output_name: str | None,
     pattern: str = "*.shp",
     recursive: bool = False,
     add_source_col: bool = True,
     use_pyogrio: bool = True,
+    input_gdfs: dict[str, gpd.GeoDataFrame] | None = None,
+    precision_grid: float | None = None,
+    use_catalog: bool = False,
+    use_tiled_mask: bool = False,
 ):
     """
     Script for generating SHP of MDL cities with vegetalisation's KPIs and save datas on a new Shapefile.
@@ -47,17 +60,21 @@ def batch_clip_concat(
     python ./2_script/generate_1_shp_comunes_vege_clipped.py --dir "vegetation_stratifiee_2018_2154" --origin "OUTPUT" --mask "surfacique_voirie.shp" --name "vegetation_stratifiee_clipped_by_voirie_2018_2154.shp" --extension "*.shp"
 
         Parameters:
-            input_dir (string) : Name of the directory where the data files are
+            input_dir (string) : Name of the directory where the data files are (ignored if input_gdfs is given)
             origin_input_dir (string) : Select the parent directory : INPUT or OUTPUT (present in the directory ./0_geodatas/)
             clip_file (string) : Name of the file (.shp or .gpkg) input used to define clipping area (present in the directory ./0_geodatas/input/)
-            output_name (string) : Name of the file output used to generate and save datas (.shp ou .gpkg)
+            output_name (string) : Name of the file output used to generate and save datas (.shp ou .gpkg), None to skip the export
             pattern (string) : Pattern used to select files (from extension) to import data files (ex: *.shp)
             recursive (bool) : If we're using recursive select option
             add_source_col (bool) : If we're adding a column from data sources
             use_pyogrio (bool) : If we're using "pyogrio" library for better perf
+            input_gdfs (dict) : In-memory GeoDataFrames to clip instead of the data files ({source name : GeoDataFrame})
+            precision_grid (float) : Size of the precision grid applied at ingest on datas and mask (ex: 0.01 = 1 cm), None to keep full precision
+            use_catalog (bool) : If we're using the catalog of the data files (skip files out of the mask bbox without reading them, reuse the clipped parts of unchanged files)
+            use_tiled_mask (bool) : If we're clipping with the tiled mask (union of the mask done once, split in prepared tiles, persisted by CRS), the data files in another CRS are clipped in their own CRS
 
         Returns:
-            None (but generate a Shapefile with generates datas resumed on the OUTPUT directory)
+            GeoDataFrame of the clipped datas (and generate a file with generates datas resumed on the OUTPUT directory if output_name is given)
     """
 
     """
@@ -68,21 +85,30 @@ def batch_clip_concat(
     logger.info(f"⚙️  Engine used : {engine if engine else '-default-'}")
 
     MASK_FILE_PATH = os.path.join(INPUT_DATA_DIR, clip_file)
-    if origin_input_dir == "OUTPUT":
+    if input_gdfs is not None:
+        DIR_VEGETATION_FILES_PATH = None
+    elif origin_input_dir == "OUTPUT":
         DIR_VEGETATION_FILES_PATH = os.path.join(OUTPUT_DATA_DIR, input_dir)
     else:
         DIR_VEGETATION_FILES_PATH = os.path.join(INPUT_DATA_DIR, input_dir)
 
-    if output_name.endswith(".shp") or output_name.endswith(".gpkg"):
+    if output_name is None:
+        FILE_OUTPUT_PATH = None
+    elif output_name.endswith(".shp") or output_name.endswith(".gpkg"):
         FILE_OUTPUT_PATH = os.path.join(OUTPUT_DATA_DIR, output_name)
     else:
         FILE_OUTPUT_PATH = os.path.join(OUTPUT_DATA_DIR, f"{output_name}.shp")
 
     logger.info(f"   ▶️  File used to clip : {MASK_FILE_PATH}")
+    if DIR_VEGETATION_FILES_PATH:
+        logger.info(
+            f"   ▶️  Directory used for data files input : {DIR_VEGETATION_FILES_PATH}"
+        )
+    else:
+        logger.info(f"   ▶️  In-memory datas used for input : {len(input_gdfs)}")
     logger.info(
-        f"   ▶️  Directory used for data files input : {DIR_VEGETATION_FILES_PATH}"
+        f"   ▶️  File to generate at the end : {FILE_OUTPUT_PATH or '-no export-'}"
     )
-    logger.info(f"   ▶️  File to generate at the end : {FILE_OUTPUT_PATH}")
 
     # INFO: STEP 1 - Read & import mask file
     clip_gdf = gpd.read_file(MASK_FILE_PATH, engine=engine)
@@ -92,62 +118,154 @@ def batch_clip_concat(
         raise ValueError("Clip file is empty")
     logger.info(f"     ✅  MASK FILE FOUND !")
 
-    # INFO: STEP 2 - Get & Read data files to clip
-    files = list(
-        Path(DIR_VEGETATION_FILES_PATH).rglob(pattern)
-        if recursive
-        else Path(DIR_VEGETATION_FILES_PATH).glob(pattern)
-    )
-    if not files:
-        logger.info(f"     ❌ INPUT DATA FILES NOT FOUND !")
-        raise FileNotFoundError("No data file is found")
+    if precision_grid:
+        nb_vertices = count_vertices(clip_gdf)
+        clip_gdf = snap_to_grid(clip_gdf, precision_grid)
+        logger.info(
+            f"     📐  MASK SNAPPED ON {precision_grid} GRID : {nb_vertices} -> {count_vertices(clip_gdf)} vertices"
+        )
+
+    # INFO: STEP 2 - Get & Read data files to clip (or in-memory datas)
+    if input_gdfs is not None:
+        sources = list(input_gdfs.items())
+        if not sources:
+            logger.info(f"     ❌ INPUT DATAS NOT FOUND !")
+            raise ValueError("No in-memory data is given")
+        logger.info(f"     ✅  IN-MEMORY DATAS FOUND : {str(len(sources))}")
+    else:
+        files = list(
+            Path(DIR_VEGETATION_FILES_PATH).rglob(pattern)
+            if recursive
+            else Path(DIR_VEGETATION_FILES_PATH).glob(pattern)
+        )
+        if not files:
+            logger.info(f"     ❌ INPUT DATA FILES NOT FOUND !")
+            raise FileNotFoundError("No data file is found")
+        sources = [(shp.name, shp) for shp in files]
+        logger.info(f"     ✅  INPUT DATA FILES FOUND on {DIR_VEGETATION_FILES_PATH} !")
+        logger.info(f"     ✅  FILES FOUNDED : {str(len(sources))}")
+
+    catalog = None
+    if use_catalog and input_gdfs is None:
+        catalog = DatasetCatalog(DATASET_CATALOG_DIR, DATASET_CATALOG_MAX_SIZE)
+        mask_key = catalog.mask_key(MASK_FILE_PATH, precision_grid)
+        logger.info(f"     📚  CATALOG USED : {catalog.path}")
+
+    # Tiled masks by CRS of the data (the one of the mask is built or read from the cache here)
+    tiled_masks = None
+    if use_tiled_mask:
+        tiled_cache = StageCache(CLIP_MASK_DIR, CLIP_MASK_MAX_SIZE)
+        tiled_key = StageCache.key(
+            DatasetCatalog.signature(os.path.abspath(MASK_FILE_PATH)), precision_grid
+        )
+        tiled_masks = {
+            clip_gdf.crs: TiledMask.load(
+                tiled_cache, tiled_key, clip_gdf, clip_gdf.crs, CLIP_MASK_TILE_SIZE
+            )
+        }
+        logger.info(
+            f"     🧩  TILED MASK : {len(tiled_masks[clip_gdf.crs].geoms)} tiles of {CLIP_MASK_TILE_SIZE} m"
+        )
 
-    nb_files = len(files)
-    logger.info(f"     ✅  INPUT DATA FILES FOUND on {DIR_VEGETATION_FILES_PATH} !")
-    logger.info(f"     ✅  FILES FOUNDED : {str(nb_files)}")
+    nb_files = len(sources)
 
     parts = []
     count = 0
     logger.info(f"   ⚙️   FETCH ALL INPUT DATA FILES & CLIP THEM !")
     # INFO: STEP 3 - Clip all data files imported
-    for shp in files:
+    for source_name, source in sources:
         try:
             time_start = datetime.datetime.now()
-            logger.info(f"      ⚙️   CLIPPING INPUT DATA FILE {shp.name}...")
-            gdf = gpd.read_file(shp, engine=engine)
-            if gdf.empty or gdf.geometry.isna().all():
-                continue
-
-            if gdf.crs != clip_gdf.crs:
-                gdf = gdf.to_crs(clip_gdf.crs)
-
-            # Validate & Clean GeoDatas if needed
-            gdf["geometry"] = gdf.geometry.apply(make_valid)
-            gdf = gdf[~gdf.geometry.is_empty & gdf.geometry.notna()]
-
-            if gdf.empty:
-                continue
-
-            clipped = gpd.clip(gdf, clip_gdf)
+            logger.info(f"      ⚙️   CLIPPING INPUT DATA FILE {source_name}...")
+            clipped = None
+            if catalog is not None:
+                entry = catalog.info(source)
+                if not catalog.overlaps(entry, clip_gdf):
+                    logger.info(
+                        f"      ⏭️   SKIPPED {source_name} : bbox out of the mask ({entry['features']} entities)"
+                    )
+                    continue
+                clipped = catalog.get_clip(source, mask_key)
+
+            features_in = None
+            if clipped is not None:
+                vertices_in = vertices_snapped = "-cached-"
+                logger.info(f"      📚  CLIPPED PART REUSED FROM THE CATALOG")
+            else:
+                if isinstance(source, gpd.GeoDataFrame):
+                    gdf = source
+                else:
+                    gdf = gpd.read_file(source, engine=engine)
+                if gdf.empty or gdf.geometry.isna().all():
+                    continue
+
+                # With the tiled mask, the data are clipped in their CRS (only the clipped part is reprojected)
+                if gdf.crs != clip_gdf.crs and tiled_masks is None:
+                    gdf = gdf.to_crs(clip_gdf.crs)
+
+                # Validate & Clean GeoDatas if needed (new frame : the in-memory inputs of the caller are kept)
+                gdf = gdf.set_geometry(gdf.geometry.apply(make_valid))
+                gdf = gdf[~gdf.geometry.is_empty & gdf.geometry.notna()]
+
+                if gdf.empty:
+                    continue
+
+                features_in = len(gdf)
+                vertices_in = count_vertices(gdf)
+                if precision_grid and gdf.crs == clip_gdf.crs:
+                    gdf = snap_to_grid(gdf, precision_grid)
+                vertices_snapped = count_vertices(gdf)
+
+                if tiled_masks is not None:
+                    if gdf.crs not in tiled_masks:
+                        tiled_masks[gdf.crs] = TiledMask.load(
+                            tiled_cache,
+                            tiled_key,
+                            clip_gdf,
+                            gdf.crs,
+                            CLIP_MASK_TILE_SIZE,
+                        )
+                    clipped = tiled_masks[gdf.crs].clip(gdf)
+                    if clipped.crs != clip_gdf.crs:
+                        clipped = clipped.to_crs(clip_gdf.crs)
+                        if precision_grid:
+                            clipped = snap_to_grid(clipped, precision_grid)
+                else:
+                    clipped = gpd.clip(gdf, clip_gdf)
+                if catalog is not None:
+                    catalog.put_clip(source, mask_key, clipped)
 
             if clipped.empty:
                 continue
 
             if add_source_col:
-                clipped["__source__"] = shp.name
+                clipped["__source__"] = source_name
 
             count += 1
             parts.append(clipped)
             time_end = datetime.datetime.now()
             time_elapsed = format_elapsed_time(time_start, time_end)
+            record_stage(
+                "clip",
+                source_name,
+                (time_end - time_start).total_seconds(),
+                features_in=features_in,
+                features_out=len(clipped),
+            )
             logger.info(
-                f"      ✅  CLIP {str(count)}/{str(nb_files)} DONE FOR {shp.name} in {time_elapsed} !"
+                f"      ✅  CLIP {str(count)}/{str(nb_files)} DONE FOR {source_name} in {time_elapsed} !"
+            )
+            logger.info(
+                f"      📐  VERTICES : {vertices_in} in -> {vertices_snapped} snapped -> {count_vertices(clipped)} clipped"
             )
         except Exception as e:
-            logger.info(f"      ❌  FAILED TO LOAD {shp.name} : {e}")
+            logger.info(f"      ❌  FAILED TO LOAD {source_name} : {e}")
             logger.info("")
             logger.error(traceback.format_exc())
 
+    if catalog is not None:
+        catalog.save()
+
     if not parts:
         logger.info(f"   ❌  NO DATAS AFTER RUNNING IMPORTS & CLIPS")
         logger.info("")
@@ -159,17 +277,18 @@ def batch_clip_concat(
     result = gpd.GeoDataFrame(result, geometry="geometry", crs=clip_gdf.crs)
     logger.info(f"   ✅  GEO DATA FRAME CREATED !")
 
-    # INFO: STEP 5 - Save & export clipped datas
-    logger.info(f"   ⚙️  GENERATE NEW FILE...")
-    out = Path(FILE_OUTPUT_PATH)
-    out.parent.mkdir(parents=True, exist_ok=True)
+    # INFO: STEP 5 - Save & export clipped datas (optional checkpoint)
+    if FILE_OUTPUT_PATH:
+        logger.info(f"   ⚙️  GENERATE NEW FILE...")
+        out = Path(FILE_OUTPUT_PATH)
+        out.parent.mkdir(parents=True, exist_ok=True)
 
-    if out.suffix.lower() == ".shp":
-        result.to_file(out, driver="ESRI Shapefile", encoding="utf-8")
-        logger.info(f"   ✅  FILE CREATED : {out} !")
-    else:
-        result.to_file(out, driver="GPKG")  # encoding géré nativement
-        print(f"   ✅  FILE CREATED : {out} !")
+        if out.suffix.lower() == ".shp":
+            result.to_file(out, driver="ESRI Shapefile", encoding="utf-8")
+            logger.info(f"   ✅  FILE CREATED : {out} !")
+        else:
+            result.to_file(out, driver="GPKG")  # encoding géré nativement
+            print(f"   ✅  FILE CREATED : {out} !")
 
     script_time_end = datetime.datetime.now()
     time_elapsed = format_elapsed_time(script_time_start, script_time_end)
@@ -212,6 +331,22 @@ if __name__ == "__main__":
         required=True,
         help="Pattern of extensions data files selected (*.shp)",
     )
+    parser.add_argument(
+        "--precision",
+        type=float,
+        help="Size of the precision grid applied at ingest in meters (ex: 0.01 = 1 cm)",
+    )
+
+    parser.add_argument(
+        "--catalog",
+        action="store_true",
+        help="Use the catalog of the data files (skip files out of the mask, reuse clipped parts of unchanged files)",
+    )
+    parser.add_argument(
+        "--tiled-mask",
+        action="store_true",
+        help="Clip with the mask dissolved once and split in prepared tiles (persisted by CRS)",
+    )
 
     args = parser.parse_args()
     bash_input_dir = args.dir[0]
@@ -225,14 +360,18 @@ if __name__ == "__main__":
     if bash_output_name.split(".")[-1] not in ("shp", "gpkg"):
         bash_output_name = bash_output_name.replace(".", "") + ".shp"
 
-    result = batch_clip_concat(
-        input_dir=bash_input_dir,
-        origin_input_dir=bash_origin_input_dir,
-        clip_file=bash_clip_file,
-        output_name=bash_output_name,
-        pattern=bash_pattern,
-        recursive=False,  # True if wanted to import sub directories
-        add_source_col=False,  # True if Add column "__source__"
-        use_pyogrio=True,  # True if pyogrio available to Boost
-    )
+    with record_run("clip", vars(args)):
+        result = batch_clip_concat(
+            input_dir=bash_input_dir,
+            origin_input_dir=bash_origin_input_dir,
+            clip_file=bash_clip_file,
+            output_name=bash_output_name,
+            pattern=bash_pattern,
+            recursive=False,  # True if wanted to import sub directories
+            add_source_col=False,  # True if Add column "__source__"
+            use_pyogrio=True,  # True if pyogrio available to Boost
+            precision_grid=args.precision,  # None to keep full float precision
+            use_catalog=args.catalog,  # True to skip files out of the mask & reuse unchanged clips
+            use_tiled_mask=args.tiled_mask,  # True to clip with the tiled mask (union done once)
+        )
     print(f"OK : {len(result)} entities on the output data file.")
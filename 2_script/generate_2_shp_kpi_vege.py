@@ -11,12 +11,33 @@ import argparse
 
 from utils.logger import setup_logger
 from utils.functions import wfs2gp_df, format_elapsed_time
+from utils.kpi_vege_process import (
+    strate_areas_out_of_core,
+    strate_areas_from_raster,
+    strate_areas_indexed,
+    strate_landscape_indexed,
+    landscape_kpis,
+    zone_parents,
+    rollup_areas,
+    zone_kpis,
+    grid_cells,
+    strate_areas_grid,
+    strate_areas_grid_from_raster,
+    grid_kpis,
+)
+from utils.mask_index import IndexMasques
+from utils.raster_prepare import resolve_raster
+from utils.run_history import record_stage, record_run
+from utils.cost_model import EtaTracker, history_item_costs
 from utils.constants import (
     INPUT_DATA_DIR,
+    MASK_INDEX_DIR,
     OUTPUT_DATA_DIR,
     RATE_M2_TO_KM2,
     RATE_MK2_TO_HA,
     ROUND_KM2,
+    WFS_COMMUNES_LAYER,
+    WFS_COMMUNES_URL,
 )
 
 import warnings
@@ -30,27 +51,54 @@ logger = setup_logger(
 
 # INFO: launching the script from shell command :
 # python ./2_script/generate_2_shp_kpi_vege.py --file "vegetation_stratifiee_clipped_by_voirie_2018_2154.shp" --origin "OUTPUT" --name "ipave_communes-gl_vege-voirie_kpis_2018_2154"
-
-
-def batch_generate_kpis(input_file: str, origin_input_dir: str, output_name: str):
+# python ./2_script/generate_2_shp_kpi_vege.py --raster "vegetation_stratifiee_2018_2154.tiff" --mask "surfacique_voirie.shp" --origin "INPUT" --name "ipave_communes-gl_vege-voirie_kpis_raster_2018_2154"
+
+
+def batch_generate_kpis(
+    input_file: str | None,
+    origin_input_dir: str,
+    output_name: str | None,
+    gdf_input: gpd.GeoDataFrame | None = None,
+    gdf_cities: gpd.GeoDataFrame | None = None,
+    out_of_core: bool = False,
+    partition_size: float = 2000.0,
+    partition_order: str = "hilbert",
+    raster_file: str | None = None,
+    mask_file: str | None = None,
+    use_mask_index: bool = False,
+    show_eta: bool = False,
+    landscape_metrics: bool = False,
+):
     """
     Script for generating SHP of MDL cities with vegetalisation's KPIs and save datas on a new Shapefile.
 
     Use the script on the shell command like this :
     python ./2_script/generate_2_shp_kpi_vege.py --file "vegetation_stratifiee_2018_2154_ALB.gpkg" --origin "OUTPUT" --name "vegetation_stratifiee_kpis_2018_2154"
     python ./2_script/generate_2_shp_kpi_vege.py --file "vegetation_stratifiee_clipped_by_voirie_2018_2154.shp" --origin "OUTPUT" --name "ipave_communes-gl_vege-voirie_kpis_2018_2154"
+    python ./2_script/generate_2_shp_kpi_vege.py --raster "vegetation_stratifiee_2018_2154.tiff" --mask "surfacique_voirie.shp" --origin "INPUT" --name "ipave_communes-gl_vege-voirie_kpis_raster_2018_2154"
 
         Parameters:
             input_file (string) : Name of the file input used to extract datas (present in the directory ./0_geodatas/input/ - or ./0_geodatas/output/)
             origin_input_dir (string) : Select the parent directory : INPUT or OUTPUT (present in the directory ./0_geodatas/)
-            output_name (string) : Name of the file output used to generate and save datas (as a Shapefile)
+            output_name (string) : Name of the file output used to generate and save datas (as a Shapefile), None to skip the export
+            gdf_input (GeoDataFrame) : In-memory datas used instead of the input file
+            gdf_cities (GeoDataFrame) : Cities already loaded (if None, import from the open-data WFS)
+            out_of_core (bool) : If we're reading the input file by spatial partitions (bbox reads) instead of loading it entirely
+            partition_size (float) : Side of a partition in meters (out-of-core mode)
+            partition_order (string) : Order of the partitions, "grid" or "hilbert" (out-of-core mode)
+            raster_file (string) : Name of the classified raster : areas are counted from the pixels (zonal histogram) instead of the vector file
+            mask_file (string) : Name of a mask (ex: roads) applied to the raster pixels (raster mode)
+            use_mask_index (bool) : If we're loading the windows / pixel masks of the cities from the index MASK_INDEX_DIR (raster mode)
+            show_eta (bool) : If we're logging the estimated time remaining after each city (costs from the run history, vector mode)
+            landscape_metrics (bool) : If we're adding the landscape KPIs by strate (patches, mean / median patch area, largest patch share, edge density, canopy fragmentation), computed with the areas in one indexed pass (vector mode)
 
         Returns:
-            None (but generate a Shapefile with generates datas resumed on the OUTPUT directory)
+            GeoDataFrame of the cities with KPIs (and generate a Shapefile with generates datas resumed on the OUTPUT directory if output_name is given)
     """
     try:
         script_time_start = datetime.datetime.now()
         error = True
+        gdf_voirie_vg_kpis = None
         if output_name:
             if output_name[-4:] != ".shp":
                 output_name = f"{output_name}.shp"
@@ -65,18 +113,43 @@ def batch_generate_kpis(input_file: str, origin_input_dir: str, output_name: str
         # TOOD: how it works with GeoJSON ?
         logger.info(f"   ⚙️    ...checking files if exists...")
 
-        if origin_input_dir == "OUTPUT":
-            if os.path.join(OUTPUT_DATA_DIR, input_file):
-                logger.info(f"     ✅  {input_file} FILE FOUND !")
+        gdf_result = None
+        if gdf_input is not None:
+            logger.info(f"     ✅  IN-MEMORY DATAS FOUND !")
+            error = False
+            gdf_result = gdf_input
+            out_of_core = False
+            raster_file = None
+        elif raster_file:
+            if origin_input_dir == "OUTPUT":
+                input_path = os.path.join(OUTPUT_DATA_DIR, raster_file)
+            else:
+                input_path = os.path.join(INPUT_DATA_DIR, raster_file)
+
+            if os.path.exists(input_path):
+                logger.info(f"     ✅  {raster_file} RASTER FOUND !")
+                input_path = resolve_raster(input_path)
+                logger.info(f"     ⚙️  Raster read : {input_path}")
+                logger.info(f"     ⚙️  Raster mode : zonal histogram of the pixels")
                 error = False
-                gdf_result = gpd.read_file(os.path.join(OUTPUT_DATA_DIR, input_file))
+                out_of_core = False
             else:
-                logger.info(f"     ❌ {input_file} FILE NOT FOUND !")
+                logger.info(f"     ❌ {raster_file} RASTER NOT FOUND !")
         else:
-            if os.path.join(INPUT_DATA_DIR, input_file):
+            if origin_input_dir == "OUTPUT":
+                input_path = os.path.join(OUTPUT_DATA_DIR, input_file)
+            else:
+                input_path = os.path.join(INPUT_DATA_DIR, input_file)
+
+            if os.path.exists(input_path):
                 logger.info(f"     ✅  {input_file} FILE FOUND !")
                 error = False
-                gdf_result = gpd.read_file(os.path.join(INPUT_DATA_DIR, input_file))
+                if out_of_core:
+                    logger.info(
+                        f"     ⚙️  Out-of-core mode : partitions of {partition_size} m ({partition_order})"
+                    )
+                else:
+                    gdf_result = gpd.read_file(input_path)
             else:
                 logger.info(f"     ❌ {input_file} FILE NOT FOUND !")
 
@@ -97,6 +170,11 @@ def batch_generate_kpis(input_file: str, origin_input_dir: str, output_name: str
                 "sup_ha",
                 "geometry",
             ]
+            if landscape_metrics and (raster_file or out_of_core):
+                logger.info(
+                    f"     ❌  Landscape KPIs need the vegetation polygons : not computed in raster / out-of-core mode"
+                )
+                landscape_metrics = False
             gdf_voirie_vg_kpis = gpd.GeoDataFrame(
                 columns=columns_list, geometry="geometry", crs="EPSG:2154"
             )
@@ -107,12 +185,13 @@ def batch_generate_kpis(input_file: str, origin_input_dir: str, output_name: str
             # INFO: STEP 1 - Open cities open-data
             logger.info(f"   ⚙️    ...import Cities datas from open-datas WFS...")
             time_start = datetime.datetime.now()
-            gdf_cities = wfs2gp_df(
-                "metropole-de-lyon:adr_voie_lieu.adrcommunes_2024",
-                "https://data.grandlyon.com/geoserver/metropole-de-lyon/ows?SERVICE=WFS",
-                reprojMetro=True,
-                targetProj="EPSG:2154",
-            )
+            if gdf_cities is None:
+                gdf_cities = wfs2gp_df(
+                    WFS_COMMUNES_LAYER,
+                    WFS_COMMUNES_URL,
+                    reprojMetro=True,
+                    targetProj="EPSG:2154",
+                )
             time_end = datetime.datetime.now()
             time_elapsed = format_elapsed_time(time_start, time_end)
             logger.info(f"   ⚙️  ...CRS got : {gdf_cities.crs}")
@@ -123,6 +202,79 @@ def batch_generate_kpis(input_file: str, origin_input_dir: str, output_name: str
             logger.info(f"   ⚠️    ...warning : long time process...")
             time_start = time.time()
 
+            # Out-of-core / raster : areas by city & strate are computed for all cities at once
+            areas_by_city = None
+            gdf_cities_kpis = gdf_cities[
+                gdf_cities["communegl"].astype(bool)
+                & (gdf_cities["trigramme"] != "LYO")
+            ]
+            if raster_file:
+                gdf_mask = None
+                if mask_file:
+                    gdf_mask = gpd.read_file(os.path.join(INPUT_DATA_DIR, mask_file))
+                    logger.info(f"     ⚙️  Mask applied to the pixels : {mask_file}")
+                mask_index = None
+                if use_mask_index:
+                    mask_index = IndexMasques(MASK_INDEX_DIR)
+                    logger.info(
+                        f"     ⚙️  Masks of the cities index : {MASK_INDEX_DIR}"
+                    )
+                areas_by_city = strate_areas_from_raster(
+                    input_path,
+                    gdf_cities_kpis,
+                    gdf_mask=gdf_mask,
+                    mask_index=mask_index,
+                )
+            elif out_of_core:
+                areas_by_city = strate_areas_out_of_core(
+                    input_path,
+                    gdf_cities_kpis,
+                    partition_size=partition_size,
+                    order=partition_order,
+                )
+            elif landscape_metrics:
+                # Areas and landscape metrics of all the cities in one indexed pass (no clip by city)
+                areas_by_city, metrics_by_city = strate_landscape_indexed(
+                    gdf_result, gdf_cities_kpis
+                )
+                landscape_by_city = landscape_kpis(gdf_cities_kpis, metrics_by_city)
+                columns_list[-1:-1] = list(landscape_by_city.columns)
+                gdf_voirie_vg_kpis = gpd.GeoDataFrame(
+                    columns=columns_list, geometry="geometry", crs="EPSG:2154"
+                )
+            if areas_by_city is not None:
+                record_stage(
+                    "kpiAreas",
+                    (
+                        "raster"
+                        if raster_file
+                        else "out_of_core" if out_of_core else "indexed"
+                    ),
+                    time.time() - time_start,
+                    features_out=len(areas_by_city),
+                )
+
+            eta = None
+            if show_eta and areas_by_city is None:
+                city_costs = history_item_costs(
+                    gdf_cities_kpis["insee"]
+                    + "_"
+                    + gdf_cities_kpis["trigramme"]
+                    + "_"
+                    + gdf_cities_kpis["nom"],
+                    gdf_cities_kpis.geometry.area,
+                    "kpiCity",
+                )
+                eta = EtaTracker(city_costs)
+                if city_costs.attrs["known"]:
+                    logger.info(
+                        f"     ⏳  Estimated time : {city_costs.sum():.0f}s for {len(city_costs)} cities"
+                    )
+                else:
+                    logger.info(
+                        f"     ⏳  No city in the run history : ETA from the first cities (by area)"
+                    )
+
             for index, city in gdf_cities.iterrows():
                 area_city = city["geometry"].area / RATE_M2_TO_KM2 * RATE_MK2_TO_HA
                 area_unknown = 0
@@ -132,14 +284,28 @@ def batch_generate_kpis(input_file: str, origin_input_dir: str, output_name: str
                 total_layer_area = 0
 
                 if city["communegl"] and city["trigramme"] != "LYO":
-                    gdf_city_clipped = gpd.clip(
-                        gdf_result, city["geometry"], keep_geom_type=False, sort=False
-                    )
+                    city_time_start = time.time()
+                    features_in = None
+                    if areas_by_city is not None:
+                        if index in areas_by_city.index:
+                            strate_areas = areas_by_city.loc[index].items()
+                        else:
+                            strate_areas = []
+                    else:
+                        gdf_city_clipped = gpd.clip(
+                            gdf_result,
+                            city["geometry"],
+                            keep_geom_type=False,
+                            sort=False,
+                        )
+                        features_in = len(gdf_city_clipped)
+                        strate_areas = (
+                            (polygon.strate.lower(), polygon.geometry.area)
+                            for polygon in gdf_city_clipped.itertuples()
+                        )
 
                     logger.info(f"       ⚙️  > calculate areas by layer...")
-                    for polygon in gdf_city_clipped.itertuples():
-                        polygon_strate_type = polygon.strate.lower()
-                        polygon_area = polygon.geometry.area
+                    for polygon_strate_type, polygon_area in strate_areas:
                         if polygon_strate_type == "arborescent":
                             upper_layer_area += polygon_area
                             total_layer_area += polygon_area
@@ -168,7 +334,7 @@ def batch_generate_kpis(input_file: str, origin_input_dir: str, output_name: str
                         total_layer_area / RATE_M2_TO_KM2 * RATE_MK2_TO_HA
                     )
                     last_index = len(gdf_voirie_vg_kpis)
-                    gdf_voirie_vg_kpis.loc[last_index] = {
+                    city_kpis = {
                         "gid": city["gid"],
                         "nom": city["nom"],
                         "insee": city["insee"],
@@ -180,7 +346,21 @@ def batch_generate_kpis(input_file: str, origin_input_dir: str, output_name: str
                         "v_veg_t_ha": total_layer_area,
                         "geometry": city["geometry"],
                     }
-
+                    if landscape_metrics:
+                        city_kpis.update(
+                            landscape_by_city.loc[[index]].to_dict("records")[0]
+                        )
+                    gdf_voirie_vg_kpis.loc[last_index] = city_kpis
+
+                    record_stage(
+                        "kpiCity",
+                        f"{city['insee']}_{city['trigramme']}_{city['nom']}",
+                        time.time() - city_time_start,
+                        features_in=features_in,
+                    )
+                    if eta is not None:
+                        eta.done(index, time.time() - city_time_start)
+                        logger.info(f"       ⏳  {eta.summary()}")
                     logger.info(f"       ✅    SUCCESS CALCULATED FOR {city['nom']}")
 
                     mdl_upper_layer_area += upper_layer_area
@@ -198,18 +378,25 @@ def batch_generate_kpis(input_file: str, origin_input_dir: str, output_name: str
                 f"     ✅  ...Sucessfully ended in {time_end - time_start:.4f}s !"
             )
 
-            logger.info(
-                f"   ⚙️    ...export datas on Shapefile (CRS={gdf_voirie_vg_kpis.crs})..."
-            )
-            time_start = time.time()
-            gdf_voirie_vg_kpis.to_file(os.path.join(OUTPUT_DATA_DIR, output_name))
-            time_end = time.time()
-            logger.info(
-                f"     ✅  ...Sucessfully ended in {time_end - time_start:.4f}s !"
-            )
-            logger.info(
-                f"ℹ️  FILE SAVED AT {os.path.join(OUTPUT_DATA_DIR, output_name)} !"
-            )
+            if output_name:
+                logger.info(
+                    f"   ⚙️    ...export datas on Shapefile (CRS={gdf_voirie_vg_kpis.crs})..."
+                )
+                time_start = time.time()
+                gdf_voirie_vg_kpis.to_file(os.path.join(OUTPUT_DATA_DIR, output_name))
+                time_end = time.time()
+                record_stage(
+                    "exportKpis",
+                    output_name,
+                    time_end - time_start,
+                    features_in=len(gdf_voirie_vg_kpis),
+                )
+                logger.info(
+                    f"     ✅  ...Sucessfully ended in {time_end - time_start:.4f}s !"
+                )
+                logger.info(
+                    f"ℹ️  FILE SAVED AT {os.path.join(OUTPUT_DATA_DIR, output_name)} !"
+                )
 
             # INFO: STEP 4 - Return KPIs on global (MDL)
             logger.info(f"🗺️  Results on Metropole de Lyon :")
@@ -230,6 +417,236 @@ def batch_generate_kpis(input_file: str, origin_input_dir: str, output_name: str
         time_elapsed = format_elapsed_time(script_time_start, script_time_end)
         logger.info(f" 🌳 🌾 🌿 END OF SCRIPT IN {time_elapsed} 🌳 🌾 🌿")
         logger.info("")
+        return gdf_voirie_vg_kpis
+    except Exception as error:
+        logger.info(f"🚨 🚨 🚨 🚨  An error as occured !  🚨 🚨 🚨 🚨")
+        logger.info("")
+        logger.error(f"   > {str(error)} > {traceback.print_exc()}")
+
+
+def batch_generate_zone_kpis(
+    input_file: str | None,
+    origin_input_dir: str,
+    zone_files: list,
+    output_name: str | None,
+    gdf_input: gpd.GeoDataFrame | None = None,
+    out_of_core: bool = False,
+    partition_size: float = 2000.0,
+    partition_order: str = "hilbert",
+    raster_file: str | None = None,
+    mask_file: str | None = None,
+):
+    """
+    Generate vegetation KPIs for several nested zonings (ex: IRIS, quartiers, cities) in one pass.
+
+    The areas by strate are computed once on the finest zoning (first file) : indexed intersection of the
+    vegetation polygons (or out-of-core / raster modes, see batch_generate_kpis), then rolled up zoning
+    by zoning (each zone of a level goes to the zone of the next level containing it).
+    An extra zoning level only costs the roll-up of the previous level.
+
+    Use the script on the shell command like this :
+    python ./2_script/generate_2_shp_kpi_vege.py --file "vegetation_stratifiee_clipped_by_voirie_2018_2154.shp" --origin "OUTPUT" --name "ipave_vege-voirie_kpis_2018_2154" --zones "iris.shp" "quartiers.shp" "communes.shp"
+
+        Parameters:
+            input_file (string) : Name of the vegetation file (present in the directory ./0_geodatas/input/ - or ./0_geodatas/output/)
+            origin_input_dir (string) : Select the parent directory : INPUT or OUTPUT (present in the directory ./0_geodatas/)
+            zone_files (list) : Names of the zoning files (present in the directory ./0_geodatas/input/), from the finest to the coarsest
+            output_name (string) : Prefix of the Shapefiles generated (<output_name>_<zoning>.shp), None to skip the export
+            gdf_input (GeoDataFrame) : In-memory datas used instead of the input file
+            out_of_core (bool) : If we're reading the input file by spatial partitions (bbox reads) instead of loading it entirely
+            partition_size (float) : Side of a partition in meters (out-of-core mode)
+            partition_order (string) : Order of the partitions, "grid" or "hilbert" (out-of-core mode)
+            raster_file (string) : Name of the classified raster : areas are counted from the pixels (zonal histogram) instead of the vector file
+            mask_file (string) : Name of a mask (ex: roads) applied to the raster pixels (raster mode)
+
+        Returns:
+            Dict of GeoDataFrames of the zones with KPIs ({zoning name : GeoDataFrame})
+    """
+    try:
+        script_time_start = datetime.datetime.now()
+        logger.info(f"🚀 Let's go ! (KPIs by zonings)")
+        input_dir = OUTPUT_DATA_DIR if origin_input_dir == "OUTPUT" else INPUT_DATA_DIR
+
+        # INFO: STEP 1 - Zonings, from the finest to the coarsest
+        zonings = {}
+        for zone_file in zone_files:
+            zone_path = os.path.join(INPUT_DATA_DIR, zone_file)
+            if not os.path.exists(zone_path):
+                logger.info(f"     ❌ {zone_file} ZONING NOT FOUND !")
+                return None
+            zonings[os.path.splitext(os.path.basename(zone_file))[0]] = gpd.read_file(
+                zone_path
+            ).to_crs("EPSG:2154")
+            logger.info(f"     ✅  {zone_file} ZONING FOUND !")
+        levels = list(zonings)
+
+        # INFO: STEP 2 - Areas by strate on the finest zoning
+        time_start = time.time()
+        gdf_finest = zonings[levels[0]]
+        if gdf_input is not None:
+            areas = strate_areas_indexed(gdf_input, gdf_finest)
+        elif raster_file:
+            gdf_mask = None
+            if mask_file:
+                gdf_mask = gpd.read_file(os.path.join(INPUT_DATA_DIR, mask_file))
+            areas = strate_areas_from_raster(
+                resolve_raster(os.path.join(input_dir, raster_file)),
+                gdf_finest,
+                gdf_mask=gdf_mask,
+            )
+        elif out_of_core:
+            areas = strate_areas_out_of_core(
+                os.path.join(input_dir, input_file),
+                gdf_finest,
+                partition_size=partition_size,
+                order=partition_order,
+            )
+        else:
+            areas = strate_areas_indexed(
+                gpd.read_file(os.path.join(input_dir, input_file)), gdf_finest
+            )
+        logger.info(
+            f"     ✅  Areas of {len(gdf_finest)} zones ({levels[0]}) in {time.time() - time_start:.4f}s !"
+        )
+
+        # INFO: STEP 3 - Roll-up on the coarser zonings
+        results = {levels[0]: zone_kpis(gdf_finest, areas)}
+        for fine, coarse in zip(levels[:-1], levels[1:]):
+            time_start = time.time()
+            parents = zone_parents(zonings[fine], zonings[coarse])
+            if len(parents) < len(zonings[fine]):
+                logger.info(
+                    f"       ❌  {len(zonings[fine]) - len(parents)} zones of {fine} outside of {coarse}"
+                )
+            areas = rollup_areas(areas, parents)
+            results[coarse] = zone_kpis(zonings[coarse], areas)
+            logger.info(
+                f"     ✅  Roll-up {fine} -> {coarse} in {time.time() - time_start:.4f}s !"
+            )
+
+        # INFO: STEP 4 - Export a Shapefile by zoning
+        if output_name:
+            output_name = (
+                output_name[:-4] if output_name.endswith(".shp") else output_name
+            )
+            for level, gdf_kpis in results.items():
+                output_path = os.path.join(
+                    OUTPUT_DATA_DIR, f"{output_name}_{level}.shp"
+                )
+                gdf_kpis.to_file(output_path)
+                logger.info(f"ℹ️  FILE SAVED AT {output_path} !")
+
+        script_time_end = datetime.datetime.now()
+        time_elapsed = format_elapsed_time(script_time_start, script_time_end)
+        logger.info(f" 🌳 🌾 🌿 END OF SCRIPT IN {time_elapsed} 🌳 🌾 🌿")
+        logger.info("")
+        return results
+    except Exception as error:
+        logger.info(f"🚨 🚨 🚨 🚨  An error as occured !  🚨 🚨 🚨 🚨")
+        logger.info("")
+        logger.error(f"   > {str(error)} > {traceback.print_exc()}")
+
+
+def batch_generate_grid_kpis(
+    input_file: str | None,
+    origin_input_dir: str,
+    output_name: str | None,
+    cell_size: float = 100.0,
+    gdf_input: gpd.GeoDataFrame | None = None,
+    gdf_cities: gpd.GeoDataFrame | None = None,
+    partition_size: float = 2000.0,
+    raster_file: str | None = None,
+    mask_file: str | None = None,
+):
+    """
+    Generate vegetation KPIs on a regular grid (ex: cells of 50 m or 100 m) over the cities of the Metropole.
+
+    The areas are assigned to the cells without any clip by cell : vectorized intersection of the polygons
+    with the cells (spatial index), partition by partition (bounded memory), or pixel binning on the raster.
+
+    Use the script on the shell command like this :
+    python ./2_script/generate_2_shp_kpi_vege.py --file "vegetation_stratifiee_clipped_by_voirie_2018_2154.shp" --origin "OUTPUT" --name "ipave_vege-voirie_grid100_2018_2154" --grid 100
+    python ./2_script/generate_2_shp_kpi_vege.py --raster "vegetation_stratifiee_2018_2154.tiff" --origin "INPUT" --name "ipave_vege_grid50_2018_2154" --grid 50
+
+        Parameters:
+            input_file (string) : Name of the vegetation file (present in the directory ./0_geodatas/input/ - or ./0_geodatas/output/)
+            origin_input_dir (string) : Select the parent directory : INPUT or OUTPUT (present in the directory ./0_geodatas/)
+            output_name (string) : Name of the grid Shapefile generated, None to skip the export
+            cell_size (float) : Side of a cell in meters
+            gdf_input (GeoDataFrame) : In-memory datas used instead of the input file
+            gdf_cities (GeoDataFrame) : Cities already loaded (if None, import from the open-data WFS)
+            partition_size (float) : Side of the partitions processed one by one in meters (vector mode)
+            raster_file (string) : Name of the classified raster : pixel binning instead of the vector file
+            mask_file (string) : Name of a mask (ex: roads) applied to the raster pixels (raster mode)
+
+        Returns:
+            GeoDataFrame of the cells with KPIs (hectares and cover ratios by strate)
+    """
+    try:
+        script_time_start = datetime.datetime.now()
+        logger.info(f"🚀 Let's go ! (KPIs on a grid of {cell_size} m)")
+        input_dir = OUTPUT_DATA_DIR if origin_input_dir == "OUTPUT" else INPUT_DATA_DIR
+
+        # INFO: STEP 1 - Cities & grid over the territory
+        if gdf_cities is None:
+            gdf_cities = wfs2gp_df(
+                WFS_COMMUNES_LAYER,
+                WFS_COMMUNES_URL,
+                reprojMetro=True,
+                targetProj="EPSG:2154",
+            )
+        gdf_territory = gdf_cities[
+            gdf_cities["communegl"].astype(bool) & (gdf_cities["trigramme"] != "LYO")
+        ]
+        cells = grid_cells(gdf_territory, cell_size)
+        logger.info(f"   ⚙️  Grid : {len(cells)} cells of {cell_size} m")
+
+        # INFO: STEP 2 - Areas by cell & strate
+        time_start = time.time()
+        if raster_file:
+            gdf_mask = None
+            if mask_file:
+                gdf_mask = gpd.read_file(os.path.join(INPUT_DATA_DIR, mask_file))
+                logger.info(f"     ⚙️  Mask applied to the pixels : {mask_file}")
+            areas = strate_areas_grid_from_raster(
+                resolve_raster(os.path.join(input_dir, raster_file)),
+                cells,
+                cell_size,
+                gdf_territory,
+                gdf_mask=gdf_mask,
+            )
+        else:
+            source = (
+                gdf_input
+                if gdf_input is not None
+                else os.path.join(input_dir, input_file)
+            )
+            areas = strate_areas_grid(
+                source,
+                cells,
+                cell_size,
+                partition_size=partition_size,
+                gdf_zones=gdf_territory,
+            )
+        gdf_grid_kpis = grid_kpis(cells, areas)
+        logger.info(
+            f"     ✅  ...Sucessfully ended in {time.time() - time_start:.4f}s !"
+        )
+
+        # INFO: STEP 3 - Export
+        if output_name:
+            if output_name[-4:] != ".shp":
+                output_name = f"{output_name}.shp"
+            gdf_grid_kpis.to_file(os.path.join(OUTPUT_DATA_DIR, output_name))
+            logger.info(
+                f"ℹ️  FILE SAVED AT {os.path.join(OUTPUT_DATA_DIR, output_name)} !"
+            )
+
+        script_time_end = datetime.datetime.now()
+        time_elapsed = format_elapsed_time(script_time_start, script_time_end)
+        logger.info(f" 🌳 🌾 🌿 END OF SCRIPT IN {time_elapsed} 🌳 🌾 🌿")
+        logger.info("")
+        return gdf_grid_kpis
     except Exception as error:
         logger.info(f"🚨 🚨 🚨 🚨  An error as occured !  🚨 🚨 🚨 🚨")
         logger.info("")
@@ -241,7 +658,6 @@ if __name__ == "__main__":
     parser.add_argument(
         "--file",
         nargs=1,
-        required=True,
         help="Path of the input file (.gpkg, .shp)",
     )
     parser.add_argument(
@@ -256,13 +672,101 @@ if __name__ == "__main__":
         required=True,
         help="name of the final Shapefile",
     )
+    parser.add_argument(
+        "--out-of-core",
+        action="store_true",
+        help="Read the input file by spatial partitions (bounded memory)",
+    )
+    parser.add_argument(
+        "--partition-size",
+        type=float,
+        default=2000.0,
+        help="Side of a partition in meters (out-of-core mode)",
+    )
+    parser.add_argument(
+        "--partition-order",
+        choices=("grid", "hilbert"),
+        default="hilbert",
+        help="Order of the partitions (out-of-core mode)",
+    )
+    parser.add_argument(
+        "--raster",
+        help="Classified raster : KPIs from the pixels (zonal histogram) instead of --file",
+    )
+    parser.add_argument(
+        "--mask",
+        help="Mask (ex: roads, on the INPUT directory) applied to the pixels (raster mode)",
+    )
+    parser.add_argument(
+        "--zones",
+        nargs="+",
+        help="Zoning files (on the INPUT directory) from the finest to the coarsest : KPIs by zone instead of by city",
+    )
+    parser.add_argument(
+        "--grid",
+        type=float,
+        help="Side of the cells in meters : KPIs on a regular grid instead of by city",
+    )
+    parser.add_argument(
+        "--mask-index",
+        action="store_true",
+        help="Load the windows / pixel masks of the cities from the persistent index (raster mode)",
+    )
+    parser.add_argument(
+        "--eta",
+        action="store_true",
+        help="Log the estimated time remaining after each city (costs from the run history)",
+    )
+    parser.add_argument(
+        "--landscape",
+        action="store_true",
+        help="Add the landscape KPIs by strate (patches, patch areas, largest patch share, edge density, canopy fragmentation)",
+    )
 
     args = parser.parse_args()
-    bash_input_file = args.file[0]
+    if not args.file and not args.raster:
+        parser.error("--file or --raster is required")
+    bash_input_file = args.file[0] if args.file else None
     bash_origin_input_dir = args.origin[0]
     bash_output_name = args.name[0]
 
     if bash_origin_input_dir not in ("INPUT", "OUTPUT"):
         bash_origin_input_dir = "INPUT"
 
-    batch_generate_kpis(bash_input_file, bash_origin_input_dir, bash_output_name)
+    with record_run("kpi", vars(args)):
+        if args.grid:
+            batch_generate_grid_kpis(
+                bash_input_file,
+                bash_origin_input_dir,
+                bash_output_name,
+                cell_size=args.grid,
+                partition_size=args.partition_size,
+                raster_file=args.raster,
+                mask_file=args.mask,
+            )
+        elif args.zones:
+            batch_generate_zone_kpis(
+                bash_input_file,
+                bash_origin_input_dir,
+                args.zones,
+                bash_output_name,
+                out_of_core=args.out_of_core,
+                partition_size=args.partition_size,
+                partition_order=args.partition_order,
+                raster_file=args.raster,
+                mask_file=args.mask,
+            )
+        else:
+            batch_generate_kpis(
+                bash_input_file,
+                bash_origin_input_dir,
+                bash_output_name,
+                out_of_core=args.out_of_core,
+                partition_size=args.partition_size,
+                partition_order=args.partition_order,
+                raster_file=args.raster,
+                mask_file=args.mask,
+                use_mask_index=args.mask_index,
+                show_eta=args.eta,
+                landscape_metrics=args.landscape,
+            )
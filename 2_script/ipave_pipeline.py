@@ -0,0 +1,893 @@
+import sys
+import os
+import datetime
+import argparse
+import glob
+from contextlib import nullcontext
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+sys.path.append(os.path.abspath(os.path.dirname(__file__)))
+
+import rasterio
+import pyogrio
+import pandas as pd
+import geopandas as gpd
+
+from utils.logger import setup_logger
+from utils.functions import wfs2gp_df, format_elapsed_time
+from utils.vectorisation_vege_process import (
+    vegeBigProcess,
+    chargerCommunes,
+    PARAMS_ETAPES,
+)
+from utils.cost_model import CostModel, lpt_schedule
+from utils.stage_cache import StageCache
+from utils.mask_index import IndexMasques
+from utils.raster_prepare import prepare_raster, resolve_raster, COG_OPTIONS
+from utils.tiles_process import build_vector_tiles
+from utils.run_history import RunHistory, record_run
+from utils.work_queue import WorkQueue, CLAIMED, DONE, FAILED, PENDING
+from utils.constants import (
+    INPUT_DATA_DIR,
+    MASK_INDEX_DIR,
+    OUTPUT_DATA_DIR,
+    RUN_HISTORY_DB,
+    STAGE_CACHE_DIR,
+    STAGE_CACHE_MAX_SIZE,
+    WFS_COMMUNES_LAYER,
+    WFS_COMMUNES_URL,
+    WORK_QUEUE_DIR,
+    WORK_QUEUE_LEASE_S,
+)
+from generate_1_shp_comunes_vege import batch_clip_concat
+from generate_2_shp_kpi_vege import (
+    batch_generate_kpis,
+    batch_generate_zone_kpis,
+    batch_generate_grid_kpis,
+)
+
+import warnings
+
+warnings.filterwarnings("ignore")
+
+logger = setup_logger(
+    __name__, info_log_file="logs/info.log", error_log_file="logs/error.log"
+)
+
+# INFO: launching the script from shell command :
+# python ./2_script/ipave_pipeline.py run-all --raster "vegetation_stratifiee_2018_2154.tiff" --mask "surfacique_voirie.shp" --name "ipave_communes-gl_vege-voirie_kpis_2018_2154"
+# python ./2_script/ipave_pipeline.py prepare-raster --raster "vegetation_stratifiee_2018_2154.tiff"
+# python ./2_script/ipave_pipeline.py vectorize --raster "vegetation_stratifiee_2018_2154.tiff" --insee 69072 69286
+# python ./2_script/ipave_pipeline.py clip --dir "vegetation_stratifiee_2018_2154" --origin "OUTPUT" --mask "surfacique_voirie.shp" --name "vegetation_stratifiee_clipped_by_voirie_2018_2154.shp" --extension "*.shp"
+# python ./2_script/ipave_pipeline.py kpi --file "vegetation_stratifiee_clipped_by_voirie_2018_2154.shp" --origin "OUTPUT" --name "ipave_communes-gl_vege-voirie_kpis_2018_2154"
+# python ./2_script/ipave_pipeline.py report --window 10 --threshold 1.25
+# python ./2_script/ipave_pipeline.py tiles --vege "vegetation_stratifiee_2018_2154_*.shp" --kpi "ipave_communes-gl_vege-voirie_kpis_2018_2154" --name "ipave_vege_kpis.mbtiles" --workers 4
+
+CHECKPOINT_STAGES = ("vectorize", "clip")
+CLIPPED_CHECKPOINT_NAME = "vegetation_stratifiee_clipped_by_voirie_2018_2154.shp"
+
+
+def get_stage_cache(use_cache: bool, cache_max_gb: float | None = None):
+    """
+    Build the cache of the intermediate stages of vegeBigProcess (None if disabled).
+    """
+    if not use_cache:
+        return None
+    max_size = (
+        int(cache_max_gb * 1024**3)
+        if cache_max_gb is not None
+        else STAGE_CACHE_MAX_SIZE
+    )
+    logger.info(f"   ▶️  Stage cache : {STAGE_CACHE_DIR} (max {max_size} bytes)")
+    return StageCache(STAGE_CACHE_DIR, max_size)
+
+
+def add_vectorize_arguments(subparser):
+    """
+    Options of the vectorization shared by the "vectorize" and "run-all" subcommands.
+    """
+    subparser.add_argument(
+        "--raster",
+        default="vegetation_stratifiee_2018_2154.tiff",
+        help="Name of the raster file (on the INPUT directory)",
+    )
+    subparser.add_argument(
+        "--insee", nargs="*", help="INSEE codes of the communes to process"
+    )
+    subparser.add_argument(
+        "--cache", action="store_true", help="Use the cache of intermediate stages"
+    )
+    subparser.add_argument(
+        "--cache-max-gb", type=float, help="Size cap of the stage cache (GB)"
+    )
+    subparser.add_argument(
+        "--prefetch",
+        type=int,
+        default=0,
+        help="Number of communes read ahead by a background thread (raster windows)",
+    )
+    subparser.add_argument(
+        "--mask-index",
+        action="store_true",
+        help="Load the raster windows / pixel masks of the communes from the persistent index",
+    )
+    subparser.add_argument(
+        "--precision",
+        type=float,
+        help="Precision grid applied at ingest in meters (ex: 0.01 = 1 cm)",
+    )
+    subparser.add_argument(
+        "--sieve",
+        type=int,
+        default=0,
+        help="Raster pre-cleaning : remove patches smaller than N pixels",
+    )
+    subparser.add_argument(
+        "--morpho",
+        type=int,
+        default=0,
+        help="Raster pre-cleaning : radius (pixels) of the opening/closing by class",
+    )
+    subparser.add_argument(
+        "--coverage-union",
+        action="store_true",
+        help="Dissolve step 5 with a coverage union (fallback on unary union)",
+    )
+    subparser.add_argument(
+        "--coverage-simplify",
+        action="store_true",
+        help="Step 6 : simplify the merged strata of a commune as one coverage (shared edges simplified once), without the buffer of step 5 nor the smoothing : the output has no gap or overlap between strata. Implies the coverage union of steps 5 and 7",
+    )
+    subparser.add_argument(
+        "--export-format",
+        choices=["shp", "gpkg", "gpkg-communes"],
+        default="shp",
+        help="Export of the vectorized communes : a Shapefile per commune, one GeoPackage layer, or a GeoPackage layer per commune",
+    )
+    subparser.add_argument(
+        "--dissolve-cell",
+        type=float,
+        help="Partitioned dissolve of step 7 : side of the grid cells in meters",
+    )
+    subparser.add_argument(
+        "--dissolve-workers",
+        type=int,
+        default=1,
+        help="Number of threads for the partitioned dissolve of step 7",
+    )
+    subparser.add_argument(
+        "--schedule",
+        action="store_true",
+        help="Process the most costly communes first (cost model calibrated on the run history) and log the ETA",
+    )
+    subparser.add_argument(
+        "--estimate",
+        action="store_true",
+        help="Dry run : estimate the cost of each commune and the total time, without processing",
+    )
+    subparser.add_argument(
+        "--plan-workers",
+        type=int,
+        default=1,
+        help="With --estimate : split the communes between N concurrent runs (longest first)",
+    )
+    subparser.add_argument(
+        "--queue",
+        help="Distributed mode : name (or path) of the work queue shared by the workers, each worker claims the next commune (vectorize only)",
+    )
+    subparser.add_argument(
+        "--lease",
+        type=float,
+        default=WORK_QUEUE_LEASE_S,
+        help="Distributed mode : lease of a claimed commune in seconds (renewed by the worker, claimed again if it expires)",
+    )
+
+
+def vectorize_options(args) -> dict:
+    """
+    Keyword arguments of vegeBigProcess built from the command line options.
+    """
+    params_etapes = {}
+    if args.sieve or args.morpho:
+        params_etapes["etape3"] = {
+            "sieve_min_pixels": args.sieve,
+            "rayon_morpho": args.morpho,
+        }
+    if args.precision:
+        params_etapes["etape4"] = {"grid_size": args.precision}
+    if args.coverage_union:
+        # Step 7 : the strata smoothed by step 6 (buffer) are never a coverage, unary union kept
+        params_etapes["etape5"] = {"methode_union": "coverage"}
+    if args.coverage_simplify:
+        # The strata stay a coverage from step 5 to step 7 : no buffer of step 5 (the buffered strata
+        # overlap), no smoothing in step 6, coverage union in step 7
+        params_etapes["etape5"] = {"methode_union": "coverage", "tampon_final": False}
+        params_etapes["etape6"] = {
+            "methode_simplification": "coverage",
+            "tampon": PARAMS_ETAPES["etape5"]["buffer_dist"],
+        }
+        params_etapes["etape7"] = {"methode_union": "coverage"}
+    if args.dissolve_cell:
+        params_etapes.setdefault("etape7", {}).update(
+            {
+                "taille_partition": args.dissolve_cell,
+                "nb_workers": args.dissolve_workers,
+            }
+        )
+    return {
+        "specificComList": args.insee,
+        "params_etapes": params_etapes,
+        "cache": get_stage_cache(args.cache, args.cache_max_gb),
+        "format_export": args.export_format.replace("-", "_"),
+        "index_masques": IndexMasques(MASK_INDEX_DIR) if args.mask_index else None,
+        "prefetch": args.prefetch,
+        "modele_cout": CostModel() if args.schedule else None,
+        "file_travail": (
+            WorkQueue(os.path.join(WORK_QUEUE_DIR, args.queue), lease_s=args.lease)
+            if args.queue
+            else None
+        ),
+    }
+
+
+def run_vectorize(raster_name: str, export=True, vege_options: dict | None = None):
+    """
+    Vectorize the stratified vegetation raster, commune by commune.
+
+        Parameters:
+            raster_name (string) : Name of the raster file (present in the directory ./0_geodatas/input/)
+            export (bool) : If we're saving a Shapefile per commune on the OUTPUT directory
+            vege_options (dict) : Keyword arguments given to vegeBigProcess (specificComList, params_etapes, cache...)
+
+        Returns:
+            Dict of GeoDataFrames ({export file name : GeoDataFrame})
+    """
+    raster_path = resolve_raster(os.path.join(INPUT_DATA_DIR, raster_name))
+    logger.info(f"   ▶️  Raster used : {raster_path}")
+    with rasterio.open(raster_path) as raster:
+        return vegeBigProcess(raster, export=export, **(vege_options or {}))
+
+
+def run_estimate(
+    raster_name: str, specific_com_list: list | None = None, workers: int = 1
+):
+    """
+    Dry run of the vectorization : estimated cost of each commune (pixels and vegetation pixels,
+    cost model calibrated on the run history), total time and split between concurrent runs.
+
+        Parameters:
+            raster_name (string) : Name of the raster file (present in the directory ./0_geodatas/input/)
+            specific_com_list (list) : INSEE codes of the communes to estimate (all by default)
+            workers (int) : Number of concurrent runs to plan (longest processing time first)
+
+        Returns:
+            DataFrame of the communes (item, pixels, vege_pixels, cost_s), by decreasing cost
+    """
+    communes = chargerCommunes()
+    if specific_com_list:
+        communes = communes[communes["insee"].isin(specific_com_list)]
+    model = CostModel()
+    raster_path = resolve_raster(os.path.join(INPUT_DATA_DIR, raster_name))
+    with rasterio.open(raster_path) as raster:
+        estimation = model.estimate(raster, communes)
+
+    logger.info(
+        f"📊  Cost model : {model.calibrated_on} communes of the history, "
+        f"{', '.join(f'{k}={v:.3g}' for k, v in model.coefficients.items())} s/px, "
+        f"{model.intercept:.2f} s by commune"
+    )
+    for row in estimation.itertuples():
+        logger.info(
+            f"   ⏳  {row.item} : {row.cost_s:.1f}s ({row.pixels / 1e6:.2f} Mpx, {row.vege_pixels / 1e6:.2f} Mpx of vegetation)"
+        )
+    logger.info(
+        f"   ▶️  Estimated total : {estimation['cost_s'].sum():.0f}s for {len(estimation)} communes"
+    )
+    if workers > 1:
+        insee = communes["insee"]
+        plan = lpt_schedule(estimation["cost_s"], workers)
+        for worker, (load, indexes) in enumerate(plan, start=1):
+            logger.info(
+                f"   🧩  Run {worker} : ~{load:.0f}s, --insee {' '.join(insee.loc[indexes])}"
+            )
+        logger.info(
+            f"   ▶️  Estimated makespan with {workers} concurrent runs : {max(load for load, _ in plan):.0f}s"
+        )
+    return estimation
+
+
+def run_prepare_raster(
+    raster_name: str, block_size: int, compress: str, force: bool = False
+):
+    """
+    Rewrite the raster as a tiled Cloud-Optimized GeoTIFF (internal overviews, lossless compression),
+    later runs of vectorize / run-all / kpi --raster use the prepared file automatically.
+
+        Parameters:
+            raster_name (string) : Name of the raster file (present in the directory ./0_geodatas/input/)
+            block_size (int) : Side of the tiles (pixels)
+            compress (string) : Lossless compression (DEFLATE, ZSTD, LZW...)
+            force (bool) : Rewrite even if a prepared file is already recorded
+
+        Returns:
+            Path of the prepared raster
+    """
+    time_start = datetime.datetime.now()
+    raster_path = os.path.join(INPUT_DATA_DIR, raster_name)
+    logger.info(f"   ▶️  Raster to prepare : {raster_path}")
+    prepared_path = prepare_raster(
+        raster_path,
+        options={"BLOCKSIZE": block_size, "COMPRESS": compress},
+        force=force,
+    )
+    time_elapsed = format_elapsed_time(time_start, datetime.datetime.now())
+    logger.info(f"   ✅  PREPARE-RASTER DONE in {time_elapsed} : {prepared_path}")
+    return prepared_path
+
+
+def run_all(
+    raster_name: str,
+    clip_file: str,
+    output_name: str,
+    checkpoints: list | None = None,
+    vege_options: dict | None = None,
+    clip_options: dict | None = None,
+):
+    """
+    Chain vectorize -> clip -> KPIs in memory, GeoDataFrames are passed directly between stages.
+
+        Parameters:
+            raster_name (string) : Name of the raster file (present in the directory ./0_geodatas/input/)
+            clip_file (string) : Name of the file (.shp or .gpkg) used to define clipping area (present in the directory ./0_geodatas/input/)
+            output_name (string) : Name of the final KPIs Shapefile
+            checkpoints (list) : Intermediate stages saved on the OUTPUT directory ("vectorize", "clip")
+            vege_options (dict) : Keyword arguments given to vegeBigProcess (specificComList, params_etapes, cache...)
+            clip_options (dict) : Keyword arguments given to batch_clip_concat (precision_grid...)
+
+        Returns:
+            GeoDataFrame of the cities with KPIs
+    """
+    script_time_start = datetime.datetime.now()
+    checkpoints = checkpoints or []
+    logger.info(f"🚀  Let's go ! (run-all)")
+    logger.info(f"   ▶️  Checkpoints saved : {', '.join(checkpoints) or '-none-'}")
+
+    # INFO: STEP 0 - Cities are fetched once and shared by the stages
+    communes_larges = wfs2gp_df(
+        WFS_COMMUNES_LAYER,
+        WFS_COMMUNES_URL,
+        reprojMetro=True,
+        targetProj="EPSG:2154",
+    )
+
+    # INFO: STEP 1 - Vectorize
+    time_start = datetime.datetime.now()
+    raster_path = resolve_raster(os.path.join(INPUT_DATA_DIR, raster_name))
+    logger.info(f"   ▶️  Raster used : {raster_path}")
+    with rasterio.open(raster_path) as raster:
+        vege_communes = vegeBigProcess(
+            raster,
+            communes_larges=communes_larges,
+            export="vectorize" in checkpoints,
+            **(vege_options or {}),
+        )
+    time_elapsed = format_elapsed_time(time_start, datetime.datetime.now())
+    logger.info(
+        f"   ✅  VECTORIZE DONE ({len(vege_communes)} communes) in {time_elapsed}"
+    )
+
+    # INFO: STEP 2 - Clip by the roads area
+    time_start = datetime.datetime.now()
+    gdf_clipped = batch_clip_concat(
+        input_dir=None,
+        origin_input_dir="OUTPUT",
+        clip_file=clip_file,
+        output_name=CLIPPED_CHECKPOINT_NAME if "clip" in checkpoints else None,
+        add_source_col=False,
+        input_gdfs=vege_communes,
+        **(clip_options or {}),
+    )
+    del vege_communes
+    time_elapsed = format_elapsed_time(time_start, datetime.datetime.now())
+    logger.info(f"   ✅  CLIP DONE ({len(gdf_clipped)} entities) in {time_elapsed}")
+
+    # INFO: STEP 3 - KPIs
+    gdf_kpis = batch_generate_kpis(
+        None,
+        "OUTPUT",
+        output_name,
+        gdf_input=gdf_clipped,
+        gdf_cities=communes_larges,
+    )
+    if gdf_kpis is None:
+        # batch_generate_kpis logs its errors and returns None : the run must not be recorded as "ok"
+        raise RuntimeError("run-all : KPIs generation failed (see the logs above)")
+
+    time_elapsed = format_elapsed_time(script_time_start, datetime.datetime.now())
+    logger.info(f" 🌳 🌾 🌿 END OF RUN-ALL IN {time_elapsed} 🌳 🌾 🌿")
+    logger.info("")
+    return gdf_kpis
+
+
+def run_tiles(
+    vege_pattern: str | None,
+    kpi_name: str | None,
+    output_name: str,
+    min_zoom: int = 10,
+    max_zoom: int = 16,
+    workers: int = 1,
+):
+    """
+    Build the vector tiles (MBTiles) of the web map from the pipeline outputs (OUTPUT directory).
+
+        Parameters:
+            vege_pattern (string) : Pattern of the vegetation files (.shp, or .gpkg with all its layers)
+            kpi_name (string) : Name of the KPIs file (output of the "kpi" stage)
+            output_name (string) : Name of the MBTiles file
+            min_zoom (int), max_zoom (int) : Zoom levels of the pyramid
+            workers (int) : Number of processes used to generate the tiles
+
+        Returns:
+            Path of the MBTiles file
+    """
+    time_start = datetime.datetime.now()
+    layers = {}
+
+    if vege_pattern:
+        vege_paths = sorted(glob.glob(os.path.join(OUTPUT_DATA_DIR, vege_pattern)))
+        logger.info(f"   ▶️  Vegetation files : {len(vege_paths)}")
+        frames = [
+            pyogrio.read_dataframe(path, layer=layer)
+            for path in vege_paths
+            for layer in pyogrio.list_layers(path)[:, 0]
+        ]
+        if frames:
+            layers["vegetation"] = pd.concat(frames, ignore_index=True)
+    if kpi_name:
+        layers["kpis"] = gpd.read_file(os.path.join(OUTPUT_DATA_DIR, kpi_name))
+
+    if not layers:
+        logger.error("   ❌  No layer to tile")
+        return None
+
+    output_path = build_vector_tiles(
+        layers,
+        os.path.join(OUTPUT_DATA_DIR, output_name),
+        min_zoom=min_zoom,
+        max_zoom=max_zoom,
+        workers=workers,
+    )
+    time_elapsed = format_elapsed_time(time_start, datetime.datetime.now())
+    logger.info(
+        f"   ✅  TILES DONE ({', '.join(layers)}) in {time_elapsed} : {output_path}"
+    )
+    return output_path
+
+
+def run_report(
+    run_id: int | None = None,
+    window: int = 10,
+    threshold: float = 1.25,
+    list_runs: int = 0,
+):
+    """
+    Compare a run of the history with the trailing median of the previous runs of the same entry point,
+    stage by stage, and flag the stages that got slower.
+
+        Parameters:
+            run_id (int) : Run to compare (default : the last finished run)
+            window (int) : Number of previous successful runs used for the median
+            threshold (float) : Ratio wall time / median above which a stage is flagged
+            list_runs (int) : Number of last runs listed before the report (0 : none)
+
+        Returns:
+            DataFrame of the stages (see RunHistory.report)
+    """
+    history = RunHistory(RUN_HISTORY_DB)
+    try:
+        if list_runs:
+            for run in history.runs(limit=list_runs).itertuples():
+                logger.info(
+                    f"   🗂️  #{run.run_id} {run.entry_point} {run.started_at} : {run.status}, "
+                    f"{run.wall_s or 0:.1f}s, peak {run.peak_rss_mb or 0:.0f} MB"
+                )
+        run, stages = history.report(run_id, window=window, threshold=threshold)
+    finally:
+        history.close()
+
+    previous = stages.attrs["previous_runs"]
+    logger.info(
+        f"📊  Run #{run['run_id']} ({run['entry_point']}, {run['started_at']}, {run['status']}) : "
+        f"{run['wall_s'] or 0:.1f}s, peak {run['peak_rss_mb'] or 0:.0f} MB"
+    )
+    logger.info(
+        f"   ▶️  Compared with the median of {len(previous)} previous runs : {previous or '-none-'}"
+    )
+    for stage, row in stages.iterrows():
+        throughput = (
+            f", {row['features_per_s']:.0f} features/s"
+            if row["features_out"]
+            else f", {row['pixels_per_s'] / 1e6:.1f} Mpx/s" if row["pixels"] else ""
+        )
+        comparison = (
+            f" vs median {row['baseline_s']:.2f}s (x{row['ratio']:.2f})"
+            if pd.notna(row["ratio"])
+            else " (no history)"
+        )
+        logger.info(
+            f"   {'⚠️  SLOWER' if row['slower'] else '✅'}  {stage} : {row['wall_s']:.2f}s "
+            f"on {row['items']} items{comparison}{throughput}, peak {row['peak_rss_mb']:.0f} MB"
+        )
+    if stages["slower"].any():
+        logger.info(
+            f"   ⚠️  {int(stages['slower'].sum())} stage(s) slower than {threshold}x the median"
+        )
+    return stages
+
+
+def run_queue_status(queue_name: str, reset_failed: bool = False):
+    """
+    Progress of a work queue of the distributed mode (vectorize --queue) : items by state, claims by worker
+    (expired leases of crashed workers), median time of the done items and estimated time remaining.
+
+        Parameters:
+            queue_name (string) : Name (or path) of the work queue
+            reset_failed (bool) : Put the failed items back to pending first
+
+        Returns:
+            DataFrame of the items (see WorkQueue.status)
+    """
+    queue = WorkQueue(os.path.join(WORK_QUEUE_DIR, queue_name))
+    if reset_failed:
+        logger.info(f"   ♻️  {queue.reset((FAILED,))} failed items put back to pending")
+    items = queue.status()
+    if items.empty:
+        logger.info(f"   ❌  Empty work queue : {queue.path}")
+        return items
+
+    counts = items["status"].value_counts()
+    logger.info(
+        f"🗂️  Work queue {queue.queue_dir} : {counts.get(DONE, 0)}/{len(items)} done, "
+        f"{counts.get(CLAIMED, 0)} claimed, {counts.get(PENDING, 0)} pending, {counts.get(FAILED, 0)} failed"
+    )
+    claimed = items[items["status"] == CLAIMED]
+    for worker, worker_items in claimed.groupby("worker"):
+        for item, row in worker_items.iterrows():
+            logger.info(
+                f"   {'⚠️  EXPIRED' if row['expired'] else '⚙️ '}  {worker} : {item} since {row['started_at']:%H:%M:%S}"
+            )
+    for item, row in items[items["status"] == FAILED].iterrows():
+        logger.info(f"   ❌  {item} ({row['attempts']} attempts) : {row['error']}")
+
+    done = items[items["status"] == DONE]
+    if not done.empty:
+        median_s = (done["ended_at"] - done["started_at"]).dt.total_seconds().median()
+        left = len(items) - len(done) - counts.get(FAILED, 0)
+        workers = max(1, claimed.loc[~claimed["expired"], "worker"].nunique())
+        logger.info(
+            f"   ⏳  Median {median_s:.0f}s by item, ~{left * median_s / workers:.0f}s left with {workers} active worker(s)"
+        )
+    return items
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="🧩  Script pipeline - Vectorisation / Clip / KPIs Végé -"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    # vectorize
+    parser_vectorize = subparsers.add_parser(
+        "vectorize", help="Vectorize the raster commune by commune"
+    )
+    add_vectorize_arguments(parser_vectorize)
+
+    # prepare-raster
+    parser_prepare = subparsers.add_parser(
+        "prepare-raster",
+        help="Rewrite the raster as a tiled Cloud-Optimized GeoTIFF (used by the next runs)",
+    )
+    parser_prepare.add_argument(
+        "--raster",
+        default="vegetation_stratifiee_2018_2154.tiff",
+        help="Name of the raster file (on the INPUT directory)",
+    )
+    parser_prepare.add_argument(
+        "--block-size",
+        type=int,
+        default=COG_OPTIONS["BLOCKSIZE"],
+        help="Side of the tiles in pixels",
+    )
+    parser_prepare.add_argument(
+        "--compress",
+        default=COG_OPTIONS["COMPRESS"],
+        help="Lossless compression (DEFLATE, ZSTD, LZW...)",
+    )
+    parser_prepare.add_argument(
+        "--force", action="store_true", help="Rewrite the prepared raster"
+    )
+
+    # clip
+    parser_clip = subparsers.add_parser(
+        "clip", help="Clip data files with a mask (see generate_1_shp_comunes_vege.py)"
+    )
+    parser_clip.add_argument(
+        "--dir", required=True, help="Directory to select data files to clip"
+    )
+    parser_clip.add_argument(
+        "--origin",
+        default="INPUT",
+        help="Parent folder of directory select (INPUT or OUTPUT)",
+    )
+    parser_clip.add_argument(
+        "--mask", required=True, help="Path of the mask to apply the clip"
+    )
+    parser_clip.add_argument(
+        "--name", required=True, help="Name of the final file generated (*.gpkg, *.shp)"
+    )
+    parser_clip.add_argument(
+        "--extension",
+        default="*.shp",
+        help="Pattern of extensions data files selected (*.shp)",
+    )
+    parser_clip.add_argument(
+        "--precision",
+        type=float,
+        help="Precision grid applied at ingest in meters (ex: 0.01 = 1 cm)",
+    )
+    parser_clip.add_argument(
+        "--catalog",
+        action="store_true",
+        help="Use the catalog of the data files (skip files out of the mask, reuse clipped parts of unchanged files)",
+    )
+    parser_clip.add_argument(
+        "--tiled-mask",
+        action="store_true",
+        help="Clip with the mask dissolved once and split in prepared tiles (persisted by CRS)",
+    )
+
+    # kpi
+    parser_kpi = subparsers.add_parser(
+        "kpi", help="Generate KPIs by cities (see generate_2_shp_kpi_vege.py)"
+    )
+    parser_kpi.add_argument("--file", help="Path of the input file (.gpkg, .shp)")
+    parser_kpi.add_argument(
+        "--origin",
+        default="INPUT",
+        help="Parent folder of directory select (INPUT or OUTPUT)",
+    )
+    parser_kpi.add_argument("--name", required=True, help="name of the final Shapefile")
+    parser_kpi.add_argument(
+        "--out-of-core",
+        action="store_true",
+        help="Read the input file by spatial partitions (bounded memory)",
+    )
+    parser_kpi.add_argument(
+        "--partition-size",
+        type=float,
+        default=2000.0,
+        help="Side of a partition in meters (out-of-core mode)",
+    )
+    parser_kpi.add_argument(
+        "--partition-order",
+        choices=("grid", "hilbert"),
+        default="hilbert",
+        help="Order of the partitions (out-of-core mode)",
+    )
+    parser_kpi.add_argument(
+        "--raster",
+        help="Classified raster : KPIs from the pixels (zonal histogram) instead of --file",
+    )
+    parser_kpi.add_argument(
+        "--mask",
+        help="Mask (ex: roads, on the INPUT directory) applied to the pixels (raster mode)",
+    )
+    parser_kpi.add_argument(
+        "--zones",
+        nargs="+",
+        help="Zoning files (on the INPUT directory) from the finest to the coarsest : KPIs by zone instead of by city",
+    )
+    parser_kpi.add_argument(
+        "--grid",
+        type=float,
+        help="Side of the cells in meters : KPIs on a regular grid instead of by city",
+    )
+    parser_kpi.add_argument(
+        "--mask-index",
+        action="store_true",
+        help="Load the windows / pixel masks of the cities from the persistent index (raster mode)",
+    )
+    parser_kpi.add_argument(
+        "--eta",
+        action="store_true",
+        help="Log the estimated time remaining after each city (costs from the run history)",
+    )
+    parser_kpi.add_argument(
+        "--landscape",
+        action="store_true",
+        help="Add the landscape KPIs by strate (patches, patch areas, largest patch share, edge density, canopy fragmentation)",
+    )
+
+    # tiles
+    parser_tiles = subparsers.add_parser(
+        "tiles", help="Build the vector tiles (MBTiles) of the vegetation and KPIs"
+    )
+    parser_tiles.add_argument(
+        "--vege",
+        default="vegetation_stratifiee_2018_2154_*.shp",
+        help="Pattern of the vegetation files on the OUTPUT directory (.shp, .gpkg)",
+    )
+    parser_tiles.add_argument(
+        "--kpi", help="Name of the KPIs file on the OUTPUT directory"
+    )
+    parser_tiles.add_argument(
+        "--name", required=True, help="Name of the MBTiles file generated"
+    )
+    parser_tiles.add_argument(
+        "--min-zoom", type=int, default=10, help="First zoom level"
+    )
+    parser_tiles.add_argument(
+        "--max-zoom", type=int, default=16, help="Last zoom level"
+    )
+    parser_tiles.add_argument(
+        "--workers", type=int, default=1, help="Number of processes"
+    )
+
+    # report
+    parser_report = subparsers.add_parser(
+        "report",
+        help="Compare a run with the median of the previous runs (run history)",
+    )
+    parser_report.add_argument(
+        "--run", type=int, help="Id of the run (default : the last finished run)"
+    )
+    parser_report.add_argument(
+        "--window",
+        type=int,
+        default=10,
+        help="Number of previous runs of the same command used for the median",
+    )
+    parser_report.add_argument(
+        "--threshold",
+        type=float,
+        default=1.25,
+        help="Ratio to the median above which a stage is flagged as slower",
+    )
+    parser_report.add_argument(
+        "--list", type=int, default=0, help="List the N last runs of the history"
+    )
+
+    # queue
+    parser_queue = subparsers.add_parser(
+        "queue",
+        help="Progress of a work queue of the distributed mode (vectorize --queue)",
+    )
+    parser_queue.add_argument(
+        "--queue", required=True, help="Name (or path) of the work queue"
+    )
+    parser_queue.add_argument(
+        "--reset-failed",
+        action="store_true",
+        help="Put the failed items back to pending",
+    )
+
+    # run-all
+    parser_all = subparsers.add_parser(
+        "run-all", help="Chain vectorize -> clip -> KPIs in memory"
+    )
+    add_vectorize_arguments(parser_all)
+    parser_all.add_argument(
+        "--mask", required=True, help="Path of the mask to apply the clip"
+    )
+    parser_all.add_argument(
+        "--name", required=True, help="name of the final KPIs Shapefile"
+    )
+    parser_all.add_argument(
+        "--tiled-mask",
+        action="store_true",
+        help="Clip with the mask dissolved once and split in prepared tiles (persisted by CRS)",
+    )
+    parser_all.add_argument(
+        "--checkpoint",
+        nargs="*",
+        choices=CHECKPOINT_STAGES,
+        default=[],
+        help="Intermediate stages to save on the OUTPUT directory",
+    )
+
+    args = parser.parse_args()
+    if args.command == "kpi" and not args.file and not args.raster:
+        parser.error("kpi : --file or --raster is required")
+    if args.command == "run-all" and args.queue:
+        parser.error("run-all : --queue is only available with vectorize")
+    origin = getattr(args, "origin", "INPUT")
+    if origin not in ("INPUT", "OUTPUT"):
+        origin = "INPUT"
+
+    # Each run (except report and dry runs) is recorded in the run history (RUN_HISTORY_DB)
+    with (
+        nullcontext()
+        if args.command in ("report", "queue") or getattr(args, "estimate", False)
+        else record_run(args.command, vars(args))
+    ):
+        if args.command == "report":
+            run_report(args.run, args.window, args.threshold, args.list)
+        elif args.command == "queue":
+            run_queue_status(args.queue, args.reset_failed)
+        elif args.command in ("vectorize", "run-all") and args.estimate:
+            run_estimate(args.raster, args.insee, args.plan_workers)
+        elif args.command == "vectorize":
+            run_vectorize(args.raster, vege_options=vectorize_options(args))
+        elif args.command == "prepare-raster":
+            run_prepare_raster(args.raster, args.block_size, args.compress, args.force)
+        elif args.command == "clip":
+            batch_clip_concat(
+                input_dir=args.dir,
+                origin_input_dir=origin,
+                clip_file=args.mask,
+                output_name=args.name,
+                pattern=args.extension,
+                recursive=False,
+                add_source_col=False,
+                use_pyogrio=True,
+                precision_grid=args.precision,
+                use_catalog=args.catalog,
+                use_tiled_mask=args.tiled_mask,
+            )
+        elif args.command == "kpi" and args.grid:
+            batch_generate_grid_kpis(
+                args.file,
+                origin,
+                args.name,
+                cell_size=args.grid,
+                partition_size=args.partition_size,
+                raster_file=args.raster,
+                mask_file=args.mask,
+            )
+        elif args.command == "kpi" and args.zones:
+            batch_generate_zone_kpis(
+                args.file,
+                origin,
+                args.zones,
+                args.name,
+                out_of_core=args.out_of_core,
+                partition_size=args.partition_size,
+                partition_order=args.partition_order,
+                raster_file=args.raster,
+                mask_file=args.mask,
+            )
+        elif args.command == "kpi":
+            batch_generate_kpis(
+                args.file,
+                origin,
+                args.name,
+                out_of_core=args.out_of_core,
+                partition_size=args.partition_size,
+                partition_order=args.partition_order,
+                raster_file=args.raster,
+                mask_file=args.mask,
+                use_mask_index=args.mask_index,
+                show_eta=args.eta,
+                landscape_metrics=args.landscape,
+            )
+        elif args.command == "tiles":
+            run_tiles(
+                args.vege,
+                args.kpi,
+                args.name,
+                min_zoom=args.min_zoom,
+                max_zoom=args.max_zoom,
+                workers=args.workers,
+            )
+        elif args.command == "run-all":
+            run_all(
+                args.raster,
+                args.mask,
+                args.name,
+                args.checkpoint,
+                vege_options=vectorize_options(args),
+                clip_options={
+                    "precision_grid": args.precision,
+                    "use_tiled_mask": args.tiled_mask,
+                },
+            )
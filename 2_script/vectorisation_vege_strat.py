@@ -1,5 +1,7 @@
 import sys
 import os
+import re
+import argparse
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
@@ -12,40 +14,81 @@ import rasterio
 
 from utils.functions import *
 from utils.vectorisation_vege_process import *
+from utils.raster_prepare import resolve_raster
+from utils.run_history import record_run
 
-### Démarrage du script global
-print("ℹ️  Début du script")
-globaltimer = startTimerLog("global")
+# Usage :
+# python ./2_script/vectorisation_vege_strat.py
+# python ./2_script/vectorisation_vege_strat.py --raster vegetation_stratifiee_2018_2154.tiff vegetation_stratifiee_2023_2154.tiff --insee 69072
+# python ./2_script/vectorisation_vege_strat.py --raster 2018=vege_2018.tiff 2023=vege_2023.tiff
+parser = argparse.ArgumentParser(description="Vectorisation du raster de végétation stratifiée (un ou plusieurs millésimes)")
+parser.add_argument(
+    "--raster",
+    nargs="+",
+    default=["vegetation_stratifiee_2018_2154.tiff"],
+    help="Raster(s) du répertoire INPUT, un par millésime (ANNEE=fichier, ou année lue dans le nom du fichier)")
+parser.add_argument(
+    "--insee",
+    nargs="+",
+    default=None,
+    help="Codes INSEE des communes à traiter (toutes par défaut)")
+args = parser.parse_args()
 
-### Etape1 : Import du tiff pour traiter les données
-print("ℹ️  Début Etape 1 : Import du tiff pour traiter les données")
-etape1timer = startTimerLog("etape1")
+# Millésime de chaque raster
+rasters_paths = {}
+for raster_arg in args.raster:
+    millesime, _, raster_name = raster_arg.rpartition("=")
+    if not millesime:
+        annee = re.search(r"(?<!\d)(?:19|20)\d{2}(?!\d)", raster_name)
+        if annee is None:
+            parser.error("Millésime introuvable dans " + raster_name + " (utiliser ANNEE=fichier)")
+        millesime = annee.group(0)
+    if millesime in rasters_paths:
+        parser.error("Millésime " + millesime + " en double")
+    # Version préparée du raster (prepare-raster) si elle existe
+    rasters_paths[millesime] = resolve_raster(os.path.join(INPUT_DATA_DIR, raster_name))
 
-raster_path = os.path.join(INPUT_DATA_DIR, "vegetation_stratifiee_2018_2154.tiff")
-raster = rasterio.open(raster_path)
+# Run enregistré dans l'historique (logs/run_history.sqlite, cf. utils/run_history.py)
+with record_run("vectorize", vars(args)):
+    ### Démarrage du script global
+    print("ℹ️  Début du script")
+    globaltimer = startTimerLog("global")
 
-endTimerLog(etape1timer)
-print("✅ Etape 1 terminée")
+    ### Etape1 : Import du tiff pour traiter les données
+    print("ℹ️  Début Etape 1 : Import du tiff pour traiter les données")
+    etape1timer = startTimerLog("etape1")
 
-### Etape 1.1 skipped
+    rasters = {millesime: rasterio.open(raster_path) for millesime, raster_path in rasters_paths.items()}
 
-### Etape 2 on découpe au territoire
-etape2timer = startTimerLog("etape2")
+    endTimerLog(etape1timer)
+    print("✅ Etape 1 terminée")
 
-# ================================================
-# Specify here the insee code to take if you need
-# ================================================
-# TODO: Récup le raster et l'array depuis les params de lancement du script
-# speArrayWrong = ['51561651'] (for example)
-# speArraySATC = ['69292']
+    ### Etape 1.1 skipped
 
-# Call big process function
-vegeBigProcess(raster)
+    ### Etape 2 on découpe au territoire
+    etape2timer = startTimerLog("etape2")
 
-# End Etape 2
-endTimerLog(etape2timer)
-print("✅ Etape 2 terminée")
+    # ================================================
+    # Specify here the insee code to take if you need
+    # ================================================
+    # speArrayWrong = ['51561651'] (for example)
+    # speArraySATC = ['69292']
 
-# End timer
-endTimerLog(globaltimer)
-print("✅ Script galobal terminé")
+    # Call big process function
+    if len(rasters) == 1:
+        millesime, raster = next(iter(rasters.items()))
+        vegeBigProcess(raster, specificComList=args.insee, millesime=millesime)
+    else:
+        # Plusieurs millésimes : fenêtres et masques des communes partagés, KPIs d'évolution
+        vegeMultiMillesimes(rasters, specificComList=args.insee)
+
+    for raster in rasters.values():
+        raster.close()
+
+    # End Etape 2
+    endTimerLog(etape2timer)
+    print("✅ Etape 2 terminée")
+
+    # End timer
+    endTimerLog(globaltimer)
+    print("✅ Script galobal terminé")
@@ -0,0 +1,160 @@
+import logging
+
+import numpy as np
+import geopandas as gpd
+import shapely
+
+from utils.functions import debugLog, style
+from utils.stage_cache import StageCache
+
+
+class TiledMask:
+    """
+    Clip mask prepared once for all the data files of batch_clip_concat.
+
+    - The mask is dissolved once (union of all its features)
+    - The union is split on a grid of `tile_size` meters (quadtree : each level cuts its parts in 4,
+      until the side of the cells reaches the tile size), the tiles are prepared and indexed in an STRtree
+    - A clip only touches the tiles of each feature : a feature inside one tile is kept as is,
+      otherwise it is intersected with its tiles only (instead of the whole union)
+    - The tiles are persisted by mask, options and CRS in `<cache_dir>` (StageCache, LRU capped by `max_size`) :
+      a data file in another CRS is clipped with the tiles reprojected to its CRS (once), not reprojected itself
+    """
+
+    def __init__(self, tiles: gpd.GeoSeries) -> None:
+        self.tiles = tiles
+        self.crs = tiles.crs
+        self.geoms = tiles.to_numpy()
+        shapely.prepare(self.geoms)
+        self.tree = shapely.STRtree(self.geoms)
+
+    @staticmethod
+    def split(geom, tile_size: float):
+        """Tiles of a geometry on a grid of `tile_size` (aligned on the multiples of `tile_size`)."""
+        if geom.is_empty:
+            return []
+        xmin, ymin, xmax, ymax = geom.bounds
+        xmin = np.floor(xmin / tile_size) * tile_size
+        ymin = np.floor(ymin / tile_size) * tile_size
+        cells = max(1, int(np.ceil(max(xmax - xmin, ymax - ymin) / tile_size)))
+        side = tile_size * 2 ** int(np.ceil(np.log2(cells)))
+
+        tiles = []
+        todo = [(geom, xmin, ymin, side)]
+        while todo:
+            part, x, y, side = todo.pop()
+            if side <= tile_size:
+                tiles.append(part)
+                continue
+            half = side / 2
+            for dx in (0, half):
+                for dy in (0, half):
+                    quadrant = shapely.clip_by_rect(
+                        part, x + dx, y + dy, x + dx + half, y + dy + half
+                    )
+                    if quadrant.is_empty:
+                        continue
+                    # clip_by_rect is fast but may return invalid geometries
+                    if not quadrant.is_valid:
+                        quadrant = shapely.make_valid(quadrant)
+                    quadrant = shapely.union_all(
+                        [
+                            g
+                            for g in shapely.get_parts(quadrant)
+                            if g.geom_type in ("Polygon", "MultiPolygon")
+                        ]
+                    )
+                    if not quadrant.is_empty:
+                        todo.append((quadrant, x + dx, y + dy, half))
+        return tiles
+
+    @classmethod
+    def build(cls, mask: gpd.GeoDataFrame, tile_size: float) -> "TiledMask":
+        union = mask.geometry.union_all()
+        return cls(gpd.GeoSeries(cls.split(union, tile_size), crs=mask.crs))
+
+    @classmethod
+    def load(
+        cls,
+        cache: StageCache,
+        mask_key: str,
+        mask: gpd.GeoDataFrame,
+        crs=None,
+        tile_size: float = 500,
+    ) -> "TiledMask":
+        """
+        Tiled mask in the CRS `crs` : read from the cache, else built and stored. The tiles are cut in the CRS
+        of the mask (grid in its units) and reprojected for another CRS.
+
+            Parameters:
+                cache (StageCache) : Store of the tiled masks
+                mask_key (string) : Key of the mask file and of its options (ex: precision grid)
+                mask (GeoDataFrame) : Mask (already snapped on the precision grid if any)
+                crs : CRS of the data to clip (default : CRS of the mask)
+                tile_size (float) : Side of the tiles (units of the CRS of the mask)
+        """
+        crs = mask.crs if crs is None else crs
+        key = StageCache.key(
+            mask_key, tile_size, crs.to_wkt() if crs is not None else None
+        )
+        tiles = cache.get(key)
+        if tiles is not None:
+            return cls(tiles)
+
+        if crs is not None and mask.crs is not None and crs != mask.crs:
+            tiles = cls.load(cache, mask_key, mask, mask.crs, tile_size).tiles
+            tiled = cls(tiles.to_crs(crs))
+        else:
+            tiled = cls.build(mask, tile_size)
+        cache.put(key, tiled.tiles)
+        debugLog(
+            style.GREEN,
+            "Tiled mask built : {} tiles of {} ({})".format(
+                len(tiled.geoms), tile_size, crs.to_string() if crs else "-no crs-"
+            ),
+            logging.INFO,
+        )
+        return tiled
+
+    def clip(self, gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
+        """
+        Same result as gpd.clip(gdf, mask) (features intersecting the mask, non-point geometries intersected),
+        in the order of `gdf`.
+        """
+        geoms = gdf.geometry.to_numpy()
+        features, tiles = self.tree.query(geoms)
+        hits = shapely.intersects(self.geoms[tiles], geoms[features])
+        features, tiles = features[hits], tiles[hits]
+        if len(features) == 0:
+            return gdf.iloc[:0]
+
+        # Features inside one tile : kept as is
+        order = np.argsort(features, kind="stable")
+        features, tiles = features[order], tiles[order]
+        kept, first, counts = np.unique(features, return_index=True, return_counts=True)
+        result = geoms[kept].copy()
+        single = counts == 1
+        inside = np.zeros(len(kept), dtype=bool)
+        inside[single] = shapely.contains_properly(
+            self.geoms[tiles[first[single]]], geoms[kept[single]]
+        )
+        points = shapely.get_type_id(geoms[kept]) == 0
+        to_cut = ~inside & ~points
+
+        # Features on the edge of the mask or across several tiles : intersected with their tiles only
+        cut_single = to_cut & single
+        result[cut_single] = shapely.intersection(
+            geoms[kept[cut_single]], self.geoms[tiles[first[cut_single]]]
+        )
+        for position in np.flatnonzero(to_cut & ~single):
+            pieces = shapely.intersection(
+                geoms[kept[position]],
+                self.geoms[tiles[first[position] : first[position] + counts[position]]],
+            )
+            result[position] = shapely.union_all(pieces)
+
+        clipped = gdf.iloc[kept].copy()
+        clipped[clipped.geometry.name] = gpd.GeoSeries(
+            result, index=clipped.index, crs=gdf.crs
+        )
+        return clipped[~clipped.geometry.is_empty]
@@ -8,3 +8,36 @@ OUTPUT_DATA_DIR = os.path.join(BASE_DIR, "0_geodatas", "output")
 RATE_M2_TO_KM2 = 1000000
 RATE_MK2_TO_HA = 100
 ROUND_KM2 = 3
+
+# INFO: communes of Métropole de Lyon (open-data WFS)
+WFS_COMMUNES_LAYER = "metropole-de-lyon:adr_voie_lieu.adrcommunes_2024"
+WFS_COMMUNES_URL = (
+    "https://data.grandlyon.com/geoserver/metropole-de-lyon/ows?SERVICE=WFS"
+)
+
+# INFO: cache of the intermediate stages of vegeBigProcess (LRU, size in bytes)
+STAGE_CACHE_DIR = os.path.join(BASE_DIR, "0_geodatas", "cache", "stages")
+STAGE_CACHE_MAX_SIZE = 20 * 1024**3
+
+# INFO: index of the raster windows / pixel masks of the communes (by raster grid and geometry)
+MASK_INDEX_DIR = os.path.join(BASE_DIR, "0_geodatas", "cache", "masks")
+
+# INFO: rasters prepared as tiled Cloud-Optimized GeoTIFF (prepare-raster) and registry of the prepared files
+PREPARED_RASTER_DIR = os.path.join(BASE_DIR, "0_geodatas", "cache", "rasters")
+PREPARED_RASTER_REGISTRY = os.path.join(PREPARED_RASTER_DIR, "prepared_rasters.json")
+
+# INFO: catalog of the input data files of the clip (metadata and clipped parts of the last run, LRU, size in bytes)
+DATASET_CATALOG_DIR = os.path.join(BASE_DIR, "0_geodatas", "cache", "catalog")
+DATASET_CATALOG_MAX_SIZE = 10 * 1024**3
+
+# INFO: history of the runs of the entry points (SQLite : wall time, features, pixels, memory by stage)
+RUN_HISTORY_DB = os.path.join(BASE_DIR, "logs", "run_history.sqlite")
+
+# INFO: clip mask dissolved once and split in prepared tiles, by mask file, options and CRS (LRU, size in bytes)
+CLIP_MASK_DIR = os.path.join(BASE_DIR, "0_geodatas", "cache", "clip_masks")
+CLIP_MASK_MAX_SIZE = 2 * 1024**3
+CLIP_MASK_TILE_SIZE = 500
+
+# INFO: work queues of the distributed vectorization (one directory by queue, on a filesystem shared by the workers)
+WORK_QUEUE_DIR = os.path.join(BASE_DIR, "0_geodatas", "cache", "queues")
+WORK_QUEUE_LEASE_S = 600
@@ -0,0 +1,234 @@
+import os
+import heapq
+import math
+import time
+
+import numpy as np
+import pandas as pd
+from rasterio.enums import Resampling
+from rasterio.features import geometry_mask, geometry_window
+from rasterio.transform import Affine
+from scipy.optimize import nnls
+
+from utils.constants import RUN_HISTORY_DB
+from utils.run_history import RunHistory
+
+# Seconds by pixel used until the history holds runs to calibrate on (order of magnitude of the
+# steps 3 to 7 on a vegetated pixel, the pixels without vegetation are almost free)
+DEFAULT_COEFFICIENTS = {"pixels": 0.0, "vege_pixels": 3.5e-5}
+COST_FEATURES = tuple(DEFAULT_COEFFICIENTS)
+
+
+def commune_item(row) -> str:
+    """Item of a commune in the run history (suffix of the tasks of vegeBigProcess)."""
+    return row["insee"] + "_" + row["trigramme"] + "_" + row["nom"]
+
+
+def commune_pixel_stats(
+    raster, communes: pd.DataFrame, decimation: int = 8
+) -> pd.DataFrame:
+    """
+    Quick histogram of the communes on the raster : pixels inside the commune and vegetation pixels
+    (not nodata, not 0), counted on a window decimated by `decimation` (overviews of the raster if any)
+    and scaled back to the full resolution.
+
+        Parameters:
+            raster : Raster opened with rasterio
+            communes (GeoDataFrame) : Communes (insee, trigramme, nom, geometry)
+            decimation (int) : Reading factor (1 : full resolution)
+
+        Returns:
+            DataFrame indexed like communes (item, pixels, vege_pixels)
+    """
+    nodata = raster.nodata
+    rows = []
+    for index, row in communes.iterrows():
+        geom = row["geometry"]
+        try:
+            window = geometry_window(raster, [geom])
+        except ValueError:
+            # Commune out of the raster
+            rows.append((index, commune_item(row), 0.0, 0.0))
+            continue
+        height = max(1, math.ceil(window.height / decimation))
+        width = max(1, math.ceil(window.width / decimation))
+        data = raster.read(
+            1, window=window, out_shape=(height, width), resampling=Resampling.nearest
+        )
+        transform = raster.window_transform(window) * Affine.scale(
+            window.width / width, window.height / height
+        )
+        inside = geometry_mask([geom], (height, width), transform, invert=True)
+        vege = inside & (data != 0)
+        if nodata is not None:
+            vege &= data != nodata
+        scale = window.width * window.height / (width * height)
+        rows.append(
+            (index, commune_item(row), inside.sum() * scale, vege.sum() * scale)
+        )
+    return pd.DataFrame(
+        rows, columns=["index", "item", "pixels", "vege_pixels"]
+    ).set_index("index")
+
+
+class CostModel:
+    """
+    Cost of the communes in seconds : linear model of the pixels and vegetation pixels of the commune,
+    calibrated on the run history (median time of each commune over the last runs, non-negative least squares).
+
+    Without history (or less than 2 known communes), DEFAULT_COEFFICIENTS are used : the order of the
+    communes is still right, the times are an order of magnitude.
+    """
+
+    def __init__(
+        self,
+        history_db: str = RUN_HISTORY_DB,
+        stage: str = "loopTimer",
+        entry_points: tuple = ("vectorize", "run-all"),
+        window: int = 10,
+        decimation: int = 8,
+    ) -> None:
+        self.history_db = history_db
+        self.stage = stage
+        self.entry_points = entry_points
+        self.window = window
+        self.decimation = decimation
+        self.coefficients = dict(DEFAULT_COEFFICIENTS)
+        self.intercept = 0.0
+        self.calibrated_on = 0
+
+    def calibrate(self, stats: pd.DataFrame) -> None:
+        """Fit the coefficients on the communes of `stats` present in the history."""
+        if not os.path.exists(self.history_db):
+            return
+        history = RunHistory(self.history_db)
+        try:
+            medians = history.item_medians(self.stage, self.entry_points, self.window)
+        finally:
+            history.close()
+        known = stats.join(medians.rename("wall_s"), on="item", how="inner")
+        if len(known) < 2:
+            return
+        features = known[list(COST_FEATURES)].to_numpy(dtype=float)
+        # Scaled columns (pixels ~1e6) for a well conditioned system
+        scales = features.max(axis=0)
+        scales[scales == 0] = 1.0
+        features = features / scales
+        # Fixed cost by commune only with enough communes (else it absorbs all the differences)
+        with_intercept = len(known) >= 3 * (len(COST_FEATURES) + 1)
+        if with_intercept:
+            features = np.column_stack([features, np.ones(len(known))])
+        solution, _ = nnls(features, known["wall_s"].to_numpy(dtype=float))
+        if with_intercept:
+            self.intercept = float(solution[-1])
+            solution = solution[:-1]
+        self.coefficients = dict(zip(COST_FEATURES, solution / scales))
+        self.calibrated_on = len(known)
+
+    def predict(self, stats: pd.DataFrame) -> pd.Series:
+        cost = pd.Series(self.intercept, index=stats.index, dtype=float)
+        for feature, coefficient in self.coefficients.items():
+            cost += stats[feature] * coefficient
+        return cost.rename("cost_s")
+
+    def estimate(self, raster, communes: pd.DataFrame) -> pd.DataFrame:
+        """
+        Pixel histogram, calibration on the history and estimated cost of each commune.
+
+            Returns:
+                DataFrame indexed like communes (item, pixels, vege_pixels, cost_s), sorted by decreasing cost
+        """
+        stats = commune_pixel_stats(raster, communes, self.decimation)
+        self.calibrate(stats)
+        stats["cost_s"] = self.predict(stats)
+        return stats.sort_values("cost_s", ascending=False, kind="stable")
+
+
+def history_item_costs(
+    items: pd.Series,
+    weights: pd.Series,
+    stage: str,
+    entry_points: tuple | None = None,
+    history_db: str = RUN_HISTORY_DB,
+) -> pd.Series:
+    """
+    Cost of items (cities, files...) from the run history : median time of the item over the last runs,
+    items never recorded are estimated from their weight (ex: area) with the median time by unit of weight
+    of the known items (the weight itself, relative costs only, if none is known).
+
+        Parameters:
+            items (Series) : Item of each element in the history (ex: '69266_VIL_Villeurbanne')
+            weights (Series) : Weight of each element (same index)
+
+        Returns:
+            Series of the estimated seconds (same index)
+    """
+    medians = pd.Series(dtype=float)
+    if os.path.exists(history_db):
+        history = RunHistory(history_db)
+        try:
+            medians = history.item_medians(stage, entry_points)
+        finally:
+            history.close()
+    costs = items.map(medians).astype(float)
+    known = costs.notna() & (weights > 0)
+    rate = (costs[known] / weights[known]).median() if known.any() else 1.0
+    costs = costs.fillna(weights * rate).rename("cost_s")
+    # Without any known item the costs are only relative (the ETA is corrected after the first items)
+    costs.attrs["known"] = int(known.sum())
+    return costs
+
+
+def lpt_schedule(costs: pd.Series, workers: int) -> list[tuple[float, list]]:
+    """
+    Longest processing time first : the items are taken by decreasing cost and given to the least
+    loaded worker (makespan at most 4/3 of the optimum).
+
+        Returns:
+            List by worker of (estimated total, items)
+    """
+    loads = [(0.0, worker, []) for worker in range(max(1, workers))]
+    heapq.heapify(loads)
+    for item, cost in costs.sort_values(ascending=False, kind="stable").items():
+        load, worker, items = heapq.heappop(loads)
+        items.append(item)
+        heapq.heappush(loads, (load + cost, worker, items))
+    return [(load, items) for load, _, items in sorted(loads, key=lambda l: l[1])]
+
+
+class EtaTracker:
+    """
+    Estimated time remaining of a run : estimated cost of the items left, corrected by the ratio
+    time spent / estimated cost of the items already done.
+    """
+
+    def __init__(self, costs: pd.Series) -> None:
+        self.costs = costs
+        self.remaining = set(costs.index)
+        self.estimated_done = 0.0
+        self.spent = 0.0
+        self.start = time.perf_counter()
+
+    def done(self, item, elapsed: float | None = None) -> None:
+        if item not in self.remaining:
+            return
+        self.remaining.discard(item)
+        self.estimated_done += self.costs[item]
+        self.spent += elapsed if elapsed is not None else 0.0
+
+    @property
+    def correction(self) -> float:
+        return self.spent / self.estimated_done if self.estimated_done > 0 else 1.0
+
+    def eta(self) -> float:
+        return self.costs[list(self.remaining)].sum() * self.correction
+
+    def summary(self) -> str:
+        done = len(self.costs) - len(self.remaining)
+        return "{}/{} items, elapsed {:.0f} s, ETA {:.0f} s (x{:.2f} on the estimate)".format(
+            done,
+            len(self.costs),
+            time.perf_counter() - self.start,
+            self.eta(),
+            self.correction,
+        )
@@ -0,0 +1,112 @@
+import os
+import json
+import glob
+import logging
+
+import geopandas as gpd
+import pyogrio
+from shapely.geometry import box
+
+from utils.functions import debugLog, style
+from utils.stage_cache import StageCache
+
+
+class DatasetCatalog:
+    """
+    Persistent catalog of the input data files of batch_clip_concat.
+
+    - One entry by file in `<catalog_dir>/catalog.json` : signature (size and mtime of the file and its
+      sidecar files, ex: .dbf / .shx of a Shapefile), CRS, bbox, feature count, key of the last clipped result
+    - The metadata are read from the file header (pyogrio.read_info) only when the signature changed
+    - The clipped parts are stored in `<catalog_dir>/clips/` (StageCache, LRU capped by `max_size`),
+      keyed by the signature of the file, the signature of the mask and the clip options
+    """
+
+    def __init__(self, catalog_dir: str, max_size: int) -> None:
+        self.catalog_dir = catalog_dir
+        self.path = os.path.join(catalog_dir, "catalog.json")
+        os.makedirs(catalog_dir, exist_ok=True)
+        self.clips = StageCache(os.path.join(catalog_dir, "clips"), max_size)
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                self.entries = json.load(f)
+        except FileNotFoundError:
+            self.entries = {}
+        except ValueError as error:
+            debugLog(
+                style.YELLOW,
+                "Unreadable catalog, rebuilt : {} ({})".format(self.path, error),
+                logging.WARN,
+            )
+            self.entries = {}
+
+    @staticmethod
+    def signature(path: str) -> dict:
+        """Size and mtime of the file and of its sidecar files (same name, other extension)."""
+        stem = os.path.splitext(path)[0]
+        files = sorted(set(glob.glob(glob.escape(stem) + ".*")) | {path})
+        return {
+            os.path.basename(f): [os.path.getsize(f), os.path.getmtime(f)]
+            for f in files
+            if os.path.isfile(f)
+        }
+
+    def info(self, path: str) -> dict:
+        """
+        Catalog entry of a file (signature, crs, bbox, features), the header is read only if the file changed.
+        """
+        path = os.path.abspath(str(path))
+        signature = self.signature(path)
+        entry = self.entries.get(path)
+        if entry is not None and entry["signature"] == signature:
+            return entry
+
+        info = pyogrio.read_info(path, force_total_bounds=True)
+        bbox = info.get("total_bounds")
+        entry = {
+            "signature": signature,
+            "crs": info.get("crs"),
+            "bbox": [float(b) for b in bbox] if bbox is not None else None,
+            "features": int(info.get("features", -1)),
+            "clip_key": None,
+        }
+        self.entries[path] = entry
+        return entry
+
+    @staticmethod
+    def overlaps(entry: dict, mask: gpd.GeoDataFrame) -> bool:
+        """True if the bbox of the file touches the bbox of a feature of the mask (no file read)."""
+        if entry["bbox"] is None or entry["features"] == 0:
+            return entry["features"] != 0
+        extent = gpd.GeoSeries([box(*entry["bbox"])], crs=entry["crs"] or mask.crs)
+        if mask.crs is not None and extent.crs != mask.crs:
+            extent = extent.to_crs(mask.crs)
+        return len(mask.sindex.query(extent.iloc[0], predicate="intersects")) > 0
+
+    def clip_key(self, path: str, mask_key: str) -> str:
+        """Key of the clipped result of a file for a mask (see mask_key)."""
+        entry = self.info(path)
+        return StageCache.key(entry["signature"], mask_key)
+
+    def mask_key(self, mask_path: str, *options) -> str:
+        """Key of a mask file and of the clip options (ex: precision grid)."""
+        return StageCache.key(self.signature(os.path.abspath(mask_path)), *options)
+
+    def get_clip(self, path: str, mask_key: str):
+        """Clipped result of the last run for this file and mask (None if absent)."""
+        return self.clips.get(self.clip_key(path, mask_key))
+
+    def put_clip(self, path: str, mask_key: str, gdf) -> None:
+        key = self.clip_key(path, mask_key)
+        self.clips.put(key, gdf)
+        self.entries[os.path.abspath(str(path))]["clip_key"] = key
+
+    def save(self) -> None:
+        """Write the catalog (atomic), the entries of deleted files are dropped."""
+        self.entries = {
+            path: entry for path, entry in self.entries.items() if os.path.exists(path)
+        }
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.entries, f, indent=2)
+        os.replace(tmp_path, self.path)
@@ -1,19 +1,34 @@
 import logging, os
+import socket
+import uuid
 import psycopg2
 import csv
 from math import *
 from datetime import datetime
 from psycopg2.extras import RealDictCursor
+from psycopg2 import sql
+from psycopg2.pool import ThreadedConnectionPool
 import geopandas as gp
 from pyproj import Transformer
 import requests
 from fiona import BytesCollection
+import numpy as np
+import pandas as pd
+import pyogrio
+import shapely
+import queue
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 
 from shapely.geometry import (
     Polygon,
     MultiPolygon,
 )
 from utils.constants import *
+from utils.run_history import record_stage
 
 if os.getenv("BDD_DB_SYSTEM"):
     BDD_DB_SYSTEM = os.getenv("BDD_DB_SYSTEM").strip()
@@ -95,7 +110,12 @@ def startTimerLog(taskname):
     return timer
 
 
-def endTimerLog(timer):
+def endTimerLog(timer, historique=True, **mesures):
+    """
+    Log de fin de tâche, et enregistrement dans l'historique du run en cours (cf. utils/run_history.py) :
+    étape = début du nom de tâche (ex: 'etape5'), item = la suite (ex: '69266_VIL_Villeurbanne')
+    mesures : features_in, features_out, pixels
+    """
     # Log time end
     end_date = datetime.now()
     time_elapsed = datetime.now() - timer["start_date"]
@@ -122,17 +142,28 @@ def endTimerLog(timer):
         logging.INFO,
     )
 
+    if historique:
+        etape, _, item = timer["taskname"].partition("_")
+        record_stage(etape, item or None, time_elapsed.total_seconds(), **mesures)
+
+
+def parametresConnexionDB():
+    """
+    Paramètres de connexion PostgreSQL (variables d'environnement BDD_*)
+    """
+    return {
+        "dbname": BDD_CONFIG_DB,
+        "user": BDD_CONFIG_USER,
+        "password": BDD_CONFIG_PASSWD,
+        "host": BDD_CONFIG_HOST,
+        "port": BDD_CONFIG_PORT,
+        "options": f"-c search_path={BDD_CONFIG_SCHEMA}",
+    }
+
 
 def connectDB(jsonEnable=False, setSearchpath=True):
     try:
-        conn = psycopg2.connect(
-            dbname=BDD_CONFIG_DB,
-            user=BDD_CONFIG_USER,
-            password=BDD_CONFIG_PASSWD,
-            host=BDD_CONFIG_HOST,
-            port=BDD_CONFIG_PORT,
-            options=f"-c search_path={BDD_CONFIG_SCHEMA}",
-        )
+        conn = psycopg2.connect(**parametresConnexionDB())
         cur = None
         if jsonEnable:
             cur = conn.cursor(cursor_factory=RealDictCursor)
@@ -192,6 +223,189 @@ def getGDFfromDB(DB_params, sqlQuery, projection):
     return df
 
 
+def partitionsTableDB(conn, table, colonne_geom="geom", nb_partitions=8, mode="tuiles"):
+    """
+    Découpage d'une table spatiale en partitions disjointes (chaque ligne dans une seule partition)
+    - "tuiles" : grille sur l'emprise de la table, une ligne appartient à la tuile qui contient le coin
+      bas-gauche de sa bbox (filtre && sur l'index GiST + test sur le coin)
+    - "ctid" : plages de blocs de la table (parcours TID Range, PostgreSQL >= 14)
+    Retour : liste de (clause WHERE (sql.Composed), paramètres)
+    """
+    cur = conn.cursor()
+    geom = sql.Identifier(colonne_geom)
+    table_sql = sql.Identifier(*table.split("."))
+
+    if mode == "ctid":
+        cur.execute("SELECT relpages FROM pg_class WHERE oid = %s::regclass", (table,))
+        nb_blocs = max(cur.fetchone()[0], 1)
+        # Bornes en blocs, la dernière partition est ouverte (blocs ajoutés depuis le dernier ANALYZE)
+        bornes = np.unique(np.linspace(0, nb_blocs, nb_partitions + 1).astype(int))
+        partitions = []
+        for i, (debut, fin) in enumerate(zip(bornes[:-1], bornes[1:])):
+            if i == len(bornes) - 2:
+                clause = sql.SQL("ctid >= %s::tid")
+                params = (f"({debut},0)",)
+            else:
+                clause = sql.SQL("ctid >= %s::tid AND ctid < %s::tid")
+                params = (f"({debut},0)", f"({fin},0)")
+            partitions.append((clause, params))
+        cur.close()
+        return partitions
+
+    # SRID de la table pour l'enveloppe du filtre (&& refuse les géométries de SRID différents)
+    cur.execute(
+        sql.SQL(
+            "SELECT ST_XMin(e), ST_YMin(e), ST_XMax(e), ST_YMax(e), "
+            "(SELECT ST_SRID({geom}) FROM {table} WHERE {geom} IS NOT NULL LIMIT 1) "
+            "FROM (SELECT ST_Extent({geom}) AS e FROM {table}) t"
+        ).format(geom=geom, table=table_sql)
+    )
+    xmin, ymin, xmax, ymax, srid = cur.fetchone()
+    cur.close()
+    if xmin is None:
+        return []
+
+    # Grille de n x n tuiles, les bornes supérieures sont élargies pour inclure le bord de l'emprise
+    n = max(int(ceil(sqrt(nb_partitions))), 1)
+    xs = np.linspace(xmin, xmax, n + 1)
+    ys = np.linspace(ymin, ymax, n + 1)
+    xs[-1] = ys[-1] = np.inf
+    clause = sql.SQL(
+        "{geom} && ST_MakeEnvelope(%s, %s, %s, %s, %s) "
+        "AND ST_XMin({geom}) >= %s AND ST_XMin({geom}) < %s "
+        "AND ST_YMin({geom}) >= %s AND ST_YMin({geom}) < %s"
+    ).format(geom=geom)
+    partitions = []
+    for i in range(n):
+        for j in range(n):
+            x0, x1, y0, y1 = xs[i], xs[i + 1], ys[j], ys[j + 1]
+            partitions.append(
+                (
+                    clause,
+                    (
+                        float(x0),
+                        float(y0),
+                        float(min(x1, xmax)),
+                        float(min(y1, ymax)),
+                        srid,
+                        float(x0),
+                        float(x1),
+                        float(y0),
+                        float(y1),
+                    ),
+                )
+            )
+    return partitions
+
+
+def getGDFfromDBParallel(
+    table,
+    projection,
+    colonne_geom="geom",
+    colonnes=None,
+    nb_workers=4,
+    nb_partitions=None,
+    mode="tuiles",
+    stream=False,
+):
+    """
+    Lecture parallèle d'une table spatiale PostGIS : la table est découpée en partitions disjointes
+    (tuiles spatiales ou plages de ctid, cf. partitionsTableDB) lues en même temps par `nb_workers`
+    connexions d'un pool (un backend PostgreSQL par connexion)
+    table : nom de la table (schema.table ou table du search_path)
+    colonnes : colonnes lues (toutes par défaut, la géométrie est toujours lue)
+    nb_partitions : nombre de partitions (défaut : 4 x nb_workers, pour équilibrer la charge)
+    stream : si True, générateur des GeoDataFrames des partitions au fil de l'eau (mémoire bornée),
+             sinon un seul GeoDataFrame concaténé
+    """
+    nb_partitions = nb_partitions or 4 * nb_workers
+    pool = ThreadedConnectionPool(1, nb_workers, **parametresConnexionDB())
+
+    def fermerPool():
+        if not pool.closed:
+            pool.closeall()
+
+    try:
+        conn = pool.getconn()
+        try:
+            partitions = partitionsTableDB(
+                conn, table, colonne_geom, nb_partitions, mode=mode
+            )
+            if colonnes:
+                select = sql.SQL(", ").join(
+                    sql.Identifier(c)
+                    for c in dict.fromkeys(list(colonnes) + [colonne_geom])
+                )
+            else:
+                select = sql.SQL("*")
+            requetes = [
+                (
+                    sql.SQL("SELECT {} FROM {} WHERE {}")
+                    .format(select, sql.Identifier(*table.split(".")), clause)
+                    .as_string(conn),
+                    params,
+                )
+                for clause, params in partitions
+            ]
+        finally:
+            pool.putconn(conn)
+    except BaseException:
+        fermerPool()
+        raise
+
+    debugLog(
+        style.YELLOW,
+        "Lecture parallèle de {} : {} partitions ({}) sur {} connexions".format(
+            table, len(requetes), mode, nb_workers
+        ),
+        logging.INFO,
+    )
+
+    def lirePartition(requete):
+        conn = pool.getconn()
+        try:
+            return gp.read_postgis(
+                requete[0],
+                conn,
+                geom_col=colonne_geom,
+                crs=projection,
+                params=requete[1],
+            )
+        finally:
+            conn.rollback()
+            pool.putconn(conn)
+
+    def partitionsLues():
+        try:
+            with ThreadPoolExecutor(max_workers=nb_workers) as executor:
+                futures = [executor.submit(lirePartition, r) for r in requetes]
+                try:
+                    for future in as_completed(futures):
+                        yield future.result()
+                finally:
+                    for future in futures:
+                        future.cancel()
+        finally:
+            fermerPool()
+
+    if stream:
+        generateur = partitionsLues()
+        # Générateur jamais consommé (son finally ne s'exécute pas) : pool fermé à sa destruction
+        weakref.finalize(generateur, fermerPool)
+        return generateur
+
+    parts = [part for part in partitionsLues() if not part.empty]
+    if not parts:
+        return gp.GeoDataFrame(geometry=[], crs=projection)
+    df = pd.concat(parts, ignore_index=True)
+    debugLog(
+        style.GREEN,
+        "Datas was loaded successfully (with {} entites) \n".format(len(df)),
+        logging.INFO,
+    )
+    return df
+
+
 def insertGDFintoDB(
     DB_params, DB_schema, gdf, tablename, columnsListToDB, batch_size=10000
 ):
@@ -457,3 +671,346 @@ def simplifier_geom(geom, seuil=150, tol_base=0.4, tol_min=0.1, tol_max=1.0):
         pass
 
     return geom  # fallback
+
+
+def simplifier_couverture(
+    geoms, seuil=150, tol_base=0.4, tol_min=0.1, tol_max=1.0, tampon=0.0
+):
+    """
+    Simplification d'une couverture (polygones sans recouvrement, ex : strates fusionnées d'une commune)
+    avec shapely coverage_simplify : chaque arête commune est simplifiée une seule fois, les polygones
+    voisins gardent la même frontière (la simplification ne crée ni trou ni recouvrement).
+    - Tolérance : coverage_simplify n'accepte qu'une tolérance par couverture (une tolérance par polygone
+      casserait les arêtes communes). La tolérance de simplifier_geom est calculée pour chaque polygone
+      (tol_base * nb_sommets / seuil encadrée par tol_min et tol_max) et la couverture est simplifiée avec
+      leur moyenne pondérée par la surface : la tolérance moyenne reçue par un m² avec simplifier_geom
+      (le polygone qui a le plus de sommets atteint tol_max sur toute commune réelle, les nombreux petits
+      polygones restent à tol_min : ni le maximum ni la médiane ne sont représentatifs)
+    - tampon : buffer de l'étape 5 du mode par défaut, non appliqué (la sortie reste une couverture). Les
+      sommets sont comptés sur les polygones avec ce buffer, comme simplifier_geom les voit dans le mode
+      par défaut (les arcs du buffer multiplient le nombre de sommets des polygones en escalier du raster)
+    - coverage_simplify est un Visvalingam-Whyatt (tolérance ~ racine de l'aire des triangles retirés)
+    Si la simplification échoue (GEOS < 3.12, géométries invalides en sortie) : repli sur simplifier_geom
+    """
+    geoms = np.asarray(geoms, dtype=object)
+    if len(geoms) == 0:
+        return geoms
+
+    # Nombre de sommets de l'extérieur du plus grand polygone de chaque géométrie (cf. simplifier_geom)
+    comptees = shapely.buffer(geoms, tampon) if tampon > 0 else geoms
+    parties, positions = shapely.get_parts(comptees, return_index=True)
+    nb_pts = np.zeros(len(geoms), dtype=np.int64)
+    np.maximum.at(
+        nb_pts,
+        positions,
+        shapely.get_num_coordinates(shapely.get_exterior_ring(parties)),
+    )
+    tolerances = np.clip(tol_base * nb_pts / seuil, tol_min, tol_max)
+    surfaces = shapely.area(geoms)
+    tol = (
+        float(np.average(tolerances, weights=surfaces))
+        if surfaces.sum() > 0
+        else tol_min
+    )
+
+    try:
+        simple = shapely.coverage_simplify(geoms, tol)
+        if shapely.is_valid(simple).all() and not shapely.is_empty(simple).any():
+            return simple
+    except Exception:
+        pass
+
+    debugLog(
+        style.YELLOW,
+        "Simplification de couverture impossible : repli sur simplifier_geom",
+        logging.WARN,
+    )
+    return np.array(
+        [simplifier_geom(g, seuil, tol_base, tol_min, tol_max) for g in geoms],
+        dtype=object,
+    )
+
+
+def rss_processus():
+    """
+    Mémoire résidente (RSS) du processus en octets : psutil si installé, sinon /proc (Linux),
+    None si elle n'est pas disponible
+    """
+    try:
+        import psutil
+
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def chemin_temporaire(path):
+    """
+    Chemin temporaire d'écriture de `path` propre à l'écriture (hôte, pid, uuid) : plusieurs processus
+    (ou hôtes partageant le répertoire) qui écrivent le même fichier n'écrasent pas le fichier temporaire
+    des autres avant leur os.replace
+    """
+    return "{}.{}_{}_{}.tmp".format(
+        path, socket.gethostname(), os.getpid(), uuid.uuid4().hex
+    )
+
+
+def lectureAnticipee(iterable, profondeur=1):
+    """
+    Itère sur `iterable` depuis un thread de lecture qui garde jusqu'à `profondeur` éléments d'avance
+    (file bornée) : la lecture des éléments suivants recouvre le traitement de l'élément courant
+    Les exceptions levées par la lecture sont relancées côté consommateur, la lecture s'arrête
+    si la consommation est interrompue
+    """
+    file = queue.Queue(maxsize=max(profondeur, 1))
+    arret = threading.Event()
+    fin = object()
+
+    def deposer(element):
+        while not arret.is_set():
+            try:
+                file.put(element, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def lecteur():
+        try:
+            for element in iterable:
+                if not deposer((element, None)):
+                    return
+            deposer((fin, None))
+        except BaseException as erreur:
+            deposer((fin, erreur))
+
+    thread = threading.Thread(target=lecteur, name="lectureAnticipee", daemon=True)
+    thread.start()
+    try:
+        while True:
+            element, erreur = file.get()
+            if element is fin:
+                if erreur is not None:
+                    raise erreur
+                return
+            yield element
+    finally:
+        arret.set()
+
+
+def count_vertices(gdf):
+    """
+    Nombre total de sommets des géométries d'un GeoDataFrame (ou d'une GeoSeries)
+    """
+    return int(gdf.geometry.count_coordinates().sum())
+
+
+def snap_to_grid(gdf, grid_size=0.01):
+    """
+    Accroche les coordonnées sur une grille de précision `grid_size` (0.01 = 1 cm en EPSG:2154)
+    Supprime le bruit flottant et les sommets dupliqués, les géométries devenues vides sont retirées
+    """
+    if not grid_size:
+        return gdf
+
+    snapped = gdf.set_geometry(gdf.geometry.set_precision(grid_size))
+    return snapped[~snapped.geometry.is_empty & snapped.geometry.notna()]
+
+
+def dissolve_coverage(gdf, by, as_index=True, valider_couverture=True):
+    """
+    Dissolve avec l'union de couverture (shapely coverage_union), beaucoup plus rapide que l'union
+    générale quand les géométries forment une couverture (polygones sans recouvrement aux arêtes
+    communes identiques, ex : polygones issus de rasterio.features.shapes densifiés au pas du pixel)
+    - valider_couverture : validation complète en amont (shapely coverage_is_valid), coûteuse sur
+      de gros volumes, à désactiver seulement si la couverture est garantie par construction
+    - contrôle du résultat dans tous les cas (surface conservée par groupe, géométries valides)
+    Si la couverture n'est pas valide : repli sur l'union générale (unary_union)
+    """
+    couverture_valide = True
+    if valider_couverture:
+        try:
+            couverture_valide = bool(shapely.coverage_is_valid(gdf.geometry.to_numpy()))
+        except Exception:
+            # GEOS < 3.12 : pas de validation possible
+            couverture_valide = False
+
+    if couverture_valide:
+        try:
+            dissous = gdf.dissolve(by=by, method="coverage", observed=True)
+            aires_attendues = gdf.geometry.area.groupby(
+                [gdf[col] for col in ([by] if isinstance(by, str) else by)],
+                observed=True,
+            ).sum()
+            couverture_valide = bool(
+                dissous.geometry.is_valid.all()
+                and np.allclose(
+                    dissous.geometry.area.to_numpy(),
+                    aires_attendues.loc[dissous.index].to_numpy(),
+                    rtol=1e-9,
+                    atol=1e-6,
+                )
+            )
+        except Exception:
+            couverture_valide = False
+
+    if not couverture_valide:
+        debugLog(
+            style.YELLOW,
+            "Couverture invalide : repli sur l'union générale (unary)",
+            logging.INFO,
+            onlyFile=True,
+        )
+        dissous = gdf.dissolve(by=by, method="unary", observed=True)
+
+    return dissous if as_index else dissous.reset_index()
+
+
+def dissolve_partitionne(
+    gdf, by, taille_cellule=500.0, nb_workers=1, methode_union="unary"
+):
+    """
+    Équivalent de gdf.dissolve(by=by, as_index=False).explode() par partitions spatiales :
+    - chaque géométrie est affectée à la cellule (grille de `taille_cellule` m) de son point représentatif
+    - union indépendante dans chaque cellule (en parallèle avec `nb_workers` threads, shapely libère le GIL)
+    - seuls les polygones qui touchent un polygone d'une autre cellule sont fusionnés ensuite
+      (composantes connexes du graphe d'intersection)
+    Mêmes polygones que l'union globale (à l'ordre des lignes près) sans construire une
+    MultiPolygon géante par groupe : le pic mémoire est borné par la taille des cellules.
+    Les attributs sont ceux de la première ligne de chaque groupe (comme dissolve).
+    methode_union : "unary" ou "coverage" (dissolve_coverage dans chaque cellule)
+    """
+    colonnes = [by] if isinstance(by, str) else list(by)
+    geom_col = gdf.geometry.name
+    if gdf.empty:
+        return gdf.dissolve(by=by, as_index=False, observed=True).explode(
+            index_parts=False, ignore_index=True
+        )
+
+    # 1) Affectation des entités aux cellules
+    points = gdf.geometry.representative_point()
+    minx, miny = gdf.total_bounds[:2]
+    ix = np.floor((points.x.to_numpy() - minx) / taille_cellule).astype(np.int64)
+    iy = np.floor((points.y.to_numpy() - miny) / taille_cellule).astype(np.int64)
+    cellules = iy * (ix.max() + 1) + ix
+    sous_gdf = gdf[colonnes + [geom_col]]
+
+    # 2) Union par cellule et par groupe
+    def union_cellule(positions):
+        morceau = sous_gdf.iloc[positions]
+        if methode_union == "coverage":
+            dissous = dissolve_coverage(morceau, by=colonnes, as_index=False)
+        else:
+            dissous = morceau.dissolve(by=colonnes, as_index=False, observed=True)
+        return dissous.explode(index_parts=False, ignore_index=True)
+
+    ordre = np.argsort(cellules, kind="stable")
+    _, debuts = np.unique(cellules[ordre], return_index=True)
+    positions_cellules = np.split(ordre, debuts[1:])
+    with ThreadPoolExecutor(max_workers=max(1, nb_workers)) as executor:
+        resultats = list(executor.map(union_cellule, positions_cellules))
+    morceaux = gp.GeoDataFrame(
+        pd.concat(resultats, ignore_index=True), geometry=geom_col, crs=gdf.crs
+    )
+    morceaux["__cellule__"] = np.repeat(
+        [cellules[positions[0]] for positions in positions_cellules],
+        [len(resultat) for resultat in resultats],
+    )
+    del resultats
+    code_groupe = (
+        morceaux.groupby(colonnes, sort=False, observed=True).ngroup().to_numpy()
+    )
+
+    # 3) Fusion des seuls polygones en contact avec une autre cellule (même groupe)
+    gauche, droite = morceaux.sindex.query(morceaux.geometry, predicate="intersects")
+    frontiere = (
+        morceaux["__cellule__"].to_numpy()[gauche]
+        != morceaux["__cellule__"].to_numpy()[droite]
+    ) & (code_groupe[gauche] == code_groupe[droite])
+    n = len(morceaux)
+    graphe = coo_matrix(
+        (
+            np.ones(frontiere.sum(), dtype=np.int8),
+            (gauche[frontiere], droite[frontiere]),
+        ),
+        shape=(n, n),
+    )
+    _, composantes = connected_components(graphe, directed=False)
+    taille_composantes = np.bincount(composantes)
+    a_fusionner = taille_composantes[composantes] > 1
+
+    geometries = list(morceaux.geometry.to_numpy()[~a_fusionner])
+    groupes = list(code_groupe[~a_fusionner])
+    if a_fusionner.any():
+        fusion = (
+            gp.GeoSeries(morceaux.geometry.to_numpy()[a_fusionner], crs=gdf.crs)
+            .groupby(composantes[a_fusionner])
+            .agg(shapely.union_all)
+        )
+        code_fusion = (
+            pd.Series(code_groupe[a_fusionner])
+            .groupby(composantes[a_fusionner])
+            .first()
+        )
+        for geom, code in zip(fusion.to_numpy(), code_fusion.loc[fusion.index]):
+            parties = shapely.get_parts(geom)
+            geometries.extend(parties)
+            groupes.extend([code] * len(parties))
+
+    # 4) Attributs du groupe (première ligne, comme dissolve)
+    cles = morceaux[colonnes].drop_duplicates().reset_index(drop=True)
+    attributs = (
+        gdf.drop(columns=geom_col)
+        .groupby(colonnes, observed=True)
+        .first()
+        .reset_index()
+    )
+    resultat = cles.iloc[groupes].reset_index(drop=True)
+    resultat[geom_col] = geometries
+    resultat = gp.GeoDataFrame(resultat, geometry=geom_col, crs=gdf.crs)
+    resultat = resultat.merge(attributs, on=colonnes, how="left")
+    resultat = resultat[list(attributs.columns) + [geom_col]]
+    return resultat.sort_values(colonnes, kind="stable").reset_index(drop=True)
+
+
+# Pragmas SQLite appliqués pendant l'écriture d'un GeoPackage (options de configuration GDAL)
+GPKG_PRAGMAS = {
+    "OGR_SQLITE_SYNCHRONOUS": "OFF",  # pas de fsync à chaque transaction
+    "OGR_SQLITE_JOURNAL": "MEMORY",  # journal de transaction en mémoire
+    "OGR_SQLITE_CACHE": "512",  # cache SQLite en Mo
+}
+
+
+def exportGeoPackage(couches, chemin, pragmas=GPKG_PRAGMAS):
+    """
+    Export de plusieurs couches (dict {nom de couche : GeoDataFrame}) dans un seul GeoPackage
+    - le fichier est recréé, chaque couche est écrite en un seul appel (pyogrio) : une seule
+      transaction par couche au lieu d'un fichier ouvert / écrit / fermé par commune
+    - index spatial (R-tree) construit par GDAL une seule fois, quand la couche est remplie
+    - pragmas SQLite (synchronous, journal, cache) appliqués le temps de l'écriture
+      ⚠️ pas de fsync : en cas d'arrêt brutal le fichier est à régénérer
+    """
+    if os.path.exists(chemin):
+        os.remove(chemin)
+
+    anciennes_options = {
+        option: pyogrio.get_gdal_config_option(option) for option in pragmas
+    }
+    pyogrio.set_gdal_config_options(pragmas)
+    try:
+        for nom_couche, gdf in couches.items():
+            pyogrio.write_dataframe(
+                gdf,
+                chemin,
+                layer=nom_couche,
+                driver="GPKG",
+                append=os.path.exists(chemin),
+                layer_options={"SPATIAL_INDEX": "YES"},
+            )
+    finally:
+        pyogrio.set_gdal_config_options(anciennes_options)
@@ -0,0 +1,840 @@
+import logging
+import math
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import pyogrio
+import rasterio
+import shapely
+from rasterio.features import rasterize
+from rasterio.windows import Window
+from shapely.geometry import box
+
+from utils.functions import debugLog, style
+from utils.constants import RATE_M2_TO_KM2, RATE_MK2_TO_HA
+from utils.vectorisation_vege_process import FUSION_CLASSES
+
+# KPI column (hectares) of each strate, v_veg_t_ha is the sum of the strates
+STRATE_KPI_COLUMNS = {
+    "arborescent": "v_veg_h_ha",
+    "arbustif": "v_veg_m_ha",
+    "herbacee": "v_veg_b_ha",
+}
+
+
+def spatial_partitions(bounds, partition_size: float, order: str = "hilbert"):
+    """
+    Split an extent in square cells (partitions) of `partition_size` (CRS unit).
+
+        Parameters:
+            bounds (tuple) : Extent to split (minx, miny, maxx, maxy)
+            partition_size (float) : Side of a cell
+            order (string) : Order of the cells : "grid" (row by row) or "hilbert" (Hilbert curve, better locality)
+
+        Returns:
+            List of cells (minx, miny, maxx, maxy)
+    """
+    minx, miny, maxx, maxy = bounds
+    xs = np.arange(minx, maxx, partition_size)
+    ys = np.arange(miny, maxy, partition_size)
+    if len(xs) == 0:
+        xs = np.array([minx])
+    if len(ys) == 0:
+        ys = np.array([miny])
+
+    cells = [
+        (x, y, min(x + partition_size, maxx), min(y + partition_size, maxy))
+        for y in ys
+        for x in xs
+    ]
+    if order == "hilbert" and len(cells) > 1:
+        distances = gpd.GeoSeries([box(*cell) for cell in cells]).hilbert_distance(
+            total_bounds=bounds
+        )
+        cells = [cells[i] for i in np.argsort(distances.to_numpy(), kind="stable")]
+    return cells
+
+
+def strate_areas_out_of_core(
+    input_path: str,
+    gdf_zones: gpd.GeoDataFrame,
+    partition_size: float = 2000.0,
+    order: str = "hilbert",
+    strate_col: str = "strate",
+):
+    """
+    Sum vegetation areas by zone (index of gdf_zones) and by strate without loading the whole input file.
+
+    The input extent is split in partitions, each partition is read with a bbox filter (pyogrio),
+    clipped to its cell (features crossing cells are counted once) and intersected with the zones.
+    The partial sums are then reduced : memory is bounded by the partition size, not by the dataset size.
+
+        Parameters:
+            input_path (string) : Path of the vegetation file (.shp, .gpkg) with a `strate` column
+            gdf_zones (GeoDataFrame) : Zones (cities) used to aggregate areas
+            partition_size (float) : Side of a partition (CRS unit, meters in EPSG:2154)
+            order (string) : Order of the partitions ("grid" or "hilbert")
+            strate_col (string) : Name of the strate column
+
+        Returns:
+            DataFrame of areas (m2) : index = index of gdf_zones, columns = strates (lowercase)
+    """
+    info = pyogrio.read_info(input_path, force_total_bounds=True)
+    input_crs = info["crs"]
+    zones = gdf_zones[["geometry"]].copy()
+    zones["__zone__"] = gdf_zones.index
+    if input_crs and zones.crs is not None and zones.crs != input_crs:
+        zones = zones.to_crs(input_crs)
+
+    # Only the extent covered by both the input and the zones is read
+    in_minx, in_miny, in_maxx, in_maxy = info["total_bounds"]
+    zn_minx, zn_miny, zn_maxx, zn_maxy = zones.total_bounds
+    bounds = (
+        max(in_minx, zn_minx),
+        max(in_miny, zn_miny),
+        min(in_maxx, zn_maxx),
+        min(in_maxy, zn_maxy),
+    )
+    if bounds[0] >= bounds[2] or bounds[1] >= bounds[3]:
+        return pd.DataFrame(index=pd.Index([], name="__zone__"))
+
+    cells = spatial_partitions(bounds, partition_size, order=order)
+    debugLog(
+        style.YELLOW,
+        "Out-of-core read : {} features split in {} partitions of {} m".format(
+            info["features"], len(cells), partition_size
+        ),
+        logging.INFO,
+        onlyFile=True,
+    )
+
+    partial_sums = []
+    for cell in cells:
+        cell_geom = box(*cell)
+        zones_cell = gpd.clip(zones, cell_geom, keep_geom_type=True)
+        if zones_cell.empty:
+            continue
+
+        gdf_cell = pyogrio.read_dataframe(input_path, bbox=cell, columns=[strate_col])
+        if gdf_cell.empty:
+            continue
+
+        # Count each piece of geometry once : keep only the part inside the cell
+        gdf_cell = gpd.clip(gdf_cell, cell_geom, keep_geom_type=True)
+        if gdf_cell.empty:
+            continue
+
+        parts = gpd.overlay(
+            gdf_cell, zones_cell, how="intersection", keep_geom_type=True
+        )
+        if parts.empty:
+            continue
+
+        parts["__area__"] = parts.geometry.area
+        parts[strate_col] = parts[strate_col].astype(str).str.lower()
+        partial_sums.append(parts.groupby(["__zone__", strate_col])["__area__"].sum())
+        del gdf_cell, parts
+
+    if not partial_sums:
+        return pd.DataFrame(index=pd.Index([], name="__zone__"))
+
+    # Reduce partial sums
+    areas = pd.concat(partial_sums).groupby(level=[0, 1]).sum()
+    return areas.unstack(fill_value=0.0)
+
+
+def _rasterized_zone_labels(raster, zones: gpd.GeoDataFrame, window_size: int):
+    """
+    Windows of `window_size` pixels over the extent of the zones, with the label of the zone of each pixel
+    (position of the zone + 1, 0 = outside of the zones) rasterized on the window.
+
+        Returns:
+            Generator of (window, labels)
+    """
+    # Windows over the extent of the zones (clipped to the raster)
+    minx, miny, maxx, maxy = zones.total_bounds
+    row_start, col_start = raster.index(minx, maxy, op=math.floor)
+    row_stop, col_stop = raster.index(maxx, miny, op=math.ceil)
+    row_start, col_start = max(row_start, 0), max(col_start, 0)
+    row_stop, col_stop = min(row_stop, raster.height), min(col_stop, raster.width)
+    windows = [
+        Window(
+            col,
+            row,
+            min(window_size, col_stop - col),
+            min(window_size, row_stop - row),
+        )
+        for row in range(row_start, row_stop, window_size)
+        for col in range(col_start, col_stop, window_size)
+    ]
+    debugLog(
+        style.YELLOW,
+        "Raster KPIs : {} zones, {} windows of {} px".format(
+            len(zones), len(windows), window_size
+        ),
+        logging.INFO,
+        onlyFile=True,
+    )
+
+    zone_geoms = zones.geometry.to_numpy()
+    for window in windows:
+        zone_positions = zones.sindex.query(
+            box(*raster.window_bounds(window)), predicate="intersects"
+        )
+        if len(zone_positions) == 0:
+            continue
+        yield window, rasterize(
+            zip(zone_geoms[zone_positions], zone_positions + 1),
+            out_shape=(int(window.height), int(window.width)),
+            transform=raster.window_transform(window),
+            fill=0,
+            dtype="int32",
+        )
+
+
+def _indexed_zone_labels(raster, zones: gpd.GeoDataFrame, mask_index):
+    """
+    Window of each zone with its labels (position of the zone + 1, 0 = outside), from the mask index.
+
+        Returns:
+            Generator of (window, labels)
+    """
+    debugLog(
+        style.YELLOW,
+        "Raster KPIs : {} zones, windows and masks from {}".format(
+            len(zones), mask_index.index_dir
+        ),
+        logging.INFO,
+        onlyFile=True,
+    )
+    for position, geom in enumerate(zones.geometry.to_numpy()):
+        try:
+            outside, _, window = mask_index.masque(raster, geom)
+        except ValueError:
+            # Zone outside of the raster : no pixel counted
+            continue
+        yield window, np.where(outside, 0, position + 1).astype(np.int32)
+
+
+def strate_areas_from_raster(
+    raster_path: str,
+    gdf_zones: gpd.GeoDataFrame,
+    gdf_mask: gpd.GeoDataFrame | None = None,
+    class_to_strate: dict | None = None,
+    window_size: int = 2048,
+    mask_index=None,
+):
+    """
+    Sum vegetation areas by zone (index of gdf_zones) and by strate straight from the classified raster,
+    without vectorization (zonal histogram).
+
+    The raster is read window by window over the extent of the zones. In each window, the zones are
+    rasterized once on the raster grid (label = zone number, pixel centers) and a single `np.bincount`
+    on (zone, class) gives the pixel counts of every zone. Counts are converted with the pixel area.
+    Zones must not overlap (cities are a partition of the territory).
+    With a `mask_index`, the window and pixel mask of each zone are loaded from the index instead
+    (one window by zone, no rasterization of the zones once the index is built).
+
+        Parameters:
+            raster_path (string) : Path of the classified raster (GeoTIFF, classes 1 to 5)
+            gdf_zones (GeoDataFrame) : Zones (cities) used to aggregate areas
+            gdf_mask (GeoDataFrame) : Optional mask (ex: roads), only the pixels inside are counted
+            class_to_strate (dict) : Class of the raster -> strate (default : FUSION_CLASSES)
+            window_size (int) : Side of the windows read (pixels)
+            mask_index (IndexMasques) : Index of the zone windows / pixel masks (utils/mask_index.py)
+
+        Returns:
+            DataFrame of areas (m2) : index = index of gdf_zones, columns = strates (lowercase)
+    """
+    class_to_strate = class_to_strate or FUSION_CLASSES
+
+    with rasterio.open(raster_path) as raster:
+        zones = gdf_zones[["geometry"]]
+        if zones.crs is not None and raster.crs is not None and zones.crs != raster.crs:
+            zones = zones.to_crs(raster.crs)
+        mask = None
+        if gdf_mask is not None:
+            mask = gdf_mask[["geometry"]]
+            if (
+                mask.crs is not None
+                and raster.crs is not None
+                and mask.crs != raster.crs
+            ):
+                mask = mask.to_crs(raster.crs)
+
+        pixel_area = abs(raster.transform.a * raster.transform.e)
+        # Only the classes of class_to_strate are counted (nodata and other values are ignored)
+        nb_classes = max(class_to_strate) + 1
+        nb_zones = len(zones)
+        counts = np.zeros((nb_zones + 1) * nb_classes, dtype=np.int64)
+
+        if mask_index is not None:
+            zone_labels = _indexed_zone_labels(raster, zones, mask_index)
+        else:
+            zone_labels = _rasterized_zone_labels(raster, zones, window_size)
+
+        for window, labels in zone_labels:
+            if mask is not None:
+                window_bounds = box(*raster.window_bounds(window))
+                mask_positions = mask.sindex.query(
+                    window_bounds, predicate="intersects"
+                )
+                if len(mask_positions) == 0:
+                    continue
+                inside_mask = rasterize(
+                    mask.geometry.to_numpy()[mask_positions],
+                    out_shape=labels.shape,
+                    transform=raster.window_transform(window),
+                    fill=0,
+                    default_value=1,
+                    dtype="uint8",
+                ).astype(bool)
+                labels[~inside_mask] = 0
+
+            data = raster.read(1, window=window).astype(np.int64)
+            inside = (labels > 0) & (data >= 0) & (data < nb_classes)
+            counts += np.bincount(
+                labels[inside] * nb_classes + data[inside], minlength=counts.size
+            )
+
+    # Pixel counts (zone, class) -> areas (zone, strate)
+    counts = counts.reshape(nb_zones + 1, nb_classes)[1:]
+    areas = pd.DataFrame(index=gdf_zones.index)
+    for classe, strate in class_to_strate.items():
+        strate = strate.lower()
+        column = counts[:, classe] * pixel_area
+        areas[strate] = areas[strate] + column if strate in areas else column
+    areas.index.name = "__zone__"
+    return areas
+
+
+def _indexed_pieces(gdf_vege: gpd.GeoDataFrame, gdf_zones: gpd.GeoDataFrame):
+    """
+    (polygon, zone) pairs found with the spatial index of the zones and the piece of each polygon in its zone :
+    a polygon covered by its zone is kept as is, only the polygons crossing a zone border are intersected.
+
+        Returns:
+            Positions of the polygons, positions of the zones, pieces (geometries) and covered mask of the pairs
+    """
+    zones = gdf_zones[["geometry"]]
+    if zones.crs is not None and gdf_vege.crs is not None and zones.crs != gdf_vege.crs:
+        zones = zones.to_crs(gdf_vege.crs)
+
+    vege_positions, zone_positions = zones.sindex.query(
+        gdf_vege.geometry, predicate="intersects"
+    )
+    pieces = gdf_vege.geometry.to_numpy()[vege_positions]
+    zone_geoms = zones.geometry.to_numpy()[zone_positions]
+    shapely.prepare(zone_geoms)
+    covered = shapely.covers(zone_geoms, pieces)
+    pieces[~covered] = shapely.intersection(zone_geoms[~covered], pieces[~covered])
+    debugLog(
+        style.YELLOW,
+        "Indexed KPIs : {} (polygon, zone) pairs, {} intersected".format(
+            len(pieces), int((~covered).sum())
+        ),
+        logging.INFO,
+        onlyFile=True,
+    )
+    return vege_positions, zone_positions, pieces, covered
+
+
+def strate_areas_indexed(
+    gdf_vege: gpd.GeoDataFrame,
+    gdf_zones: gpd.GeoDataFrame,
+    strate_col: str = "strate",
+):
+    """
+    Sum vegetation areas by zone (index of gdf_zones) and by strate in a single indexed pass.
+
+    The (polygon, zone) pairs are found with the spatial index of the zones, a polygon covered by its zone
+    keeps its own area and only the polygons crossing a zone border are intersected.
+
+        Parameters:
+            gdf_vege (GeoDataFrame) : Vegetation polygons with a `strate` column
+            gdf_zones (GeoDataFrame) : Zones used to aggregate areas (finest zoning)
+            strate_col (string) : Name of the strate column
+
+        Returns:
+            DataFrame of areas (m2) : index = index of gdf_zones, columns = strates (lowercase)
+    """
+    vege_positions, zone_positions, pieces, _ = _indexed_pieces(gdf_vege, gdf_zones)
+    parts = pd.DataFrame(
+        {
+            "__zone__": gdf_zones.index.to_numpy()[zone_positions],
+            strate_col: gdf_vege[strate_col]
+            .astype(str)
+            .str.lower()
+            .to_numpy()[vege_positions],
+            "__area__": shapely.area(pieces),
+        }
+    )
+    return (
+        parts.groupby(["__zone__", strate_col])["__area__"]
+        .sum()
+        .unstack(fill_value=0.0)
+    )
+
+
+def strate_landscape_indexed(
+    gdf_vege: gpd.GeoDataFrame,
+    gdf_zones: gpd.GeoDataFrame,
+    strate_col: str = "strate",
+):
+    """
+    Areas and landscape metrics of the patches by zone and by strate, in the same indexed pass as
+    strate_areas_indexed. A patch is a polygon (part of a multipolygon) of the vegetation in the zone.
+
+        Parameters:
+            gdf_vege (GeoDataFrame) : Vegetation polygons with a `strate` column
+            gdf_zones (GeoDataFrame) : Zones used to aggregate areas
+            strate_col (string) : Name of the strate column
+
+        Returns:
+            DataFrame of areas (m2) : index = index of gdf_zones, columns = strates (lowercase)
+            DataFrame of metrics : index = (zone, strate), columns = patches, area, mean_area, median_area,
+            largest_area (m2), edge (m, perimeter of the patches) and division (landscape division index,
+            1 - sum((a_i / A)^2) with A the area of the zone : probability that two random points of the
+            zone are not in the same patch, 0 for a single patch covering the zone)
+    """
+    vege_positions, zone_positions, pieces, _ = _indexed_pieces(gdf_vege, gdf_zones)
+
+    # Patches : polygons of the pieces (the lines / points left by an intersection are dropped)
+    patches, pair_positions = shapely.get_parts(pieces, return_index=True)
+    patch_areas = shapely.area(patches)
+    keep = patch_areas > 0
+    patches, pair_positions, patch_areas = (
+        patches[keep],
+        pair_positions[keep],
+        patch_areas[keep],
+    )
+    parts = pd.DataFrame(
+        {
+            "__zone__": gdf_zones.index.to_numpy()[zone_positions[pair_positions]],
+            strate_col: gdf_vege[strate_col]
+            .astype(str)
+            .str.lower()
+            .to_numpy()[vege_positions[pair_positions]],
+            "__area__": patch_areas,
+            "__edge__": shapely.length(patches),
+            "__area2__": patch_areas**2,
+        }
+    )
+    grouped = parts.groupby(["__zone__", strate_col])
+    metrics = grouped["__area__"].agg(
+        patches="size",
+        area="sum",
+        mean_area="mean",
+        median_area="median",
+        largest_area="max",
+    )
+    metrics["edge"] = grouped["__edge__"].sum()
+    zone_areas = pd.Series(
+        shapely.area(gdf_zones.geometry.to_numpy()), index=gdf_zones.index
+    )
+    zone_areas = zone_areas.reindex(metrics.index.get_level_values(0)).to_numpy()
+    metrics["division"] = 1 - grouped["__area2__"].sum() / zone_areas**2
+    return metrics["area"].unstack(fill_value=0.0), metrics
+
+
+def zone_parents(gdf_fine: gpd.GeoDataFrame, gdf_coarse: gpd.GeoDataFrame):
+    """
+    Parent zone of each zone of a finer zoning (ex: IRIS -> city) : the coarse zone containing
+    its representative point. Zones without parent are left out.
+
+        Parameters:
+            gdf_fine (GeoDataFrame) : Finer zoning
+            gdf_coarse (GeoDataFrame) : Coarser zoning (the fine zones are nested in it)
+
+        Returns:
+            Series : index = index of gdf_fine, values = index of gdf_coarse
+    """
+    points = gdf_fine.geometry.representative_point()
+    if (
+        gdf_coarse.crs is not None
+        and points.crs is not None
+        and gdf_coarse.crs != points.crs
+    ):
+        points = points.to_crs(gdf_coarse.crs)
+    point_positions, coarse_positions = gdf_coarse.sindex.query(
+        points, predicate="within"
+    )
+    parents = pd.Series(
+        gdf_coarse.index.to_numpy()[coarse_positions],
+        index=gdf_fine.index.to_numpy()[point_positions],
+    )
+    return parents[~parents.index.duplicated()]
+
+
+def rollup_areas(areas: pd.DataFrame, parents: pd.Series):
+    """
+    Sum the areas of the zones of a finer zoning on their parent zones.
+
+        Parameters:
+            areas (DataFrame) : Areas (m2) by fine zone (index) and strate (columns)
+            parents (Series) : Parent zone of each fine zone (see zone_parents)
+
+        Returns:
+            DataFrame of areas (m2) : index = parent zones, columns = strates
+    """
+    areas = areas[areas.index.isin(parents.index)]
+    rolled = areas.groupby(parents.loc[areas.index].to_numpy()).sum()
+    rolled.index.name = "__zone__"
+    return rolled
+
+
+def zone_kpis(gdf_zones: gpd.GeoDataFrame, areas: pd.DataFrame):
+    """
+    KPIs (hectares) of the zones from their areas by strate : columns of STRATE_KPI_COLUMNS,
+    total vegetation `v_veg_t_ha` and zone area `sup_ha`, added to the attributes of the zones.
+
+        Parameters:
+            gdf_zones (GeoDataFrame) : Zones
+            areas (DataFrame) : Areas (m2) by zone (index of gdf_zones) and strate (columns)
+
+        Returns:
+            GeoDataFrame of the zones with KPIs
+    """
+    kpis = gdf_zones.copy()
+    total = 0
+    for strate, column in STRATE_KPI_COLUMNS.items():
+        if strate in areas:
+            strate_area = areas[strate].reindex(kpis.index, fill_value=0.0)
+        else:
+            strate_area = pd.Series(0.0, index=kpis.index)
+        kpis[column] = strate_area / RATE_M2_TO_KM2 * RATE_MK2_TO_HA
+        total = total + kpis[column]
+    kpis["v_veg_t_ha"] = total
+    kpis["sup_ha"] = kpis.geometry.area / RATE_M2_TO_KM2 * RATE_MK2_TO_HA
+    geometry = kpis.geometry.name
+    return kpis[[c for c in kpis.columns if c != geometry] + [geometry]]
+
+
+# Landscape metrics of each strate : suffix of the KPI columns (h / m / b, as in STRATE_KPI_COLUMNS)
+STRATE_LANDSCAPE_SUFFIXES = {
+    "arborescent": "h",
+    "arbustif": "m",
+    "herbacee": "b",
+}
+# Canopy fragmentation index : division of the arborescent strate
+CANOPY_STRATE = "arborescent"
+
+
+def landscape_kpis(gdf_zones: gpd.GeoDataFrame, metrics: pd.DataFrame):
+    """
+    Landscape KPIs of the zones by strate (columns suffixed by h / m / b, see STRATE_LANDSCAPE_SUFFIXES) :
+    - n_pat : number of patches
+    - a_mn_m2 / a_md_m2 : mean / median patch area (m2)
+    - lps : largest patch index, share of the zone covered by the largest patch of the strate
+    - ed_mha : edge density, perimeter of the patches by hectare of zone (m/ha)
+    and `frag_can`, canopy fragmentation index : landscape division of the arborescent strate (probability
+    that two random points of the zone are not in the same canopy patch, see strate_landscape_indexed).
+
+        Parameters:
+            gdf_zones (GeoDataFrame) : Zones
+            metrics (DataFrame) : Metrics by (zone, strate) (see strate_landscape_indexed)
+
+        Returns:
+            DataFrame of the KPIs (index of gdf_zones), 0 for a strate without patch (`frag_can` : 1)
+    """
+    zone_m2 = gdf_zones.geometry.area
+    zone_m2 = zone_m2.where(zone_m2 > 0)
+    zone_ha = zone_m2 / RATE_M2_TO_KM2 * RATE_MK2_TO_HA
+    strates = metrics.index.get_level_values(1)
+    kpis = pd.DataFrame(index=gdf_zones.index)
+    for strate, suffix in STRATE_LANDSCAPE_SUFFIXES.items():
+        by_zone = metrics[strates == strate].droplevel(1).reindex(kpis.index)
+        kpis[f"n_pat_{suffix}"] = by_zone["patches"].fillna(0).astype("int64")
+        kpis[f"a_mn_{suffix}_m2"] = by_zone["mean_area"].fillna(0.0)
+        kpis[f"a_md_{suffix}_m2"] = by_zone["median_area"].fillna(0.0)
+        kpis[f"lps_{suffix}"] = (by_zone["largest_area"] / zone_m2).fillna(0.0)
+        kpis[f"ed_{suffix}_mha"] = (by_zone["edge"] / zone_ha).fillna(0.0)
+        if strate == CANOPY_STRATE:
+            # Zone without canopy : completely divided
+            kpis["frag_can"] = by_zone["division"].fillna(1.0)
+    return kpis
+
+
+# Cover ratio column (share of the cell area) of each strate, r_veg_t is the sum of the strates
+STRATE_RATIO_COLUMNS = {
+    "arborescent": "r_veg_h",
+    "arbustif": "r_veg_m",
+    "herbacee": "r_veg_b",
+}
+
+
+def grid_cells(gdf_zones: gpd.GeoDataFrame, cell_size: float):
+    """
+    Regular grid of square cells over the zones (ex: cities), aligned on multiples of `cell_size`
+    (the same cell keeps the same id from one run to another). Only the cells intersecting the zones are kept.
+
+        Parameters:
+            gdf_zones (GeoDataFrame) : Territory covered by the grid
+            cell_size (float) : Side of a cell (CRS unit, meters in EPSG:2154)
+
+        Returns:
+            GeoDataFrame of the cells : `id_cell` ("<size>mE<x>N<y>", lower left corner), `x_min`, `y_min`
+    """
+    minx, miny, maxx, maxy = gdf_zones.total_bounds
+    x0 = math.floor(minx / cell_size) * cell_size
+    y1 = math.ceil(maxy / cell_size) * cell_size
+    nb_cols = max(math.ceil((maxx - x0) / cell_size), 1)
+    nb_rows = max(math.ceil((y1 - miny) / cell_size), 1)
+
+    rows, cols = np.divmod(np.arange(nb_rows * nb_cols), nb_cols)
+    x_min = x0 + cols * cell_size
+    y_min = y1 - (rows + 1) * cell_size
+    cells = gpd.GeoDataFrame(
+        {"x_min": x_min, "y_min": y_min},
+        geometry=shapely.box(x_min, y_min, x_min + cell_size, y_min + cell_size),
+        crs=gdf_zones.crs,
+    )
+
+    # Cells over the territory only
+    keep = np.unique(gdf_zones.sindex.query(cells.geometry, predicate="intersects")[0])
+    cells = cells.iloc[keep].reset_index(drop=True)
+    cells.insert(
+        0,
+        "id_cell",
+        [
+            "{:g}mE{:.0f}N{:.0f}".format(cell_size, x, y)
+            for x, y in zip(cells["x_min"], cells["y_min"])
+        ],
+    )
+    return cells
+
+
+def _grid_layout(cells: gpd.GeoDataFrame, cell_size: float):
+    """
+    Column and row of each cell in the grid of its extent (row 0 at the top).
+
+        Returns:
+            (x0, y1, nb_cols, nb_rows, cols, rows) : top left corner, size of the grid, position of the cells
+    """
+    x0, y1 = cells["x_min"].min(), cells["y_min"].max() + cell_size
+    cols = np.rint((cells["x_min"].to_numpy() - x0) / cell_size).astype(np.int64)
+    rows = np.rint((y1 - cell_size - cells["y_min"].to_numpy()) / cell_size).astype(
+        np.int64
+    )
+    return x0, y1, int(cols.max()) + 1, int(rows.max()) + 1, cols, rows
+
+
+def strate_areas_grid(
+    source,
+    cells: gpd.GeoDataFrame,
+    cell_size: float,
+    partition_size: float = 2000.0,
+    strate_col: str = "strate",
+    gdf_zones: gpd.GeoDataFrame | None = None,
+):
+    """
+    Sum vegetation areas by grid cell and by strate, partition by partition (bounded memory).
+
+    The grid is split in partitions of whole cells. For each partition, the polygons are read with a bbox
+    filter (file) or selected with the spatial index (GeoDataFrame) and intersected with the cells of the
+    partition only (see strate_areas_indexed) : each (polygon, cell) pair is computed once, no clip by cell.
+    With `gdf_zones`, the cells on the border of the territory are cut by it first : as in the raster mode,
+    only the vegetation inside the territory is counted.
+
+        Parameters:
+            source (string | GeoDataFrame) : Path of the vegetation file (.shp, .gpkg) or polygons in memory
+            cells (GeoDataFrame) : Cells of the grid (see grid_cells)
+            cell_size (float) : Side of a cell
+            partition_size (float) : Side of a partition (rounded to a multiple of the cell size)
+            strate_col (string) : Name of the strate column
+            gdf_zones (GeoDataFrame) : Territory (cities), vegetation outside is ignored
+
+        Returns:
+            DataFrame of areas (m2) : index = index of cells, columns = strates (lowercase)
+    """
+    x0, y1, nb_cols, nb_rows, _, _ = _grid_layout(cells, cell_size)
+    if gdf_zones is not None:
+        territory = gdf_zones.to_crs(cells.crs).geometry.union_all()
+        shapely.prepare(territory)
+        geoms = cells.geometry.to_numpy()
+        border = ~shapely.contains_properly(territory, geoms)
+        geoms = geoms.copy()
+        geoms[border] = shapely.intersection(geoms[border], territory)
+        cells = cells.set_geometry(
+            gpd.GeoSeries(geoms, index=cells.index, crs=cells.crs)
+        )
+
+    step = max(round(partition_size / cell_size), 1) * cell_size
+    partitions = spatial_partitions(
+        (x0, y1 - nb_rows * cell_size, x0 + nb_cols * cell_size, y1),
+        step,
+        order="hilbert",
+    )
+    debugLog(
+        style.YELLOW,
+        "Grid KPIs : {} cells of {} m in {} partitions of {} m".format(
+            len(cells), cell_size, len(partitions), step
+        ),
+        logging.INFO,
+        onlyFile=True,
+    )
+
+    partial_areas = []
+    for partition in partitions:
+        minx, miny, maxx, maxy = partition
+        cells_part = cells[
+            (cells["x_min"] >= minx - cell_size / 2)
+            & (cells["x_min"] < maxx - cell_size / 2)
+            & (cells["y_min"] >= miny - cell_size / 2)
+            & (cells["y_min"] < maxy - cell_size / 2)
+        ]
+        if cells_part.empty:
+            continue
+
+        if isinstance(source, gpd.GeoDataFrame):
+            vege_part = source.iloc[
+                source.sindex.query(box(*partition), predicate="intersects")
+            ]
+        else:
+            vege_part = pyogrio.read_dataframe(
+                source, bbox=partition, columns=[strate_col]
+            )
+        if vege_part.empty:
+            continue
+
+        partial_areas.append(
+            strate_areas_indexed(vege_part, cells_part, strate_col=strate_col)
+        )
+        del vege_part
+
+    if not partial_areas:
+        return pd.DataFrame(index=pd.Index([], name="__zone__"))
+    # Partitions hold different cells : no reduction needed
+    return pd.concat(partial_areas).fillna(0.0)
+
+
+def strate_areas_grid_from_raster(
+    raster_path: str,
+    cells: gpd.GeoDataFrame,
+    cell_size: float,
+    gdf_zones: gpd.GeoDataFrame,
+    gdf_mask: gpd.GeoDataFrame | None = None,
+    class_to_strate: dict | None = None,
+    window_size: int = 2048,
+):
+    """
+    Sum vegetation areas by grid cell and by strate straight from the classified raster (pixel binning).
+
+    The raster is read window by window (see strate_areas_from_raster) : the cell of each pixel is computed
+    from the coordinates of its center and a single `np.bincount` on (cell, class) counts the pixels.
+    Only the pixels inside the zones (territory) and the optional mask are counted.
+
+        Parameters:
+            raster_path (string) : Path of the classified raster (GeoTIFF, classes 1 to 5)
+            cells (GeoDataFrame) : Cells of the grid (see grid_cells)
+            cell_size (float) : Side of a cell
+            gdf_zones (GeoDataFrame) : Territory (cities), pixels outside are ignored
+            gdf_mask (GeoDataFrame) : Optional mask (ex: roads), only the pixels inside are counted
+            class_to_strate (dict) : Class of the raster -> strate (default : FUSION_CLASSES)
+            window_size (int) : Side of the windows read (pixels)
+
+        Returns:
+            DataFrame of areas (m2) : index = index of cells, columns = strates (lowercase)
+    """
+    class_to_strate = class_to_strate or FUSION_CLASSES
+    x0, y1, nb_cols, nb_rows, cell_cols_of, cell_rows_of = _grid_layout(
+        cells, cell_size
+    )
+
+    with rasterio.open(raster_path) as raster:
+        zones = gdf_zones[["geometry"]]
+        if zones.crs is not None and raster.crs is not None and zones.crs != raster.crs:
+            zones = zones.to_crs(raster.crs)
+        mask = None
+        if gdf_mask is not None:
+            mask = gdf_mask[["geometry"]]
+            if (
+                mask.crs is not None
+                and raster.crs is not None
+                and mask.crs != raster.crs
+            ):
+                mask = mask.to_crs(raster.crs)
+
+        pixel_area = abs(raster.transform.a * raster.transform.e)
+        nb_classes = max(class_to_strate) + 1
+        counts = np.zeros(nb_rows * nb_cols * nb_classes, dtype=np.int64)
+
+        for window, labels in _rasterized_zone_labels(raster, zones, window_size):
+            if mask is not None:
+                window_bounds = box(*raster.window_bounds(window))
+                mask_positions = mask.sindex.query(
+                    window_bounds, predicate="intersects"
+                )
+                if len(mask_positions) == 0:
+                    continue
+                inside_mask = rasterize(
+                    mask.geometry.to_numpy()[mask_positions],
+                    out_shape=labels.shape,
+                    transform=raster.window_transform(window),
+                    fill=0,
+                    default_value=1,
+                    dtype="uint8",
+                ).astype(bool)
+                labels[~inside_mask] = 0
+
+            # Cell of each pixel (from the coordinates of the pixel centers)
+            window_transform = raster.window_transform(window)
+            xs = window_transform.c + (np.arange(labels.shape[1]) + 0.5) * (
+                window_transform.a
+            )
+            ys = window_transform.f + (np.arange(labels.shape[0]) + 0.5) * (
+                window_transform.e
+            )
+            cell_cols = np.floor((xs - x0) / cell_size).astype(np.int64)
+            cell_rows = np.floor((y1 - ys) / cell_size).astype(np.int64)
+            cell_numbers = cell_rows[:, None] * nb_cols + cell_cols[None, :]
+
+            data = raster.read(1, window=window).astype(np.int64)
+            inside = (
+                (labels > 0)
+                & (data >= 0)
+                & (data < nb_classes)
+                & (cell_cols[None, :] >= 0)
+                & (cell_cols[None, :] < nb_cols)
+                & (cell_rows[:, None] >= 0)
+                & (cell_rows[:, None] < nb_rows)
+            )
+            counts += np.bincount(
+                cell_numbers[inside] * nb_classes + data[inside],
+                minlength=counts.size,
+            )
+
+    # Pixel counts (cell, class) -> areas (cell, strate)
+    counts = counts.reshape(nb_rows * nb_cols, nb_classes)[
+        cell_rows_of * nb_cols + cell_cols_of
+    ]
+    areas = pd.DataFrame(index=cells.index)
+    for classe, strate in class_to_strate.items():
+        strate = strate.lower()
+        column = counts[:, classe] * pixel_area
+        areas[strate] = areas[strate] + column if strate in areas else column
+    areas.index.name = "__zone__"
+    return areas
+
+
+def grid_kpis(cells: gpd.GeoDataFrame, areas: pd.DataFrame):
+    """
+    KPIs of the grid cells : hectares by strate (see zone_kpis) and cover ratios of the cell area
+    (STRATE_RATIO_COLUMNS, total `r_veg_t`). The cell area is the whole cell, vegetation only inside the
+    territory. In vector mode the strata may overlap (buffers of the vectorization) : their areas are
+    summed, so `r_veg_t` can slightly exceed 1 on fully vegetated cells.
+
+        Parameters:
+            cells (GeoDataFrame) : Cells of the grid (see grid_cells)
+            areas (DataFrame) : Areas (m2) by cell (index of cells) and strate (columns)
+
+        Returns:
+            GeoDataFrame of the cells with KPIs
+    """
+    kpis = zone_kpis(cells, areas)
+    geometry = kpis.pop(kpis.geometry.name)
+    for strate, column in STRATE_RATIO_COLUMNS.items():
+        kpis[column] = kpis[STRATE_KPI_COLUMNS[strate]] / kpis["sup_ha"]
+    kpis["r_veg_t"] = kpis["v_veg_t_ha"] / kpis["sup_ha"]
+    return gpd.GeoDataFrame(kpis, geometry=geometry, crs=cells.crs)
@@ -0,0 +1,118 @@
+import os
+import logging
+
+import numpy as np
+from affine import Affine
+from rasterio.mask import raster_geometry_mask
+from rasterio.windows import Window
+
+from utils.functions import chemin_temporaire, debugLog, style
+from utils.stage_cache import StageCache
+
+
+class IndexMasques:
+    """
+    Index disque des fenêtres raster et masques de pixels des communes (ou de toute géométrie).
+
+    - Une entrée par (grille raster, géométrie) dans `<index_dir>/<clé>.npz` : fenêtre de la géométrie,
+      transform de la fenêtre et masque booléen compressé (np.packbits + zip)
+    - La clé est un hash de la signature de la grille (CRS, transform, dimensions) et du WKB de la
+      géométrie : une autre grille ou une géométrie modifiée donne une autre clé, l'entrée est recalculée
+    - Les valeurs sont celles de rasterio.mask.raster_geometry_mask(crop=True), donc les fenêtres
+      lues sont identiques à celles de rasterio.mask.mask
+    """
+
+    def __init__(self, index_dir: str) -> None:
+        self.index_dir = index_dir
+        os.makedirs(index_dir, exist_ok=True)
+
+    @staticmethod
+    def signature_grille(raster) -> list:
+        """Signature de la grille d'un raster ouvert avec rasterio (CRS, transform, dimensions)."""
+        return [
+            raster.crs.to_wkt() if raster.crs is not None else None,
+            list(raster.transform)[:6],
+            raster.width,
+            raster.height,
+        ]
+
+    def cle(self, raster, geom) -> str:
+        return StageCache.key(self.signature_grille(raster), geom.wkb)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.index_dir, key + ".npz")
+
+    def masque(self, raster, geom):
+        """
+        Masque de la géométrie sur la grille du raster, depuis l'index (calculé et enregistré si absent).
+        Retour : (masque (True = hors géométrie), transform de la fenêtre, fenêtre)
+        """
+        path = self._path(self.cle(raster, geom))
+        try:
+            with np.load(path) as entree:
+                col_off, row_off, width, height = (int(v) for v in entree["fenetre"])
+                masque = (
+                    np.unpackbits(entree["masque"], count=height * width)
+                    .reshape(height, width)
+                    .astype(bool)
+                )
+                return (
+                    masque,
+                    Affine(*entree["transform"]),
+                    Window(col_off, row_off, width, height),
+                )
+        except FileNotFoundError:
+            pass
+        except Exception as error:
+            debugLog(
+                style.YELLOW,
+                "Entrée d'index illisible, recalcul : {} ({})".format(path, error),
+                logging.WARN,
+            )
+
+        masque, transform, fenetre = raster_geometry_mask(raster, [geom], crop=True)
+        fenetre = Window(
+            int(round(fenetre.col_off)),
+            int(round(fenetre.row_off)),
+            masque.shape[1],
+            masque.shape[0],
+        )
+        # Fichier temporaire propre à l'écriture : la même entrée peut être écrite par plusieurs processus
+        tmp_path = chemin_temporaire(path)
+        try:
+            with open(tmp_path, "wb") as f:
+                np.savez_compressed(
+                    f,
+                    fenetre=np.array(
+                        [
+                            fenetre.col_off,
+                            fenetre.row_off,
+                            fenetre.width,
+                            fenetre.height,
+                        ],
+                        dtype=np.int64,
+                    ),
+                    transform=np.array(list(transform)[:6], dtype=np.float64),
+                    masque=np.packbits(masque, axis=None),
+                )
+            os.replace(tmp_path, path)
+        except BaseException:
+            StageCache._remove(tmp_path)
+            raise
+        return masque, transform, fenetre
+
+    def lire(self, raster, geom, bande: int = 1):
+        """
+        Equivalent de rasterio.mask.mask(raster, [geom], crop=True) sur une bande,
+        avec la fenêtre et le masque de l'index.
+        Retour : (tableau de la fenêtre, pixels hors géométrie = nodata (0 si absent), transform)
+        """
+        masque, transform, fenetre = self.masque(raster, geom)
+        nodata = raster.nodata
+        donnees = raster.read(bande, window=fenetre)
+        return (
+            np.where(masque, 0 if nodata is None else nodata, donnees).astype(
+                donnees.dtype, copy=False
+            ),
+            transform,
+        )
@@ -0,0 +1,170 @@
+import os
+import json
+import logging
+
+import rasterio
+import rasterio.shutil
+
+from utils.functions import debugLog, style
+from utils.constants import PREPARED_RASTER_DIR, PREPARED_RASTER_REGISTRY
+
+# Creation options of the prepared rasters (GDAL COG driver)
+# - 512 px tiles : a commune window reads whole tiles, far less bytes than strips of the full width
+# - lossless compression, no predictor (classes are categorical values, not a continuous signal)
+# - overviews resampled with the most frequent class (MODE)
+COG_OPTIONS = {
+    "BLOCKSIZE": 512,
+    "COMPRESS": "DEFLATE",
+    "LEVEL": 6,
+    "PREDICTOR": "NO",
+    "OVERVIEWS": "IGNORE_EXISTING",
+    "OVERVIEW_RESAMPLING": "MODE",
+    "NUM_THREADS": "ALL_CPUS",
+    "BIGTIFF": "IF_SAFER",
+}
+
+
+def raster_layout(raster_path: str) -> dict:
+    """
+    Storage layout of a raster : tiles or strips, block size, compression and overviews.
+
+        Parameters:
+            raster_path (string) : Path of the raster
+
+        Returns:
+            Dict of the layout (driver, tiled, block_shape, compression, overviews, cog)
+    """
+    with rasterio.open(raster_path) as raster:
+        block_height, block_width = raster.block_shapes[0]
+        return {
+            "driver": raster.driver,
+            "size": [raster.width, raster.height],
+            "dtype": raster.dtypes[0],
+            # Strips cover the full width of the raster
+            "tiled": block_width != raster.width or block_height == block_width,
+            "block_shape": [block_height, block_width],
+            "compression": raster.compression.value if raster.compression else None,
+            "overviews": raster.overviews(1),
+            "cog": raster.tags(ns="IMAGE_STRUCTURE").get("LAYOUT") == "COG",
+        }
+
+
+def is_prepared(layout: dict) -> bool:
+    """
+    True if the raster is tiled, compressed and has overviews (nothing to gain by a preparation).
+    """
+    return layout["tiled"] and bool(layout["compression"]) and bool(layout["overviews"])
+
+
+def _load_registry() -> dict:
+    try:
+        with open(PREPARED_RASTER_REGISTRY, encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except ValueError as error:
+        debugLog(
+            style.YELLOW,
+            "Unreadable registry of prepared rasters, ignored : {} ({})".format(
+                PREPARED_RASTER_REGISTRY, error
+            ),
+            logging.WARN,
+        )
+        return {}
+
+
+def _source_signature(raster_path: str) -> dict:
+    stat = os.stat(raster_path)
+    return {"size": stat.st_size, "mtime": stat.st_mtime}
+
+
+def prepare_raster(
+    raster_path: str,
+    output_path: str | None = None,
+    options: dict | None = None,
+    force: bool = False,
+) -> str:
+    """
+    Rewrite a raster as a tiled Cloud-Optimized GeoTIFF with internal overviews and lossless compression,
+    and record it in the registry of prepared rasters (see resolve_raster).
+
+        Parameters:
+            raster_path (string) : Path of the delivered raster
+            output_path (string) : Path of the prepared raster (default : <PREPARED_RASTER_DIR>/<name>_cog.tif)
+            options (dict) : Creation options overriding COG_OPTIONS
+            force (bool) : Rewrite even if the raster is already prepared (recorded or delivered as such)
+
+        Returns:
+            Path of the prepared raster (the raster itself if its layout is already suitable)
+    """
+    raster_path = os.path.abspath(raster_path)
+    if output_path is None:
+        output_path = os.path.join(
+            PREPARED_RASTER_DIR,
+            os.path.splitext(os.path.basename(raster_path))[0] + "_cog.tif",
+        )
+
+    if not force:
+        prepared_path = resolve_raster(raster_path)
+        if prepared_path != raster_path:
+            debugLog(
+                style.GREEN,
+                "Raster already prepared : {}".format(prepared_path),
+                logging.INFO,
+            )
+            return prepared_path
+
+    layout = raster_layout(raster_path)
+    debugLog(
+        style.YELLOW,
+        "Layout of {} : {}".format(raster_path, layout),
+        logging.INFO,
+    )
+    if is_prepared(layout) and not force:
+        debugLog(
+            style.GREEN,
+            "Raster already tiled, compressed and with overviews : used as delivered",
+            logging.INFO,
+        )
+        return raster_path
+
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    tmp_path = output_path + ".tmp.tif"
+    rasterio.shutil.copy(
+        raster_path, tmp_path, driver="COG", **{**COG_OPTIONS, **(options or {})}
+    )
+    os.replace(tmp_path, output_path)
+    debugLog(
+        style.GREEN,
+        "Prepared raster : {} ({})".format(output_path, raster_layout(output_path)),
+        logging.INFO,
+    )
+
+    registry = _load_registry()
+    registry[raster_path] = {
+        "prepared": os.path.abspath(output_path),
+        "source": _source_signature(raster_path),
+    }
+    os.makedirs(os.path.dirname(PREPARED_RASTER_REGISTRY), exist_ok=True)
+    tmp_registry = PREPARED_RASTER_REGISTRY + ".tmp"
+    with open(tmp_registry, "w", encoding="utf-8") as f:
+        json.dump(registry, f, indent=2)
+    os.replace(tmp_registry, PREPARED_RASTER_REGISTRY)
+    return output_path
+
+
+def resolve_raster(raster_path: str) -> str:
+    """
+    Path of the prepared version of a raster if one is recorded and still matches the delivered file
+    (same size and modification date), else the path of the raster itself.
+    """
+    raster_path = os.path.abspath(raster_path)
+    entry = _load_registry().get(raster_path)
+    if (
+        entry
+        and os.path.exists(entry["prepared"])
+        and os.path.exists(raster_path)
+        and entry["source"] == _source_signature(raster_path)
+    ):
+        return entry["prepared"]
+    return raster_path
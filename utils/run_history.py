@@ -0,0 +1,317 @@
+import os
+import json
+import socket
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+import pandas as pd
+
+from utils.constants import RUN_HISTORY_DB
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    entry_point TEXT NOT NULL,
+    started_at TEXT NOT NULL,
+    ended_at TEXT,
+    wall_s REAL,
+    status TEXT NOT NULL,
+    args TEXT,
+    host TEXT,
+    peak_rss_mb REAL
+);
+CREATE TABLE IF NOT EXISTS stages (
+    run_id INTEGER NOT NULL REFERENCES runs (run_id),
+    stage TEXT NOT NULL,
+    item TEXT,
+    ended_at TEXT NOT NULL,
+    wall_s REAL NOT NULL,
+    features_in INTEGER,
+    features_out INTEGER,
+    pixels INTEGER,
+    rss_mb REAL,
+    peak_rss_mb REAL
+);
+CREATE INDEX IF NOT EXISTS stages_run ON stages (run_id);
+CREATE INDEX IF NOT EXISTS stages_stage_item ON stages (stage, item);
+"""
+
+# Run being recorded in this process (see record_run)
+_active_run = None
+
+
+def peak_rss_mb() -> float | None:
+    """Peak resident memory of the process in MB (None if not available)."""
+    try:
+        import resource
+
+        # ru_maxrss : kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    except (ImportError, OSError):
+        return None
+
+
+def _rss_mb() -> float | None:
+    from utils.functions import rss_processus
+
+    rss = rss_processus()
+    return None if rss is None else rss / 1024**2
+
+
+class RunHistory:
+    """
+    Local SQLite store of the runs of the entry points (vectorize, clip, kpi...).
+
+    - `runs` : one row by run (entry point, arguments, dates, wall time, status, peak memory)
+    - `stages` : one row by stage and item (commune, file...) of a run : wall time, features in / out,
+      pixels processed, resident and peak memory of the process at the end of the stage
+    """
+
+    def __init__(self, db_path: str = RUN_HISTORY_DB) -> None:
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        # Stages can end in a reader thread (prefetch) : one connection shared under a lock
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(SCHEMA)
+        self.run_id = None
+        self.pid = None
+        self.start = None
+
+    def start_run(self, entry_point: str, args: dict | None = None) -> int:
+        self.start = datetime.now()
+        self.pid = os.getpid()
+        with self.lock, self.conn:
+            cursor = self.conn.execute(
+                "INSERT INTO runs (entry_point, started_at, status, args, host) VALUES (?, ?, ?, ?, ?)",
+                (
+                    entry_point,
+                    self.start.isoformat(timespec="seconds"),
+                    "running",
+                    json.dumps(args or {}, default=str, sort_keys=True),
+                    socket.gethostname(),
+                ),
+            )
+        self.run_id = cursor.lastrowid
+        return self.run_id
+
+    def end_run(self, status: str = "ok") -> None:
+        end = datetime.now()
+        with self.lock, self.conn:
+            self.conn.execute(
+                "UPDATE runs SET ended_at = ?, wall_s = ?, status = ?, peak_rss_mb = ? WHERE run_id = ?",
+                (
+                    end.isoformat(timespec="seconds"),
+                    (end - self.start).total_seconds(),
+                    status,
+                    peak_rss_mb(),
+                    self.run_id,
+                ),
+            )
+
+    def record(
+        self,
+        stage: str,
+        item: str | None,
+        wall_s: float,
+        features_in: int | None = None,
+        features_out: int | None = None,
+        pixels: int | None = None,
+    ) -> None:
+        """Record a stage of the current run (ignored in a child process of the run)."""
+        if self.run_id is None or os.getpid() != self.pid:
+            return
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT INTO stages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    self.run_id,
+                    stage,
+                    item,
+                    datetime.now().isoformat(timespec="seconds"),
+                    float(wall_s),
+                    None if features_in is None else int(features_in),
+                    None if features_out is None else int(features_out),
+                    None if pixels is None else int(pixels),
+                    _rss_mb(),
+                    peak_rss_mb(),
+                ),
+            )
+
+    def runs(self, entry_point: str | None = None, limit: int = 20) -> pd.DataFrame:
+        """Last runs (all entry points or one), most recent first."""
+        query = "SELECT * FROM runs"
+        params = []
+        if entry_point:
+            query += " WHERE entry_point = ?"
+            params.append(entry_point)
+        query += " ORDER BY run_id DESC LIMIT ?"
+        params.append(limit)
+        with self.lock:
+            return pd.read_sql_query(query, self.conn, params=params)
+
+    def stages(self, run_ids: list[int]) -> pd.DataFrame:
+        placeholders = ", ".join("?" * len(run_ids))
+        with self.lock:
+            return pd.read_sql_query(
+                f"SELECT * FROM stages WHERE run_id IN ({placeholders})",
+                self.conn,
+                params=list(run_ids),
+            )
+
+    def item_medians(
+        self, stage: str, entry_points: tuple | None = None, window: int = 10
+    ) -> pd.Series:
+        """
+        Median wall time of a stage by item (commune, file...) over the last `window` successful runs
+        (of the given entry points) where the stage was recorded.
+        """
+        query = (
+            "SELECT DISTINCT r.run_id FROM runs r JOIN stages s ON s.run_id = r.run_id "
+            "WHERE r.status = 'ok' AND s.stage = ?"
+        )
+        params = [stage]
+        if entry_points:
+            query += " AND r.entry_point IN ({})".format(
+                ", ".join("?" * len(entry_points))
+            )
+            params += list(entry_points)
+        query += " ORDER BY r.run_id DESC LIMIT ?"
+        params.append(window)
+        with self.lock:
+            run_ids = [row[0] for row in self.conn.execute(query, params)]
+        if not run_ids:
+            return pd.Series(dtype=float, name="wall_s")
+        walls = self.stages(run_ids)
+        walls = (
+            walls[walls["stage"] == stage].groupby(["run_id", "item"])["wall_s"].sum()
+        )
+        return walls.groupby("item").median()
+
+    def report(
+        self,
+        run_id: int | None = None,
+        window: int = 10,
+        threshold: float = 1.25,
+        min_delta_s: float = 0.5,
+    ) -> tuple[pd.Series, pd.DataFrame]:
+        """
+        Compare the stages of a run with the trailing median of the previous runs of the same entry point.
+
+            Parameters:
+                run_id (int) : Run to compare (default : the last finished run)
+                window (int) : Number of previous successful runs used for the median
+                threshold (float) : Ratio wall time / median above which a stage is flagged as slower
+                min_delta_s (float) : Minimal slowdown in seconds to flag a stage (ignores the noise of short stages)
+
+            Returns:
+                Row of the run and DataFrame by stage (items, wall_s, baseline_s, ratio, features_out,
+                features_per_s, pixels_per_s, peak_rss_mb, slower)
+        """
+        with self.lock:
+            if run_id is None:
+                run = pd.read_sql_query(
+                    "SELECT * FROM runs WHERE status != 'running' ORDER BY run_id DESC LIMIT 1",
+                    self.conn,
+                )
+            else:
+                run = pd.read_sql_query(
+                    "SELECT * FROM runs WHERE run_id = ?", self.conn, params=[run_id]
+                )
+            if run.empty:
+                raise ValueError("No run found in {}".format(self.db_path))
+            run = run.iloc[0]
+            previous = pd.read_sql_query(
+                "SELECT run_id FROM runs WHERE entry_point = ? AND run_id < ? AND status = 'ok' "
+                "ORDER BY run_id DESC LIMIT ?",
+                self.conn,
+                params=[run["entry_point"], int(run["run_id"]), window],
+            )["run_id"].tolist()
+
+        current = (
+            self.stages([int(run["run_id"])])
+            .groupby(["stage", "item"], dropna=False)
+            .agg(
+                wall_s=("wall_s", "sum"),
+                features_out=("features_out", "sum"),
+                pixels=("pixels", "sum"),
+                peak_rss_mb=("peak_rss_mb", "max"),
+            )
+            .reset_index()
+        )
+        # Median of each stage / item over the previous runs (same communes or files compared)
+        if previous:
+            baseline = (
+                self.stages(previous)
+                .groupby(["run_id", "stage", "item"], dropna=False)["wall_s"]
+                .sum()
+                .groupby(["stage", "item"], dropna=False)
+                .median()
+                .rename("baseline_s")
+                .reset_index()
+            )
+            current = current.merge(baseline, on=["stage", "item"], how="left")
+        else:
+            current["baseline_s"] = float("nan")
+        current["compared_s"] = current["wall_s"].where(current["baseline_s"].notna())
+
+        by_stage = current.groupby("stage", sort=False).agg(
+            items=("item", "size"),
+            wall_s=("wall_s", "sum"),
+            compared_s=("compared_s", "sum"),
+            baseline_s=("baseline_s", "sum"),
+            features_out=("features_out", "sum"),
+            pixels=("pixels", "sum"),
+            peak_rss_mb=("peak_rss_mb", "max"),
+        )
+        by_stage["ratio"] = by_stage["compared_s"] / by_stage["baseline_s"].where(
+            by_stage["baseline_s"] > 0
+        )
+        by_stage["features_per_s"] = by_stage["features_out"] / by_stage["wall_s"]
+        by_stage["pixels_per_s"] = by_stage["pixels"] / by_stage["wall_s"]
+        by_stage["slower"] = (by_stage["ratio"] > threshold) & (
+            by_stage["compared_s"] - by_stage["baseline_s"] >= min_delta_s
+        )
+        by_stage.attrs["previous_runs"] = previous
+        return run, by_stage.drop(columns="compared_s")
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+@contextmanager
+def record_run(
+    entry_point: str, args: dict | None = None, db_path: str = RUN_HISTORY_DB
+):
+    """
+    Record a run of an entry point : the stages ended during the block (record_stage, endTimerLog)
+    are stored in the run history, the status is "failed" if the block raises.
+    """
+    global _active_run
+    history = RunHistory(db_path)
+    history.start_run(entry_point, args)
+    previous, _active_run = _active_run, history
+    status = "failed"
+    try:
+        yield history
+        status = "ok"
+    finally:
+        _active_run = previous
+        history.end_run(status)
+        history.close()
+
+
+def record_stage(
+    stage: str,
+    item: str | None,
+    wall_s: float,
+    features_in: int | None = None,
+    features_out: int | None = None,
+    pixels: int | None = None,
+) -> None:
+    """Record a stage in the run being recorded (nothing outside of record_run)."""
+    if _active_run is not None:
+        _active_run.record(stage, item, wall_s, features_in, features_out, pixels)
@@ -0,0 +1,100 @@
+import os
+import json
+import hashlib
+import logging
+import pickle
+
+from utils.functions import chemin_temporaire, debugLog, style
+
+
+class StageCache:
+    """
+    Cache disque (adressé par contenu) des résultats intermédiaires de vegeBigProcess.
+
+    - Chaque résultat d'étape (GeoDataFrame) est stocké dans `<cache_dir>/<clé>.pkl`
+    - La clé d'une étape est un hash de la clé de l'étape précédente et des paramètres de l'étape,
+      la première clé est calculée sur la fenêtre raster, son transform et la géométrie de la commune
+    - Taille plafonnée à `max_size` octets, éviction LRU (date de dernier accès = mtime du fichier)
+    """
+
+    def __init__(self, cache_dir: str, max_size: int) -> None:
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(*parts) -> str:
+        """Hash (blake2b) des éléments donnés : bytes tels quels, le reste sérialisé en JSON trié."""
+        h = hashlib.blake2b(digest_size=20)
+        for part in parts:
+            if isinstance(part, (bytes, bytearray, memoryview)):
+                h.update(part)
+            else:
+                h.update(json.dumps(part, sort_keys=True, default=str).encode("utf-8"))
+            h.update(b"|")
+        return h.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key + ".pkl")
+
+    def has(self, key: str) -> bool:
+        return os.path.exists(self._path(key))
+
+    def get(self, key: str):
+        """Retourne le GeoDataFrame en cache (ou None) et le marque comme récemment utilisé."""
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                gdf = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as error:
+            debugLog(
+                style.YELLOW,
+                "Entrée de cache illisible, suppression : {} ({})".format(path, error),
+                logging.WARN,
+            )
+            self._remove(path)
+            return None
+        os.utime(path)
+        return gdf
+
+    def put(self, key: str, gdf) -> None:
+        """
+        Enregistre le GeoDataFrame (écriture atomique, fichier temporaire propre à l'écriture : la même clé
+        peut être écrite par plusieurs processus) puis applique le plafond de taille.
+        """
+        path = self._path(key)
+        tmp_path = chemin_temporaire(path)
+        try:
+            with open(tmp_path, "wb") as f:
+                pickle.dump(gdf, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+        except BaseException:
+            self._remove(tmp_path)
+            raise
+        self.evict()
+
+    def evict(self) -> None:
+        """Supprime les entrées les moins récemment utilisées jusqu'à repasser sous `max_size`."""
+        entries = []
+        total = 0
+        for entry in os.scandir(self.cache_dir):
+            if entry.is_file() and entry.name.endswith(".pkl"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+            self._remove(path)
+            total -= size
+
+    @staticmethod
+    def _remove(path: str) -> None:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,397 @@
+import os
+import gzip
+import json
+import logging
+import math
+import shutil
+import sqlite3
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import geopandas as gpd
+import pyogrio
+
+from utils.functions import debugLog, style
+
+# Web Mercator (EPSG:3857) : half width of the world and ground size of a 256 px tile pixel at the
+# equator and zoom 0
+WEB_MERCATOR_HALF_WIDTH = math.pi * 6378137
+EQUATOR_RESOLUTION = 2 * WEB_MERCATOR_HALF_WIDTH / 256
+
+# A (layer, zoom level) covering more tiles is split in bands of tile columns run as separate jobs
+TILES_PER_JOB = 16
+# Margin (fraction of a tile) read around a band : larger than the buffer of the MVT tiles written by GDAL
+# (BUFFER=80 for an EXTENT of 4096 by default)
+BAND_MARGIN = 0.125
+
+# Default options of the tile layers (see build_vector_tiles)
+TILE_LAYER_OPTIONS = {
+    # Vegetation strata : only from zoom 13, polygons smaller than 2x2 pixels are dropped (except at max zoom)
+    "vegetation": {"columns": ["strate"], "min_zoom": 13, "min_feature_pixels": 2},
+    # KPIs by city : all zoom levels, no feature dropped
+    "kpis": {"columns": None, "min_zoom": None, "min_feature_pixels": 0},
+}
+
+
+def ground_resolution(zoom: int, latitude: float) -> float:
+    """
+    Ground size (m) of a tile pixel at `zoom` and `latitude` (degrees).
+    """
+    return EQUATOR_RESOLUTION * math.cos(math.radians(latitude)) / 2**zoom
+
+
+def tile_width(zoom: int) -> float:
+    """
+    Width (m, EPSG:3857) of a tile at `zoom`.
+    """
+    return 2 * WEB_MERCATOR_HALF_WIDTH / 2**zoom
+
+
+def tile_column_bands(bounds, zoom: int, bands: int) -> list:
+    """
+    Split the tile columns covering `bounds` (EPSG:3857) at `zoom` in at most `bands` bands of contiguous
+    columns : [(first column, last column)]. The first and last bands are open up to the edges of the world
+    (tiles next to the bounds that only hold the buffer of the features).
+    """
+    width = tile_width(zoom)
+    first, last = (
+        min(max(int((x + WEB_MERCATOR_HALF_WIDTH) // width), 0), 2**zoom - 1)
+        for x in (bounds[0], bounds[2])
+    )
+    columns = last - first + 1
+    bands = max(1, min(bands, columns))
+    limits = [first + columns * band // bands for band in range(bands + 1)]
+    limits[0], limits[-1] = 0, 2**zoom
+    return [(limits[band], limits[band + 1] - 1) for band in range(bands)]
+
+
+def _write_zoom_tiles(job: dict) -> str:
+    """
+    Worker : write one layer at one zoom level in its own MBTiles file (GDAL MVT writer).
+
+    Features whose area is smaller than `min_area` (m2) are dropped, the geometries are simplified
+    by GDAL (tolerance in tile pixels, so the ground tolerance halves at each zoom level).
+    With `tile_columns` (first, last), only this band of tile columns is written : the features are read
+    with a margin of BAND_MARGIN tile around the band (features in the buffer of the tiles on its edges),
+    the tiles written by GDAL outside the band are then removed (they belong to the neighbour bands).
+    """
+    bbox = None
+    if job["tile_columns"]:
+        width = tile_width(job["zoom"])
+        first, last = job["tile_columns"]
+        bbox = (
+            (first - BAND_MARGIN) * width - WEB_MERCATOR_HALF_WIDTH,
+            -WEB_MERCATOR_HALF_WIDTH,
+            (last + 1 + BAND_MARGIN) * width - WEB_MERCATOR_HALF_WIDTH,
+            WEB_MERCATOR_HALF_WIDTH,
+        )
+    gdf = pyogrio.read_dataframe(
+        job["staging_path"],
+        layer=job["layer"],
+        columns=job["columns"],
+        where="__area__ >= {}".format(job["min_area"]) if job["min_area"] else None,
+        bbox=bbox,
+    )
+    if gdf.empty:
+        return None
+
+    pyogrio.write_dataframe(
+        gdf,
+        job["output_path"],
+        layer=job["layer"],
+        driver="MBTiles",
+        dataset_options={
+            "MINZOOM": str(job["zoom"]),
+            "MAXZOOM": str(job["zoom"]),
+            # At a single zoom level, GDAL applies SIMPLIFICATION_MAX_ZOOM
+            "SIMPLIFICATION_MAX_ZOOM": str(job["simplification"]),
+            "MAX_SIZE": str(job["max_tile_size"]),
+            "NAME": job["layer"],
+        },
+        layer_options={"NAME": job["layer"]},
+    )
+
+    if job["tile_columns"]:
+        part = sqlite3.connect(job["output_path"])
+        part.execute(
+            "DELETE FROM tiles WHERE tile_column < ? OR tile_column > ?",
+            job["tile_columns"],
+        )
+        empty = part.execute("SELECT COUNT(*) FROM tiles").fetchone()[0] == 0
+        part.commit()
+        part.close()
+        if empty:
+            return None
+    return job["output_path"]
+
+
+def _merge_tilestats(known: dict, other: dict) -> None:
+    """
+    Merge the tilestats of a layer written in two parts (bands of tile columns of the same zoom level).
+    """
+    known["count"] += other["count"]
+    attributes = {
+        attribute["attribute"]: attribute for attribute in known["attributes"]
+    }
+    for attribute in other["attributes"]:
+        merged = attributes.get(attribute["attribute"])
+        if merged is None:
+            known["attributes"].append(attribute)
+            attributes[attribute["attribute"]] = attribute
+            continue
+        if "values" in attribute:
+            values = merged.setdefault("values", [])
+            values.extend(v for v in attribute["values"] if v not in values)
+            merged["count"] = len(values)
+        for key, better in (("min", min), ("max", max)):
+            if key in attribute:
+                merged[key] = better(merged.get(key, attribute[key]), attribute[key])
+    known["attributeCount"] = len(known["attributes"])
+
+
+def merge_mbtiles(
+    part_paths: list, output_path: str, name: str, feature_counts: dict | None = None
+):
+    """
+    Merge vector MBTiles files in a single one.
+
+    Tiles present in several parts are merged by concatenating their (gunzipped) MVT payloads :
+    a tile is a list of layers (repeated protobuf field), parts must hold different layers, zoom levels
+    or tiles (bands of tile columns).
+    Metadata (zoom range, bounds, vector_layers) are merged. The tilestats of a layer are the ones of its
+    highest zoom level, merged between its bands : their feature count is then `feature_counts[layer]`
+    if given (the bands read the features on their edges twice).
+    """
+    if os.path.exists(output_path):
+        os.remove(output_path)
+
+    output = sqlite3.connect(output_path)
+    output.execute("CREATE TABLE metadata (name TEXT, value TEXT)")
+    output.execute(
+        "CREATE TABLE tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB)"
+    )
+    output.execute(
+        "CREATE UNIQUE INDEX tile_index ON tiles (zoom_level, tile_column, tile_row)"
+    )
+
+    metadata = {}
+    vector_layers = {}
+    tilestats = {}
+    tilestats_parts = {}
+    min_zoom, max_zoom = None, None
+    bounds = None
+    for part_path in part_paths:
+        part = sqlite3.connect(part_path)
+        part_metadata = dict(part.execute("SELECT name, value FROM metadata"))
+        for tile in part.execute(
+            "SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles"
+        ):
+            existing = output.execute(
+                "SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+                tile[:3],
+            ).fetchone()
+            if existing is None:
+                output.execute("INSERT INTO tiles VALUES (?, ?, ?, ?)", tile)
+            else:
+                merged = gzip.compress(
+                    gzip.decompress(existing[0]) + gzip.decompress(tile[3])
+                )
+                output.execute(
+                    "UPDATE tiles SET tile_data = ? WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+                    (merged, *tile[:3]),
+                )
+        part.close()
+
+        metadata.update(part_metadata)
+        min_zoom = min(int(part_metadata["minzoom"]), min_zoom or 99)
+        max_zoom = max(int(part_metadata["maxzoom"]), max_zoom or 0)
+        part_bounds = [float(b) for b in part_metadata["bounds"].split(",")]
+        bounds = (
+            part_bounds
+            if bounds is None
+            else [
+                min(bounds[0], part_bounds[0]),
+                min(bounds[1], part_bounds[1]),
+                max(bounds[2], part_bounds[2]),
+                max(bounds[3], part_bounds[3]),
+            ]
+        )
+        part_json = json.loads(part_metadata.get("json", "{}"))
+        for layer in part_json.get("vector_layers", []):
+            known = vector_layers.setdefault(layer["id"], layer)
+            known["minzoom"] = min(known["minzoom"], layer["minzoom"])
+            known["maxzoom"] = max(known["maxzoom"], layer["maxzoom"])
+        # Stats of the highest zoom level of a layer (all the features are kept)
+        part_zoom = int(part_metadata["maxzoom"])
+        for layer_stats in part_json.get("tilestats", {}).get("layers", []):
+            layer = layer_stats["layer"]
+            known_zoom, parts = tilestats_parts.get(layer, (-1, 0))
+            if part_zoom > known_zoom:
+                tilestats[layer] = layer_stats
+                tilestats_parts[layer] = (part_zoom, 1)
+            elif part_zoom == known_zoom:
+                _merge_tilestats(tilestats[layer], layer_stats)
+                tilestats_parts[layer] = (part_zoom, parts + 1)
+    for layer, (_, parts) in tilestats_parts.items():
+        if parts > 1 and layer in (feature_counts or {}):
+            tilestats[layer]["count"] = feature_counts[layer]
+
+    metadata.update(
+        {
+            "name": name,
+            "minzoom": str(min_zoom),
+            "maxzoom": str(max_zoom),
+            "bounds": ",".join(str(b) for b in bounds),
+            "center": "{},{},{}".format(
+                (bounds[0] + bounds[2]) / 2, (bounds[1] + bounds[3]) / 2, min_zoom
+            ),
+            "json": json.dumps(
+                {
+                    "vector_layers": list(vector_layers.values()),
+                    "tilestats": {
+                        "layerCount": len(tilestats),
+                        "layers": list(tilestats.values()),
+                    },
+                }
+            ),
+        }
+    )
+    output.executemany("INSERT INTO metadata VALUES (?, ?)", metadata.items())
+    output.commit()
+    output.close()
+
+
+def build_vector_tiles(
+    layers: dict,
+    output_path: str,
+    min_zoom: int = 10,
+    max_zoom: int = 16,
+    simplification: float = 1.0,
+    simplification_max_zoom: float = 0.5,
+    max_tile_size: int = 500000,
+    workers: int = 1,
+    layer_options: dict | None = None,
+):
+    """
+    Build a vector tile pyramid (MBTiles, Mapbox Vector Tiles) from several layers, fully offline (GDAL).
+
+    Each (layer, zoom level) is a job run in a process pool, split in bands of tile columns (one job per
+    band) when it covers more than TILES_PER_JOB tiles : the jobs write their own MBTiles file which are
+    then merged in `output_path`.
+
+        Parameters:
+            layers (dict) : {layer name : GeoDataFrame}
+            output_path (string) : Path of the MBTiles file
+            min_zoom (int), max_zoom (int) : Zoom levels of the pyramid
+            simplification (float) : Simplification tolerance (tile pixels) below max_zoom
+            simplification_max_zoom (float) : Simplification tolerance (tile pixels) at max_zoom
+            max_tile_size (int) : Max size of a tile (bytes), GDAL reduces precision / drops features above
+            workers (int) : Number of processes
+            layer_options (dict) : Options by layer (default : TILE_LAYER_OPTIONS) :
+                columns (list | None) : attributes kept (None = all)
+                min_zoom (int | None) : first zoom level of the layer
+                min_feature_pixels (float) : polygons smaller than this side (in pixels) squared are dropped
+                    below max_zoom (all the features are kept at max_zoom)
+
+        Returns:
+            Path of the MBTiles file
+    """
+    layer_options = {**TILE_LAYER_OPTIONS, **(layer_options or {})}
+    tmp_dir = tempfile.mkdtemp(prefix="ipave_tiles_")
+    staging_path = os.path.join(tmp_dir, "staging.gpkg")
+
+    try:
+        # Layers are staged in a GeoPackage read by the workers (no GeoDataFrame sent between processes)
+        jobs = []
+        feature_counts = {}
+        for layer, gdf in layers.items():
+            options = layer_options.get(layer, {})
+            columns = options.get("columns") or [
+                c for c in gdf.columns if c != gdf.geometry.name
+            ]
+            staged = gdf[columns + [gdf.geometry.name]].copy()
+            staged["__area__"] = staged.geometry.area
+            staged = staged.to_crs("EPSG:3857")
+            pyogrio.write_dataframe(
+                staged, staging_path, layer=layer, driver="GPKG", append=bool(jobs)
+            )
+            feature_counts[layer] = len(staged)
+
+            minx, miny, maxx, maxy = staged.total_bounds
+            latitude = (
+                gpd.GeoSeries(
+                    gpd.points_from_xy([(minx + maxx) / 2], [(miny + maxy) / 2]),
+                    crs=staged.crs,
+                )
+                .to_crs("EPSG:4326")
+                .y[0]
+            )
+            first_zoom = max(min_zoom, options.get("min_zoom") or min_zoom)
+            for zoom in range(first_zoom, max_zoom + 1):
+                # No feature dropped at max_zoom (over-zoomed by the map beyond it)
+                min_side = (
+                    0
+                    if zoom == max_zoom
+                    else options.get("min_feature_pixels", 0)
+                    * ground_resolution(zoom, latitude)
+                )
+                # Tiles covered by the layer at this zoom level : bands of tile columns above TILES_PER_JOB
+                # (the max zoom level holds most of the tiles, it would run on one process)
+                width = tile_width(zoom)
+                tiles = (math.floor(maxx / width) - math.floor(minx / width) + 1) * (
+                    math.floor(maxy / width) - math.floor(miny / width) + 1
+                )
+                bands = (
+                    tile_column_bands(
+                        staged.total_bounds,
+                        zoom,
+                        min(workers, math.ceil(tiles / TILES_PER_JOB)),
+                    )
+                    if workers > 1 and tiles > TILES_PER_JOB
+                    else [None]
+                )
+                for band, tile_columns in enumerate(bands):
+                    jobs.append(
+                        {
+                            "staging_path": staging_path,
+                            "layer": layer,
+                            "columns": columns,
+                            "zoom": zoom,
+                            "tile_columns": tile_columns,
+                            "min_area": min_side**2,
+                            "simplification": (
+                                simplification_max_zoom
+                                if zoom == max_zoom
+                                else simplification
+                            ),
+                            "max_tile_size": max_tile_size,
+                            "output_path": os.path.join(
+                                tmp_dir, "{}_{}_{}.mbtiles".format(layer, zoom, band)
+                            ),
+                        }
+                    )
+            del staged
+
+        debugLog(
+            style.YELLOW,
+            "Vector tiles : {} jobs (layer x zoom x band of tile columns) on {} workers".format(
+                len(jobs), workers
+            ),
+            logging.INFO,
+        )
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                parts = list(executor.map(_write_zoom_tiles, jobs))
+        else:
+            parts = [_write_zoom_tiles(job) for job in jobs]
+
+        merge_mbtiles(
+            [part for part in parts if part],
+            output_path,
+            os.path.splitext(os.path.basename(output_path))[0],
+            feature_counts,
+        )
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    return output_path
@@ -2,49 +2,483 @@ from shapely.geometry import (
     mapping,
     shape,
 )
+import time
+import glob
 import numpy as np
 import pandas as pd
 import geopandas as gpd
 
-# from rasterio.mask import mask
+from rasterio.mask import mask, raster_geometry_mask
 from rasterio.plot import show
-from rasterio.features import shapes
+from rasterio.features import shapes, sieve
+from scipy.ndimage import binary_closing, binary_opening, generate_binary_structure
 from scipy.sparse import coo_matrix
 from scipy.sparse.csgraph import connected_components
 
 from utils.functions import *
+from utils.stage_cache import StageCache
+from utils.mask_index import IndexMasques
+from utils.run_history import record_stage
+from utils.cost_model import EtaTracker
+from utils.work_queue import Heartbeat, worker_id
+
+from utils.constants import (
+    BASE_DIR,
+    INPUT_DATA_DIR,
+    OUTPUT_DATA_DIR,
+    RATE_M2_TO_KM2,
+    RATE_MK2_TO_HA,
+    WFS_COMMUNES_LAYER,
+    WFS_COMMUNES_URL,
+)
 
-from utils.constants import BASE_DIR, INPUT_DATA_DIR, OUTPUT_DATA_DIR
+# Légende des classes du raster
+CODE_CLASSES = {
+    1: "Herbacées",
+    2: "Buisson (<1,5m)",
+    3: "Arbustes (1,5m - 5m)",
+    4: "Petits arbres (5 - 15m)",
+    5: "Grands arbres (>15m)",
+}
+
+# Mapping : classe initiale → groupe fusionné (regroupement de la classe 2 & 3 et 4 & 5)
+FUSION_CLASSES = {
+    1: "herbacee",
+    2: "arbustif",  # 2 + 3
+    3: "arbustif",
+    4: "arborescent",  # 4 + 5
+    5: "arborescent",
+}
+
+# Types compacts des attributs (catégories fixes : mêmes codes pour toutes les communes)
+TYPE_NOM_CLASSE = pd.CategoricalDtype(list(CODE_CLASSES.values()))
+TYPE_STRATE = pd.CategoricalDtype(sorted(set(FUSION_CLASSES.values())))
+
+# Paramètres par défaut des étapes (ils entrent dans la clé du cache d'étapes)
+PARAMS_ETAPES = {
+    "etape3": {"nodata": 255, "sieve_min_pixels": 0, "rayon_morpho": 0},
+    "etape4": {"grid_size": None},
+    "etape5": {"buffer_dist": 0.2, "methode_union": "unary", "tampon_final": True},
+    "etape6": {
+        "seuil": 150,
+        "tol_base": 0.4,
+        "tol_min": 0.1,
+        "tol_max": 1.0,
+        "rayon_lissage": 1.0,
+        "methode_simplification": "geom",
+        "tampon": 0.0,
+    },
+    "etape7": {
+        "surface_min": 2.5,
+        "trou_min": 2.0,
+        "methode_union": "unary",
+        "taille_partition": None,
+        "nb_workers": 1,
+    },
+}
+
+ETAPES_CACHEES = ("etape4", "etape5", "etape6", "etape7")
+
+
+def nettoyage_raster(raster_clipped, nodata=255, sieve_min_pixels=0, rayon_morpho=0):
+    """
+    Pré-nettoyage du raster classé avant la vectorisation (moins de polygones, plus lisses)
+    - sieve_min_pixels : les taches de moins de N pixels sont absorbées par leur voisine (rasterio sieve)
+    - rayon_morpho : ouverture puis fermeture morphologique par classe (rayon en pixels),
+      les pixels retirés par l'ouverture d'une classe ne sont réattribués que par la fermeture
+      d'une autre classe (sinon ils retrouvent leur valeur), le NODATA n'est jamais comblé
+    """
+    valide = raster_clipped != nodata
+    raster_net = raster_clipped
+
+    # 1. Sieve : suppression des petites taches
+    if sieve_min_pixels and sieve_min_pixels > 1:
+        raster_net = sieve(raster_net, size=sieve_min_pixels, mask=valide)
+        raster_net = np.where(valide, raster_net, raster_clipped)
+
+    # 2. Ouverture / fermeture par classe
+    if rayon_morpho and rayon_morpho > 0:
+        structure = generate_binary_structure(2, 1)
+        classes = np.unique(raster_net[valide])
+        non_attribue = np.zeros(raster_net.shape, dtype=bool)
+        ouvertures = {}
+
+        # Ouverture : on retire les excroissances et pixels isolés de chaque classe
+        for c in classes:
+            masque_classe = raster_net == c
+            ouvert = binary_opening(masque_classe, structure, iterations=rayon_morpho)
+            non_attribue |= masque_classe & ~ouvert
+            ouvertures[c] = ouvert
+
+        # Fermeture : chaque classe comble ses creux sur les pixels non attribués
+        raster_morpho = np.where(non_attribue, 0, raster_net).astype(raster_net.dtype)
+        for c in classes:
+            ferme = binary_closing(ouvertures[c], structure, iterations=rayon_morpho)
+            comble = ferme & non_attribue
+            raster_morpho[comble] = c
+            non_attribue &= ~comble
+        del ouvertures
+
+        # Les pixels restés sans classe retrouvent leur valeur
+        raster_net = np.where(non_attribue, raster_net, raster_morpho)
+
+    return raster_net
+
+
+def etape3_nettoyage(raster_clipped, nodata=255, sieve_min_pixels=0, rayon_morpho=0):
+    """
+    Etape 3 : Nettoyer les valeurs inutiles (NODATA → NaN), avec pré-nettoyage raster facultatif
+    """
+    # 1. Vérifier les valeurs présentes
+    valeurs = np.unique(raster_clipped)
+    print("Valeurs uniques avant nettoyage :", valeurs)
+
+    # 1bis. Pré-nettoyage (sieve + morphologie) si demandé
+    if sieve_min_pixels or rayon_morpho:
+        raster_clipped = nettoyage_raster(
+            raster_clipped,
+            nodata=nodata,
+            sieve_min_pixels=sieve_min_pixels,
+            rayon_morpho=rayon_morpho,
+        )
 
+    # 2. Convertir 255 (ou autre code NODATA si besoin) en NaN
+    # NB : parfois, c’est 0 qui est utilisé comme NODATA dans les GeoTIFF
+    # donc on adapte selon ce que tu observes :
+    raster_clean = np.where(raster_clipped == nodata, np.nan, raster_clipped)
+
+    # 3. Revoir les valeurs restantes
+    valeurs_utiles = np.unique(raster_clean[~np.isnan(raster_clean)])
+    print("Valeurs uniques après nettoyage :", valeurs_utiles)
+
+    return raster_clean
+
+
+def etape4_vectorisation(raster_clean, transform_clipped, grid_size=None):
+    """
+    Etape 4 : Vectoriser le raster sur la zone
+    grid_size : grille de précision appliquée dès l'ingestion (ex : 0.01 = 1 cm, None = pas d'accrochage)
+    """
+    # 1. Convertir en masque binaire si on veut ignorer les NaN
+    masque = ~np.isnan(raster_clean)
+
+    # 2. Extraire les formes (géométries) et leurs valeurs
+    geometries = []
+    classes = []
+    for geom, value in shapes(
+        raster_clean.astype(np.int16), mask=masque, transform=transform_clipped
+    ):  # géoréférence les pixels
+        geometries.append(shape(geom))
+        classes.append(value)
+
+    gdf_vect = gpd.GeoDataFrame(
+        {"classe": np.asarray(classes, dtype=np.int8)},
+        geometry=geometries,
+        crs="EPSG:2154",
+    )
+    del geometries, classes
 
-"""
-Nom : vegeBigProcess (à changer à l'avenir...)
-Description : Fonction générique de vectorisation d'un raster en découpage par commune
-Paramètres :
-    raster* : Variable de raster d'entrée ouvert avec rasterio (obligatoire)
-        Exemple : raster = rasterio.open(raster_path)
-    specificComList : Liste des communes à traiter (facultatif : si par renseigné, traitement de toutes les communes par défaut)
-        Exemple : specificComList = ['69072', '69286']
-"""
+    # 3. Accrocher les coordonnées à la grille de précision (bruit flottant des pixels)
+    if grid_size:
+        nb_sommets = count_vertices(gdf_vect)
+        gdf_vect = snap_to_grid(gdf_vect, grid_size)
+        print(
+            "📐 Accrochage grille",
+            grid_size,
+            ": sommets",
+            nb_sommets,
+            "→",
+            count_vertices(gdf_vect),
+        )
 
+    # 4. Nom de la classe (catégoriel, sans jointure ni copie)
+    gdf_vect["nom"] = gdf_vect["classe"].map(CODE_CLASSES).astype(TYPE_NOM_CLASSE)
+
+    return gdf_vect
+
+
+def etape5_fusion(
+    vege_vect_zone,
+    buffer_dist=0.2,
+    methode_union="unary",
+    taille_pixel=None,
+    tampon_final=True,
+):
+    """
+    Etape 5 : (opti MiaouGPT) Nettoyer les surfaces et les éléments
+    Fusion des entités voisines (après buffer) de même classe
+    ⚠️ modifie `vege_vect_zone` sur place (pas de copie, l'étape 4 n'est plus utilisée ensuite)
+    methode_union : "unary" (union générale) ou "coverage" (union de couverture, repli sur "unary")
+    taille_pixel : pas de densification des polygones du raster pour l'union de couverture
+    tampon_final : en union de couverture, False rend la couverture fusionnée sans le buffer
+    (appliqué par l'étape 6 après la simplification de couverture)
+    """
+    # 1) Buffer vectorisé (assure-toi d'être en mètres ; sinon reprojette avant)
+    #    En union de couverture, pas de buffer des petits polygones :
+    #    intersects(buffer(a, d), buffer(b, d)) <=> distance(a, b) <= 2d
+    vege_buffer_zone = vege_vect_zone
+    if methode_union == "coverage":
+        jointure = {"predicate": "dwithin", "distance": 2 * buffer_dist}
+    else:
+        vege_buffer_zone["geometry"] = vege_buffer_zone.geometry.buffer(buffer_dist)
+        jointure = {"predicate": "intersects"}
+
+    # 2) Auto-jointure spatiale sur l'index (STRtree) : paires de positions qui s'intersectent
+    #    (pas de GeoDataFrame de paires, seulement deux tableaux d'entiers)
+    gauche, droite = vege_buffer_zone.sindex.query(
+        vege_buffer_zone.geometry, **jointure
+    )
 
-def vegeBigProcess(raster, specificComList=None):
+    # 3) Exclure les self-joins et 4) garder seulement les paires de même classe
+    classes = vege_buffer_zone["classe"].to_numpy()
+    garder = (gauche != droite) & (classes[gauche] == classes[droite])
+    gauche, droite = gauche[garder], droite[garder]
+
+    # 5) Calcul des composantes connexes PAR CLASSE
+    groupes = np.full(len(vege_buffer_zone), -1, dtype=np.int32)
+    for cls in np.unique(classes):
+        positions = np.flatnonzero(classes == cls)
+        pos = np.full(len(classes), -1, dtype=np.int64)  # map position→[0..k-1]
+        pos[positions] = np.arange(len(positions))
+
+        p = classes[gauche] == cls
+        if not p.any():
+            groupes[positions] = np.arange(len(positions))
+            continue
+
+        rows = pos[gauche[p]]
+        cols = pos[droite[p]]
+
+        data = np.ones(len(rows), dtype=np.uint8)
+        k = len(positions)
+        A = coo_matrix((data, (rows, cols)), shape=(k, k))
+        A = A + A.T
+
+        _, labels = connected_components(A, directed=False, return_labels=True)
+        groupes[positions] = labels
+    vege_buffer_zone["groupe"] = groupes
+    del gauche, droite, groupes
+
+    # 6) Dissolve par groupe et classe
+    if methode_union == "coverage":
+        # union(buffer(p)) == buffer(union(p)) : on dissout les polygones d'origine,
+        # qui forment une couverture, puis on applique le buffer aux entités fusionnées
+        # La densification au pas du pixel aligne les sommets des arêtes communes
+        if taille_pixel:
+            vege_buffer_zone["geometry"] = vege_buffer_zone.geometry.segmentize(
+                taille_pixel
+            )
+        # Couverture garantie par construction : seul le contrôle du résultat est fait
+        vege_fusion = dissolve_coverage(
+            vege_buffer_zone,
+            by=["classe", "groupe"],
+            as_index=False,
+            valider_couverture=False,
+        )
+        if tampon_final:
+            vege_fusion["geometry"] = vege_fusion.geometry.buffer(buffer_dist)
+    else:
+        vege_fusion = vege_buffer_zone.dissolve(by=["classe", "groupe"], as_index=False)
 
-    # DEBUG
-    # print(raster)
-    # print(specificComList)
+    # 7) Réaffecter les noms de classes
+    vege_fusion["classe_nom"] = (
+        vege_fusion["classe"].map(CODE_CLASSES).astype(TYPE_NOM_CLASSE)
+    )
 
-    ### Etape 2 on découpe au territoire
-    print("ℹ️  Début du découpage du traitement pour chaque commune")
+    return vege_fusion
+
+
+def buffer_smooth(geom, r=1.0):
+    """
+    Lissage "arrondi" avec buffer+ puis buffer-
+    """
+    return geom.buffer(r).buffer(-r)
+
+
+def etape6_lissage(
+    vege_fusion,
+    seuil=150,
+    tol_base=0.4,
+    tol_min=0.1,
+    tol_max=1.0,
+    rayon_lissage=1.0,
+    methode_simplification="geom",
+    tampon=0.0,
+):
+    """
+    Etape 6 : Simplification des entités (retirer l'effet dent de scie) puis lissage
+    ⚠️ modifie `vege_fusion` sur place (géométries remplacées, pas de copie du GeoDataFrame)
+    methode_simplification : "geom" (simplifier_geom entité par entité) ou "coverage" (simplifier_couverture :
+    les entités de l'étape 5 sans buffer forment une couverture, arêtes communes simplifiées une seule fois)
+    - "geom" : lissage buffer(tampon + rayon_lissage) puis buffer(-rayon_lissage)
+    - "coverage" : ni buffer ni lissage (rayon_lissage ignoré), la sortie reste une couverture (ni trou ni
+      recouvrement entre strates) ; sa surface est celle des pixels, sans le buffer de l'étape 5
+    tampon : buffer de l'étape 5 non appliqué (étape 5 avec tampon_final=False). En mode "coverage", les
+    sommets sont comptés sous ce buffer pour la tolérance (comme simplifier_geom les voit par défaut)
+    """
+    if methode_simplification == "coverage":
+        vege_fusion["geometry"] = simplifier_couverture(
+            vege_fusion.geometry.to_numpy(),
+            seuil=seuil,
+            tol_base=tol_base,
+            tol_min=tol_min,
+            tol_max=tol_max,
+            tampon=tampon,
+        )
+        # Pas de lissage par buffer : il recréerait des recouvrements entre strates voisines
+    else:
+        # Application à tout le GeoDataFrame
+        vege_fusion["geometry"] = vege_fusion.geometry.apply(
+            lambda g: simplifier_geom(
+                g, seuil=seuil, tol_base=tol_base, tol_min=tol_min, tol_max=tol_max
+            )
+        )
 
-    # On récupère le surfacique de la Métropole de Lyon
-    communes_larges = wfs2gp_df(
-        "metropole-de-lyon:adr_voie_lieu.adrcommunes_2024",
-        "https://data.grandlyon.com/geoserver/metropole-de-lyon/ows?SERVICE=WFS",
-        reprojMetro=True,
-        targetProj="EPSG:2154",
+        # vege_fusion.plot(column="classe", cmap=cmap, legend=True)
+
+        # Lissage "arrondi" (buffer+ puis buffer-, cf. buffer_smooth) vectorisé
+        vege_fusion["geometry"] = vege_fusion.geometry.buffer(
+            tampon + rayon_lissage
+        ).buffer(-rayon_lissage)
+
+    return vege_fusion
+
+
+def etape7_regroupement(
+    vege_lisse_buffer,
+    surface_min=2.5,
+    trou_min=2.0,
+    methode_union="unary",
+    taille_partition=None,
+    nb_workers=1,
+):
+    """
+    Etape 7 : Regroupement des entités par strate et nettoyage des petites géométries / petits trous
+    methode_union : "unary" (union générale) ou "coverage" (union de couverture, repli sur "unary"), la
+    couverture n'est conservée par l'étape 6 qu'en simplification de couverture ou sans lissage
+    (rayon_lissage=0, tampon=0, cf. parametresEtapes)
+    taille_partition : côté (m) des cellules de l'union partitionnée (None = union globale par strate),
+    les cellules sont traitées par `nb_workers` threads
+    """
+    # Regroupement de la classe 2 & 3 et 4 & 5 (⚠️ modifie `vege_lisse_buffer` sur place)
+
+    # Appliquer la fusion
+    vege_lisse_buffer["strate"] = (
+        vege_lisse_buffer["classe"].map(FUSION_CLASSES).astype(TYPE_STRATE)
+    )
+    if taille_partition:
+        # Union par cellules puis fusion des seules entités à cheval : évite les MultiPolygon géantes
+        vege_groupes = dissolve_partitionne(
+            vege_lisse_buffer,
+            by="strate",
+            taille_cellule=taille_partition,
+            nb_workers=nb_workers,
+            methode_union=methode_union,
+        )
+    else:
+        if methode_union == "coverage":
+            vege_groupes = dissolve_coverage(
+                vege_lisse_buffer, by="strate", as_index=False
+            )
+        else:
+            vege_groupes = vege_lisse_buffer.dissolve(
+                by="strate", as_index=False, observed=True
+            )
+        vege_groupes = vege_groupes.explode(index_parts=False, ignore_index=True)
+    del vege_lisse_buffer
+    # vege_groupes.plot(column="strate", cmap="Set2", legend=True)
+
+    ### Nettoyage des géométries trop petites
+    surfaces = vege_groupes.geometry.area.to_numpy()
+    vege_groupes["surface_m2"] = surfaces.astype(np.float32)
+
+    # Filtrer uniquement les entités dont la surface est suffisante (surface en float64)
+    vege_clean = vege_groupes[surfaces >= surface_min]
+    del vege_groupes, surfaces
+
+    ### Nettoyage des petits trous
+    # ⚠️ call de la fonction
+
+    vege_clean["geometry"] = vege_clean.geometry.apply(
+        lambda g: remove_small_holes(g, area_thresh=trou_min)
     )
 
+    return vege_clean
+
+
+def rapportMemoire(gdf, nb_sommets=None):
+    """
+    Empreinte mémoire après une étape : RSS du processus, attributs du GeoDataFrame (deep)
+    et estimation des géométries (16 octets par sommet, coordonnées xy en float64)
+    """
+    if nb_sommets is None:
+        nb_sommets = count_vertices(gdf)
+    attributs = gdf.drop(columns=gdf.geometry.name).memory_usage(deep=True).sum()
+    rss = rss_processus()
+    return "RSS {} Mo, attributs {:.0f} Ko, géométries ~{:.1f} Mo".format(
+        "?" if rss is None else round(rss / 1024**2),
+        attributs / 1024,
+        nb_sommets * 16 / 1024**2,
+    )
+
+
+def clesEtapes(raster_clipped, transform_clipped, geom, params):
+    """
+    Clés de cache chaînées des étapes 4 à 7 : la clé d'une étape dépend de la clé précédente
+    et de ses propres paramètres (changer les paramètres de l'étape 6 invalide donc 6 et 7)
+    La clé de base couvre la fenêtre raster, la géométrie et les paramètres de l'étape 3
+    """
+    cle = StageCache.key(
+        raster_clipped.tobytes(),
+        str(raster_clipped.dtype),
+        list(raster_clipped.shape),
+        list(transform_clipped)[:6],
+        geom.wkb,
+        params["etape3"],
+    )
+    cles = {}
+    for etape in ETAPES_CACHEES:
+        cle = StageCache.key(cle, etape, params[etape])
+        cles[etape] = cle
+    return cles
+
+
+def parametresEtapes(params_etapes=None):
+    """
+    Paramètres des étapes : défauts (PARAMS_ETAPES) + surcharges
+    """
+    params = {etape: dict(valeurs) for etape, valeurs in PARAMS_ETAPES.items()}
+    for etape, valeurs in (params_etapes or {}).items():
+        params[etape].update(valeurs)
+    # Union de couverture à l'étape 7 seulement si l'étape 6 garde une couverture (simplification de
+    # couverture ou pas de lissage par buffer) : sinon la validation échoue toujours et le repli sur
+    # l'union générale coûte plus cher
+    lissage = params["etape6"]["methode_simplification"] != "coverage" and (
+        params["etape6"]["rayon_lissage"] or params["etape6"]["tampon"]
+    )
+    if params["etape7"]["methode_union"] == "coverage" and lissage:
+        debugLog(
+            style.YELLOW,
+            "Etape 7 : union de couverture ignorée (lissage par buffer à l'étape 6), union générale",
+            logging.WARN,
+        )
+        params["etape7"]["methode_union"] = "unary"
+    return params
+
+
+def chargerCommunes(communes_larges=None):
+    """
+    Communes de la Métropole de Lyon à traiter (import depuis le WFS open-data si non fournies)
+    """
+    # On récupère le surfacique de la Métropole de Lyon
+    if communes_larges is None:
+        communes_larges = wfs2gp_df(
+            WFS_COMMUNES_LAYER,
+            WFS_COMMUNES_URL,
+            reprojMetro=True,
+            targetProj="EPSG:2154",
+        )
+
     # On ne garde que les communes de la Métropole de Lyon
     communes = communes_larges[communes_larges["communegl"] == True]
 
@@ -56,329 +490,753 @@ def vegeBigProcess(raster, specificComList=None):
     # print(communes)
 
     print("✅ Chargement des communes terminé")
+    return communes
 
-    for index, row in communes.iterrows():
-
-        # FIXME: Revoir l'import dans la loop mais sinon Python ne la voit pas...
-        from rasterio.mask import mask
-
-        # DEBUG print commune row
-        # print(row)
 
-        # Start Timer
-        loopTimerName = (
-            "loopTimer_" + row["insee"] + "_" + row["trigramme"] + "_" + row["nom"]
-        )
-        looptimer = startTimerLog(loopTimerName)
+def communeIgnoree(index, row, specificComList, looptimer):
+    """
+    Vérifie s'il faut tester une liste spécifique, et si la commune est dans cette liste
+    """
+    if specificComList and not row["insee"] in specificComList:
         print(
-            "ℹ️  Traitement appliqué à la commune n°",
+            "☑️  Commune n°",
             index,
             ":",
             row["insee"],
             row["trigramme"],
             row["nom"],
+            "ignorée",
         )
-
-        # Vérifie s'il faut tester une liste spécifique, et si la commune est dans cette liste
-        if specificComList:
-
-            if not row["insee"] in specificComList:
-                print(
-                    "☑️  Commune n°",
-                    index,
-                    ":",
-                    row["insee"],
-                    row["trigramme"],
-                    row["nom"],
-                    "ignorée",
-                )
-                # Fin du timer de l'item de loop ignoré
-                endTimerLog(looptimer)
-                # Skip current commune
-                continue
-
-        # Get current Geom
-        currentGeom = row["geometry"]
-        # print(currentGeom)
-
-        ### Clipper le raster à la geom séléctionnée
+        # Fin du timer de l'item de loop ignoré (hors historique du run)
+        endTimerLog(looptimer, historique=False)
+        return True
+    return False
+
+
+def lectureCommune(raster, geom, index_masques=None):
+    """
+    Fenêtre raster de la commune (pixels hors commune à nodata), son transform et la durée de lecture
+    """
+    debut = time.perf_counter()
+    if index_masques is not None:
+        raster_clipped, transform_clipped = index_masques.lire(raster, geom)
+    else:
         raster_clipped, transform_clipped = mask(
-            dataset=raster, shapes=[currentGeom], crop=True
+            dataset=raster, shapes=[geom], crop=True
         )
         raster_clipped = raster_clipped[0]
-
-        # =================================
-        # Starting geom process
-        # =================================
-
+    return raster_clipped, transform_clipped, time.perf_counter() - debut
+
+
+def traitementCommune(
+    raster_clipped, transform_clipped, currentGeom, params, cache, suffixeCom
+):
+    """
+    Etapes 3 à 7 sur la fenêtre raster d'une commune, avec reprise depuis le cache d'étapes
+    Retour : GeoDataFrame de la commune vectorisée
+    """
+    # Cache : on reprend depuis la dernière étape encore valide
+    cles = None
+    etapes_a_faire = list(ETAPES_CACHEES)
+    resultat = None
+    if cache is not None:
+        cles = clesEtapes(raster_clipped, transform_clipped, currentGeom, params)
+        for etape in reversed(ETAPES_CACHEES):
+            if cache.has(cles[etape]):
+                resultat = cache.get(cles[etape])
+                if resultat is not None:
+                    etapes_a_faire = list(
+                        ETAPES_CACHEES[ETAPES_CACHEES.index(etape) + 1 :]
+                    )
+                    print("♻️  Reprise depuis le cache après", etape)
+                    break
+
+    if "etape4" in etapes_a_faire:
         ### Etape 3 : Nettoyer les valeurs inutiles
         print("ℹ️  Début Etape 3 : Nettoyer les valeurs inutiles")
-
-        # Timer
-        etape3Com = "etape3_" + row["insee"] + "_" + row["trigramme"] + "_" + row["nom"]
-        etape3timer = startTimerLog(etape3Com)
-
-        # 1. Vérifier les valeurs présentes
-        valeurs = np.unique(raster_clipped)
-        print("Valeurs uniques avant nettoyage :", valeurs)
-
-        # 2. Convertir 255 (ou autre code NODATA si besoin) en NaN
-        # NB : parfois, c’est 0 qui est utilisé comme NODATA dans les GeoTIFF
-        # donc on adapte selon ce que tu observes :
-        raster_clean = np.where(raster_clipped == 255, np.nan, raster_clipped)
-
-        # 3. Revoir les valeurs restantes
-        valeurs_utiles = np.unique(raster_clean[~np.isnan(raster_clean)])
-        print("Valeurs uniques après nettoyage :", valeurs_utiles)
-
-        # 4. Calculer extent à partir du transform raster clippé
-        extent = (
-            transform_clipped[2],  # minX
-            transform_clipped[2]
-            + raster_clipped.shape[1] * transform_clipped[0],  # maxX
-            transform_clipped[5]
-            + raster_clipped.shape[0] * transform_clipped[4],  # minY
-            transform_clipped[5],  # maxY
-        )
-
-        endTimerLog(etape3timer)
+        etape3timer = startTimerLog("etape3_" + suffixeCom)
+        raster_clean = etape3_nettoyage(raster_clipped, **params["etape3"])
+        endTimerLog(etape3timer, pixels=raster_clipped.size)
         print("✅ Etape 3 terminée")
 
-        ### Etape 4 : Vectoriser le raster sur la zone
-        print("ℹ️  Début Etape 4 : Vectoriser le raster sur la zone")
-
-        # Timer
-        etape4Com = "etape4_" + row["insee"] + "_" + row["trigramme"] + "_" + row["nom"]
-        etape4timer = startTimerLog(etape4Com)
-
-        # 1. Convertir en masque binaire si on veut ignorer les NaN
-        mask = ~np.isnan(raster_clean)
-
-        # 2. Extraire les formes (géométries) et leurs valeurs
-        shape_gen = (
-            {"geometry": shape(geom), "properties": {"classe": int(value)}}
-            for geom, value in shapes(
-                raster_clean.astype(np.int16), mask=mask, transform=transform_clipped
-            )  # géoréférence les pixels
+    for etape in etapes_a_faire:
+        print("ℹ️  Début", etape.capitalize())
+        etapetimer = startTimerLog(etape + "_" + suffixeCom)
+        # Mesures de l'historique du run : entités en entrée (pixels pour la vectorisation)
+        mesures = (
+            {"pixels": raster_clean.size}
+            if etape == "etape4"
+            else {"features_in": len(resultat)}
         )
 
-        gdf_vect = gpd.GeoDataFrame.from_features(shape_gen, crs="EPSG:2154")
-
-        code_classes = {
-            1: "Herbacées",
-            2: "Buisson (<1,5m)",
-            3: "Arbustes (1,5m - 5m)",
-            4: "Petits arbres (5 - 15m)",
-            5: "Grands arbres (>15m)",
-        }
-
-        df_legend = pd.DataFrame(list(code_classes.items()), columns=["classe", "nom"])
-
-        vege_vect_zone = gdf_vect.merge(df_legend, on="classe", how="left")
-
-        endTimerLog(etape4timer)
-        print("✅ Etape 4 terminée")
-
-        ### Etape 5 : Nettoyer les surfaces et les éléments
-        # print("ℹ️  Début Etape 5 : Nettoyer les surfaces et les éléments")
-
-        # # Timer
-        # etape5Com = "etape5_" + row['insee'] + '_' + row['trigramme'] + '_' + row['nom']
-        # etape5timer = startTimerLog(etape5Com)
+        if etape == "etape4":
+            resultat = etape4_vectorisation(
+                raster_clean,
+                transform_clipped,
+                grid_size=params["etape4"]["grid_size"],
+            )
+            del raster_clean
+        elif etape == "etape5":
+            resultat = etape5_fusion(
+                resultat,
+                taille_pixel=abs(transform_clipped[0]),
+                **params["etape5"],
+            )
+        elif etape == "etape6":
+            resultat = etape6_lissage(resultat, **params["etape6"])
+        elif etape == "etape7":
+            resultat = etape7_regroupement(resultat, **params["etape7"])
+
+        if cache is not None:
+            cache.put(cles[etape], resultat)
+
+        nb_sommets = count_vertices(resultat)
+        print(
+            "📐",
+            etape.capitalize(),
+            ":",
+            len(resultat),
+            "entités,",
+            nb_sommets,
+            "sommets",
+        )
+        print("🧠", etape.capitalize(), ":", rapportMemoire(resultat, nb_sommets))
+        endTimerLog(etapetimer, features_out=len(resultat), **mesures)
+        print("✅", etape.capitalize(), "terminée")
 
-        # # Appliquer un petit buffer autour des entités
-        # vege_buffer_zone = vege_vect_zone.copy()
-        # vege_buffer_zone.geometry = vege_buffer_zone.geometry.buffer(0.2)
+    return resultat
 
-        # # faire une jointure combinée spatiale ET attributaire = fusion conditionnelle
-        # # Pas possible nativement dans géopandas donc on doit passer par une autre façon de faire
 
-        # # Ajouter un identifiant de "groupe spatial" basé sur intersection
-        # vege_buffer_zone["groupe"] = -1  # valeur temporaire
+def exportCommune(vege_clean, exportName, suffixeCom, export, format_export):
+    """
+    Etape finale : export Shapefile de la commune
+    (GeoPackage : toutes les communes sont écrites en une fois après la boucle)
+    """
+    print("ℹ️  Début Etape finale : Export de la commune")
 
-        # # compteur de groupe
-        # groupe_id = 0
+    # Timer
+    etapeFintimer = startTimerLog("etapeFin_" + suffixeCom)
 
-        # for buffIdx, buffRow in vege_buffer_zone.iterrows():
-        #     if vege_buffer_zone.loc[buffIdx, "groupe"] != -1:
-        #         continue  # déjà affecté
+    # Export (facultatif si le résultat est utilisé en mémoire)
+    if export and format_export == "shp":
+        exportPath = os.path.join(OUTPUT_DATA_DIR, exportName)
+        vege_clean.to_file(filename=exportPath, encoding="utf-8")
 
-        #     # Sélection des voisins spatiaux qui ont la même classe
-        #     same_class = vege_buffer_zone[
-        #         (vege_buffer_zone["classe"] == buffRow["classe"])
-        #         & (vege_buffer_zone.geometry.intersects(buffRow.geometry))
-        #     ]
+    endTimerLog(etapeFintimer, features_in=len(vege_clean))
+    print("✅ Etape finale terminée")
 
-        #     indices = same_class.index.tolist()
-        #     vege_buffer_zone.loc[indices, "groupe"] = groupe_id
-        #     groupe_id += 1
 
-        # # Fusionner par groupe et classe
-        # vege_fusion = vege_buffer_zone.dissolve(by=["classe", "groupe"], as_index=False)
+"""
+Nom : vegeBigProcess (à changer à l'avenir...)
+Description : Fonction générique de vectorisation d'un raster en découpage par commune
+Paramètres :
+    raster* : Variable de raster d'entrée ouvert avec rasterio (obligatoire)
+        Exemple : raster = rasterio.open(raster_path)
+    specificComList : Liste des communes à traiter (facultatif : si par renseigné, traitement de toutes les communes par défaut)
+        Exemple : specificComList = ['69072', '69286']
+    communes_larges : GeoDataFrame des communes déjà chargé (facultatif : si non renseigné, import depuis le WFS open-data)
+    export : Export d'un Shapefile par commune dans OUTPUT_DATA_DIR (facultatif : True par défaut)
+    params_etapes : Surcharge des paramètres des étapes (facultatif : cf. PARAMS_ETAPES)
+        Exemple : params_etapes = {'etape6': {'tol_base': 0.6}, 'etape7': {'surface_min': 4.0}}
+    cache : Cache des étapes intermédiaires (facultatif : StageCache, reprise à la première étape invalidée)
+        Exemple : cache = StageCache(STAGE_CACHE_DIR, STAGE_CACHE_MAX_SIZE)
+    format_export : Format de l'export (facultatif : "shp" par défaut, un Shapefile par commune)
+        "gpkg" : une seule couche dans vegetation_stratifiee_2018_2154.gpkg (colonnes insee et trigramme)
+        "gpkg_communes" : une couche par commune dans vegetation_stratifiee_2018_2154.gpkg
+    millesime : Millésime du raster, utilisé dans les noms d'export (facultatif : "2018" par défaut)
+    index_masques : Index des fenêtres et masques des communes (facultatif : recalculés à chaque passage sinon)
+        Exemple : index_masques = IndexMasques(MASK_INDEX_DIR)
+    prefetch : Nombre de communes lues à l'avance par un thread de lecture pendant le traitement
+               de la commune courante (facultatif : 0 par défaut, lecture séquentielle)
+    modele_cout : Modèle de coût des communes (facultatif : ordre du WFS et pas d'ETA par défaut)
+        Les communes sont traitées de la plus coûteuse à la moins coûteuse, avec l'ETA après chaque commune
+        Exemple : modele_cout = CostModel() (cf. utils/cost_model.py)
+    file_travail : File de travail partagée entre processus (facultatif : toutes les communes dans ce processus par défaut)
+        Les communes sont réclamées une à une (bail + heartbeat, reprise des communes d'un processus arrêté)
+        Exemple : file_travail = WorkQueue(os.path.join(WORK_QUEUE_DIR, "vege_2018")) (cf. utils/work_queue.py)
+Retour :
+    Dictionnaire {nom du fichier d'export : GeoDataFrame de la commune vectorisée}
+"""
 
-        # # Réaffecter les noms de classes
-        # vege_fusion["classe_nom"] = vege_fusion["classe"].map(code_classes)
 
-        # endTimerLog(etape5timer)
-        # print("✅ Etape 5 terminée")
+def vegeBigProcess(
+    raster,
+    specificComList=None,
+    communes_larges=None,
+    export=True,
+    params_etapes=None,
+    cache=None,
+    format_export="shp",
+    millesime="2018",
+    index_masques=None,
+    prefetch=0,
+    modele_cout=None,
+    file_travail=None,
+):
 
-        ### Etape 5 : (opti MiaouGPT) Nettoyer les surfaces et les éléments
-        print("ℹ️  Début Etape 5 : Nettoyer les surfaces et les éléments")
+    # DEBUG
+    # print(raster)
+    # print(specificComList)
 
-        # Timer
-        etape5Com = "etape5_" + row["insee"] + "_" + row["trigramme"] + "_" + row["nom"]
-        etape5timer = startTimerLog(etape5Com)
+    # Paramètres des étapes (défauts + surcharges)
+    params = parametresEtapes(params_etapes)
 
-        # 1) Buffer vectorisé (assure-toi d'être en mètres ; sinon reprojette avant)
-        vege_buffer_zone = vege_vect_zone.copy()
-        vege_buffer_zone["geometry"] = vege_buffer_zone.geometry.buffer(0.2)
+    ### Etape 2 on découpe au territoire
+    print("ℹ️  Début du découpage du traitement pour chaque commune")
+    communes = chargerCommunes(communes_larges)
 
-        # 2) Auto-sjoin spatial (pairs de géométries qui s’intersectent)
-        #    - how='inner' évite les non-correspondances
-        #    - predicate='intersects' s'appuie sur l'index spatial (STRtree)
-        pairs = gpd.sjoin(
-            vege_buffer_zone[["geometry"]],  # on ne garde QUE geometry ici
-            vege_buffer_zone[["geometry"]],  # idem à droite
-            how="inner",
-            predicate="intersects",
+    # Coût estimé des communes : les plus coûteuses d'abord, ETA après chaque commune
+    eta = None
+    if modele_cout is not None:
+        selection = communes
+        if specificComList:
+            selection = communes[communes["insee"].isin(specificComList)]
+        estimation = modele_cout.estimate(raster, selection)
+        print(
+            "⏳ Coût estimé : {:.0f} s pour {} communes (modèle calé sur {} communes de l'historique)".format(
+                estimation["cost_s"].sum(), len(estimation), modele_cout.calibrated_on
+            )
+        )
+        communes = pd.concat(
+            [communes.loc[estimation.index], communes.drop(index=estimation.index)]
+        )
+        eta = EtaTracker(estimation["cost_s"])
+
+    # Mode distribué : communes réclamées dans une file de travail partagée entre processus
+    if file_travail is not None:
+        return traitementFileTravail(
+            raster,
+            communes,
+            specificComList,
+            file_travail,
+            params,
+            cache,
+            export,
+            format_export,
+            millesime,
+            index_masques,
         )
 
-        # 3) Exclure les self-joins
-        pairs = pairs[pairs.index != pairs["index_right"]]
-
-        # 4) Garder seulement les paires de même classe
-        left_cls = vege_buffer_zone.loc[pairs.index, "classe"].to_numpy()
-        right_cls = vege_buffer_zone.loc[pairs["index_right"], "classe"].to_numpy()
-        pairs = pairs[left_cls == right_cls]
+    # Résultats par commune (passés directement à l'étape de clip si besoin)
+    resultats = {}
+    # Commune de chaque résultat (colonnes de la couche unique du GeoPackage)
+    communes_resultats = {}
+
+    # Lecture des fenêtres des communes à traiter, anticipée dans un thread si prefetch
+    # (le thread de lecture est alors le seul à accéder au raster)
+    lectures = (
+        lectureCommune(raster, row["geometry"], index_masques)
+        for _, row in communes.iterrows()
+        if not specificComList or row["insee"] in specificComList
+    )
+    if prefetch:
+        lectures = lectureAnticipee(lectures, prefetch)
+    total_lecture = 0.0
+    total_attente = 0.0
 
-        # 5) Calcul des composantes connexes PAR CLASSE
-        vege_buffer_zone["groupe"] = -1
-        for cls, sub_idx in vege_buffer_zone.groupby("classe").groups.items():
-            idx_list = list(sub_idx)
-            pos = pd.Series(range(len(idx_list)), index=idx_list)  # map index→[0..k-1]
+    for index, row in communes.iterrows():
 
-            p = pairs.loc[vege_buffer_zone.loc[pairs.index, "classe"].to_numpy() == cls]
-            if p.empty:
-                vege_buffer_zone.loc[idx_list, "groupe"] = np.arange(len(idx_list))
-                continue
+        # DEBUG print commune row
+        # print(row)
 
-            rows = pos.loc[p.index].to_numpy()
-            cols = pos.loc[p["index_right"]].to_numpy()
+        # Start Timer
+        suffixeCom = row["insee"] + "_" + row["trigramme"] + "_" + row["nom"]
+        looptimer = startTimerLog("loopTimer_" + suffixeCom)
+        print(
+            "ℹ️  Traitement appliqué à la commune n°",
+            index,
+            ":",
+            row["insee"],
+            row["trigramme"],
+            row["nom"],
+        )
 
-            data = np.ones(len(rows), dtype=np.uint8)
-            k = len(idx_list)
-            A = coo_matrix((data, (rows, cols)), shape=(k, k))
-            A = A + A.T
+        if communeIgnoree(index, row, specificComList, looptimer):
+            # Skip current commune
+            continue
 
-            _, labels = connected_components(A, directed=False, return_labels=True)
-            vege_buffer_zone.loc[idx_list, "groupe"] = labels
+        # Get current Geom
+        currentGeom = row["geometry"]
+        # print(currentGeom)
+        debut_commune = time.perf_counter()
 
-        # 6) Dissolve par groupe et classe
-        vege_fusion = vege_buffer_zone.dissolve(by=["classe", "groupe"], as_index=False)
+        ### Clipper le raster à la geom séléctionnée
+        debut_attente = time.perf_counter()
+        raster_clipped, transform_clipped, duree_lecture = next(lectures)
+        attente = time.perf_counter() - debut_attente
+        total_lecture += duree_lecture
+        total_attente += attente
+        record_stage("lecture", suffixeCom, duree_lecture, pixels=raster_clipped.size)
+        print(
+            "💾 Lecture de la fenêtre : {:.2f} s, attente : {:.2f} s ({:.0f} % masqué)".format(
+                duree_lecture,
+                attente,
+                max(0.0, 1 - attente / duree_lecture) * 100 if duree_lecture else 0,
+            )
+        )
 
-        # 7) Réaffecter les noms de classes
-        vege_fusion["classe_nom"] = vege_fusion["classe"].map(code_classes)
+        # =================================
+        # Starting geom process
+        # =================================
 
-        endTimerLog(etape5timer)
-        print("✅ Etape 5 terminée")
+        vege_clean = traitementCommune(
+            raster_clipped, transform_clipped, currentGeom, params, cache, suffixeCom
+        )
+        del raster_clipped
 
-        ### Etape 6 : Simplification des entités
-        print("ℹ️  Début Etape 6 : Simplification des entités")
+        # Construction du path (⚠️ PENSER AU TRIGRAMME DE LA COMMUNE)
+        exportName = (
+            "vegetation_stratifiee_" + millesime + "_2154_" + row["trigramme"] + ".shp"
+        )
+        resultats[exportName] = vege_clean
+        communes_resultats[exportName] = (row["insee"], row["trigramme"])
+        exportCommune(vege_clean, exportName, suffixeCom, export, format_export)
 
-        # Timer
-        etape6Com = "etape5_" + row["insee"] + "_" + row["trigramme"] + "_" + row["nom"]
-        etape6timer = startTimerLog(etape6Com)
+        # =================================
+        # Ending geom process
+        # =================================
 
-        # Le but est de retirer l'effet dent de scie
-        # Application à tout le GeoDataFrame
-        vege_smooth = vege_fusion.copy()
-        vege_smooth["geometry"] = vege_smooth.geometry.apply(simplifier_geom)
+        if eta is not None:
+            eta.done(index, time.perf_counter() - debut_commune)
+            print("⏳", eta.summary())
 
-        # vege_smooth.plot(column="classe", cmap=cmap, legend=True)
+        # Fin du timer de l'item de loop
+        endTimerLog(looptimer, features_out=len(vege_clean))
 
-        # TODO: Décaler dans utils...
-        # Lissage "arrondi" avec buffer+ puis buffer-
-        def buffer_smooth(geom, r=1.0):
-            return geom.buffer(r).buffer(-r)
+    print(
+        "💾 Lecture des fenêtres : {:.2f} s, attente : {:.2f} s".format(
+            total_lecture, total_attente
+        )
+    )
 
-        # Application à tout le GeoDataFrame
-        vege_lisse_buffer = vege_smooth.copy()
-        vege_lisse_buffer["geometry"] = vege_lisse_buffer.geometry.apply(
-            lambda g: buffer_smooth(g, r=1)
+    if export and format_export in ("gpkg", "gpkg_communes") and resultats:
+        exportVegeGeoPackage(resultats, communes_resultats, format_export, millesime)
+
+    return resultats
+
+
+def fichiersShapefile(nom):
+    """
+    Fichiers d'un Shapefile de OUTPUT_DATA_DIR (.shp, .shx, .dbf, .prj, .cpg...) : {extension: chemin}
+    """
+    base = os.path.join(OUTPUT_DATA_DIR, os.path.splitext(nom)[0])
+    return {
+        os.path.splitext(chemin)[1]: chemin
+        for chemin in glob.glob(glob.escape(base) + ".*")
+        if "." not in os.path.splitext(chemin)[0][len(base) :]
+    }
+
+
+def remplacerShapefile(nomTemporaire, nomFinal):
+    """
+    Renomme un Shapefile écrit sous un nom temporaire (os.replace de chacun de ses fichiers)
+    """
+    base = os.path.join(OUTPUT_DATA_DIR, os.path.splitext(nomFinal)[0])
+    for extension, chemin in fichiersShapefile(nomTemporaire).items():
+        os.replace(chemin, base + extension)
+
+
+def supprimerShapefile(nom):
+    """
+    Supprime les fichiers d'un Shapefile de OUTPUT_DATA_DIR (export temporaire abandonné)
+    """
+    for chemin in fichiersShapefile(nom).values():
+        os.remove(chemin)
+
+
+def traitementFileTravail(
+    raster,
+    communes,
+    specificComList,
+    file_travail,
+    params,
+    cache=None,
+    export=True,
+    format_export="shp",
+    millesime="2018",
+    index_masques=None,
+):
+    """
+    Mode distribué de vegeBigProcess : plusieurs processus indépendants (un ou plusieurs hôtes partageant
+    le système de fichiers) réclament les communes une à une dans la file de travail (WorkQueue)
+    - chaque processus ajoute les communes manquantes à la file (dans l'ordre de `communes` : coût
+      décroissant avec modele_cout), puis réclame la suivante jusqu'à ce que la file soit vide
+    - le bail de la commune est renouvelé par un heartbeat pendant son traitement : les communes d'un
+      processus arrêté sont reprises par les autres à l'expiration du bail
+    - une commune en erreur est rendue à la file (nouvel essai jusqu'à max_attempts)
+    - export d'un Shapefile par commune dans OUTPUT_DATA_DIR (répertoire partagé), pas de GeoPackage
+      commun (écrit par plusieurs processus) : écrit sous un nom temporaire propre au processus, renommé
+      seulement une fois la commune validée dans la file (un processus qui a perdu son bail n'écrit
+      jamais le Shapefile final, son export et son résultat sont abandonnés)
+    Retour : dictionnaire des communes traitées par ce processus
+    """
+    if specificComList:
+        communes = communes[communes["insee"].isin(specificComList)]
+    items = communes["insee"] + "_" + communes["trigramme"] + "_" + communes["nom"]
+    index_items = dict(zip(items, communes.index))
+    travailleur = worker_id()
+    ajoutees = file_travail.create(list(items))
+    print(
+        "🗂️  File de travail",
+        file_travail.queue_dir,
+        ":",
+        ajoutees,
+        "communes ajoutées, processus",
+        travailleur,
+    )
+    if export and format_export != "shp":
+        print(
+            "⚠️  Mode distribué : export d'un Shapefile par commune (pas de GeoPackage)"
         )
 
-        endTimerLog(etape6timer)
-        print("✅ Etape 6 terminée")
+    resultats = {}
+    while True:
+        suffixeCom = file_travail.claim(travailleur, index_items)
+        if suffixeCom is None:
+            break
+        index = index_items[suffixeCom]
+        row = communes.loc[index]
+        looptimer = startTimerLog("loopTimer_" + suffixeCom)
+        print("ℹ️  Commune", suffixeCom, "réclamée par", travailleur)
+        exportName = (
+            "vegetation_stratifiee_" + millesime + "_2154_" + row["trigramme"] + ".shp"
+        )
+        # Nom temporaire propre au processus : le Shapefile final n'est écrit qu'une fois la commune validée
+        exportTemporaire = "{}.{}.shp".format(
+            os.path.splitext(exportName)[0], travailleur.replace(":", "_")
+        )
 
-        ### Etape 7 : Regroupement des entités
-        print("ℹ️  Début Etape 7 : Regroupement des entités")
+        try:
+            with Heartbeat(file_travail, suffixeCom, travailleur) as heartbeat:
+                raster_clipped, transform_clipped, duree_lecture = lectureCommune(
+                    raster, row["geometry"], index_masques
+                )
+                record_stage(
+                    "lecture", suffixeCom, duree_lecture, pixels=raster_clipped.size
+                )
+                vege_clean = traitementCommune(
+                    raster_clipped,
+                    transform_clipped,
+                    row["geometry"],
+                    params,
+                    cache,
+                    suffixeCom,
+                )
+                del raster_clipped
+                exportCommune(vege_clean, exportTemporaire, suffixeCom, export, "shp")
+        except Exception as erreur:
+            debugLog(
+                style.RED,
+                "Commune {} en erreur, rendue à la file : {!r}".format(
+                    suffixeCom, erreur
+                ),
+                logging.ERROR,
+            )
+            file_travail.fail(suffixeCom, travailleur, repr(erreur))
+            supprimerShapefile(exportTemporaire)
+            endTimerLog(looptimer, historique=False)
+            continue
+
+        if heartbeat.lost or not file_travail.complete(suffixeCom, travailleur):
+            # Bail expiré pendant le traitement : la commune a été reprise par un autre processus,
+            # qui écrit seul le Shapefile final (export et résultat de ce processus abandonnés)
+            print(
+                "⚠️  Bail perdu pour",
+                suffixeCom,
+                ": commune reprise par un autre processus, résultat abandonné",
+            )
+            if export:
+                supprimerShapefile(exportTemporaire)
+            endTimerLog(looptimer, historique=False)
+            continue
+        if export:
+            remplacerShapefile(exportTemporaire, exportName)
+        resultats[exportName] = vege_clean
+        endTimerLog(looptimer, features_out=len(vege_clean))
+
+    print(
+        "✅ File de travail vide :",
+        len(resultats),
+        "communes traitées par",
+        travailleur,
+    )
+    return resultats
+
+
+def exportVegeGeoPackage(
+    resultats, communes_resultats, format_export="gpkg", millesime="2018"
+):
+    """
+    Export des résultats de vegeBigProcess dans vegetation_stratifiee_<millesime>_2154.gpkg
+    - "gpkg" : une seule couche, avec les colonnes insee et trigramme de la commune
+    - "gpkg_communes" : une couche par commune (vegetation_stratifiee_<millesime>_2154_<TRI>)
+    """
+    print("ℹ️  Début Export GeoPackage (" + format_export + ")")
+    exportTimer = startTimerLog("exportGpkg_" + millesime)
+    nomFichier = "vegetation_stratifiee_" + millesime + "_2154"
+
+    if format_export == "gpkg_communes":
+        couches = {
+            os.path.splitext(exportName)[0]: vege_clean
+            for exportName, vege_clean in resultats.items()
+        }
+    else:
+        couches = {
+            nomFichier: pd.concat(
+                [
+                    vege_clean.assign(
+                        insee=communes_resultats[exportName][0],
+                        trigramme=communes_resultats[exportName][1],
+                    )
+                    for exportName, vege_clean in resultats.items()
+                ],
+                ignore_index=True,
+            )
+        }
 
-        # Timer
-        etape7Com = "etape7_" + row["insee"] + "_" + row["trigramme"] + "_" + row["nom"]
-        etape7timer = startTimerLog(etape7Com)
+    exportPath = os.path.join(OUTPUT_DATA_DIR, nomFichier + ".gpkg")
+    exportGeoPackage(couches, exportPath)
+    endTimerLog(exportTimer)
+    print("✅ Export GeoPackage terminé :", exportPath)
+
+
+def surfacesStrates(vege_clean):
+    """
+    Surface (ha) de chaque strate d'une commune vectorisée (0 pour les strates absentes)
+    """
+    surfaces = vege_clean.geometry.area.groupby(
+        vege_clean["strate"].astype(str).to_numpy()
+    ).sum()
+    return (
+        surfaces.reindex(TYPE_STRATE.categories, fill_value=0.0)
+        / RATE_M2_TO_KM2
+        * RATE_MK2_TO_HA
+    )
 
-        # Regroupement de la classe 2 & 3 et 4 & 5
-        vege_lisse_buffer = vege_lisse_buffer.copy()
 
-        # Mapping : classe initiale → groupe fusionné
-        fusion_classes = {
-            1: "herbacee",
-            2: "arbustif",  # 2 + 3
-            3: "arbustif",
-            4: "arborescent",  # 4 + 5
-            5: "arborescent",
-        }
+def kpisEvolution(surfaces, millesimes):
+    """
+    KPIs d'évolution par commune et par strate entre millésimes successifs
+    surfaces : DataFrame (insee, trigramme, nom, strate, millesime, surface_ha)
+    Retour : DataFrame (insee, trigramme, nom, strate, millesime_ref, millesime,
+             surface_ref_ha, surface_ha, evolution_ha, evolution_pct)
+    """
+    table = surfaces.pivot_table(
+        index=["insee", "trigramme", "nom", "strate"],
+        columns="millesime",
+        values="surface_ha",
+        aggfunc="sum",
+        fill_value=0.0,
+    )
+    evolutions = []
+    for millesime_ref, millesime in zip(millesimes[:-1], millesimes[1:]):
+        evolution = pd.DataFrame(
+            {
+                "millesime_ref": millesime_ref,
+                "millesime": millesime,
+                "surface_ref_ha": table[millesime_ref],
+                "surface_ha": table[millesime],
+            }
+        )
+        evolution["evolution_ha"] = (
+            evolution["surface_ha"] - evolution["surface_ref_ha"]
+        )
+        evolution["evolution_pct"] = (
+            evolution["evolution_ha"]
+            / evolution["surface_ref_ha"].where(evolution["surface_ref_ha"] > 0)
+            * 100
+        )
+        evolutions.append(evolution)
+    return pd.concat(evolutions).reset_index()
 
-        # Appliquer la fusion
-        vege_lisse_buffer["strate"] = vege_lisse_buffer["classe"].map(fusion_classes)
-        vege_groupes = vege_lisse_buffer.dissolve(by="strate", as_index=False)
-        vege_groupes = vege_groupes.explode(index_parts=False, ignore_index=True)
-        # vege_groupes.plot(column="strate", cmap="Set2", legend=True)
 
-        ### Nettoyage des géométries trop petites
-        vege_clean = vege_groupes.copy()
-        vege_clean["surface_m2"] = vege_clean.geometry.area
+"""
+Nom : vegeMultiMillesimes
+Description : Vectorisation de plusieurs millésimes du raster (même grille) en un seul passage par commune
+    - communes chargées une seule fois, fenêtre et masque de chaque commune calculés une seule fois
+      et réutilisés pour tous les millésimes (lecture des fenêtres alignées)
+    - étapes 3 à 7 appliquées à chaque millésime (mêmes paramètres, même cache d'étapes)
+    - KPIs d'évolution par commune et par strate entre millésimes successifs
+Paramètres :
+    rasters* : Dictionnaire {millésime : raster ouvert avec rasterio} (obligatoire, même grille)
+        Exemple : rasters = {'2018': rasterio.open(path_2018), '2023': rasterio.open(path_2023)}
+    specificComList, communes_larges, export, params_etapes, cache, format_export, index_masques : cf. vegeBigProcess
+Retour :
+    Dictionnaire {nom du fichier d'export : GeoDataFrame de la commune vectorisée} (tous millésimes)
+    DataFrame des KPIs d'évolution (cf. kpisEvolution), exporté en CSV si export
+"""
 
-        # Filtrer uniquement les entités dont la surface est suffisante
-        vege_clean = vege_clean[vege_clean["surface_m2"] >= 2.5]
 
-        ### Nettoyage des petits trous
-        # ⚠️ call de la fonction
+def vegeMultiMillesimes(
+    rasters,
+    specificComList=None,
+    communes_larges=None,
+    export=True,
+    params_etapes=None,
+    cache=None,
+    format_export="shp",
+    index_masques=None,
+):
+    millesimes = sorted(rasters)
+    reference = rasters[millesimes[0]]
+    for millesime in millesimes[1:]:
+        raster = rasters[millesime]
+        if (
+            raster.crs != reference.crs
+            or raster.transform != reference.transform
+            or raster.shape != reference.shape
+        ):
+            raise ValueError(
+                "Le raster "
+                + millesime
+                + " n'est pas sur la même grille que le raster "
+                + millesimes[0]
+            )
+    print("ℹ️  Millésimes traités :", ", ".join(millesimes))
+
+    # Paramètres des étapes (défauts + surcharges)
+    params = parametresEtapes(params_etapes)
 
-        vege_clean["geometry"] = vege_clean.geometry.apply(
-            lambda g: remove_small_holes(g, area_thresh=2.0)
-        )
+    ### Etape 2 on découpe au territoire
+    print("ℹ️  Début du découpage du traitement pour chaque commune")
+    communes = chargerCommunes(communes_larges)
 
-        endTimerLog(etape7timer)
-        print("✅ Etape 7 terminée")
+    resultats = {}
+    communes_resultats = {millesime: {} for millesime in millesimes}
+    surfaces = []
 
-        ### Etape finale : Export de la commune
-        print("ℹ️  Début Etape finale : Export de la commune")
+    for index, row in communes.iterrows():
 
-        # Timer
-        etapeFinCom = (
-            "etapeFin_" + row["insee"] + "_" + row["trigramme"] + "_" + row["nom"]
+        # Start Timer
+        suffixeCom = row["insee"] + "_" + row["trigramme"] + "_" + row["nom"]
+        looptimer = startTimerLog("loopTimer_" + suffixeCom)
+        print(
+            "ℹ️  Traitement appliqué à la commune n°",
+            index,
+            ":",
+            row["insee"],
+            row["trigramme"],
+            row["nom"],
         )
-        etapeFintimer = startTimerLog(etapeFinCom)
 
-        # Construction du path (⚠️ PENSER AU TRIGRAMME DE LA COMMUNE)
-        exportPath = os.path.join(
-            OUTPUT_DATA_DIR,
-            "vegetation_stratifiee_2018_2154_" + row["trigramme"] + ".shp",
-        )
+        if communeIgnoree(index, row, specificComList, looptimer):
+            # Skip current commune
+            continue
 
-        # Export
-        vege_clean.to_file(filename=exportPath, encoding="utf-8")
+        # Get current Geom
+        currentGeom = row["geometry"]
 
-        endTimerLog(etapeFintimer)
-        print("✅ Etape finale terminée")
+        ### Fenêtre et masque de la commune, calculés une fois pour tous les millésimes
+        #   (mêmes valeurs que rasterio.mask.mask(crop=True), cf. vegeBigProcess)
+        if index_masques is not None:
+            masque_commune, transform_clipped, fenetre = index_masques.masque(
+                reference, currentGeom
+            )
+        else:
+            masque_commune, transform_clipped, fenetre = raster_geometry_mask(
+                reference, [currentGeom], crop=True
+            )
+
+        # Lecture des fenêtres alignées de tous les millésimes
+        fenetres = {
+            millesime: rasters[millesime].read(1, window=fenetre)
+            for millesime in millesimes
+        }
 
-        # =================================
-        # Ending geom process
-        # =================================
+        for millesime in millesimes:
+            nodata = rasters[millesime].nodata
+            raster_clipped = np.where(
+                masque_commune, 0 if nodata is None else nodata, fenetres.pop(millesime)
+            )
+
+            # =================================
+            # Starting geom process
+            # =================================
+
+            print("ℹ️  Millésime", millesime)
+            suffixeMillesime = suffixeCom + "_" + millesime
+            vege_clean = traitementCommune(
+                raster_clipped,
+                transform_clipped,
+                currentGeom,
+                params,
+                cache,
+                suffixeMillesime,
+            )
+            del raster_clipped
+
+            exportName = (
+                "vegetation_stratifiee_"
+                + millesime
+                + "_2154_"
+                + row["trigramme"]
+                + ".shp"
+            )
+            resultats[exportName] = vege_clean
+            communes_resultats[millesime][exportName] = (row["insee"], row["trigramme"])
+            exportCommune(
+                vege_clean, exportName, suffixeMillesime, export, format_export
+            )
+
+            for strate, surface in surfacesStrates(vege_clean).items():
+                surfaces.append(
+                    (
+                        row["insee"],
+                        row["trigramme"],
+                        row["nom"],
+                        strate,
+                        millesime,
+                        surface,
+                    )
+                )
 
         # Fin du timer de l'item de loop
         endTimerLog(looptimer)
 
+    if export and format_export in ("gpkg", "gpkg_communes"):
+        for millesime in millesimes:
+            resultats_millesime = {
+                exportName: resultats[exportName]
+                for exportName in communes_resultats[millesime]
+            }
+            if resultats_millesime:
+                exportVegeGeoPackage(
+                    resultats_millesime,
+                    communes_resultats[millesime],
+                    format_export,
+                    millesime,
+                )
+
+    ### KPIs d'évolution entre millésimes
+    evolution = None
+    if surfaces and len(millesimes) > 1:
+        evolution = kpisEvolution(
+            pd.DataFrame(
+                surfaces,
+                columns=[
+                    "insee",
+                    "trigramme",
+                    "nom",
+                    "strate",
+                    "millesime",
+                    "surface_ha",
+                ],
+            ),
+            millesimes,
+        )
+        if export:
+            exportPath = os.path.join(
+                OUTPUT_DATA_DIR,
+                "evolution_vegetation_stratifiee_"
+                + millesimes[0]
+                + "_"
+                + millesimes[-1]
+                + "_2154.csv",
+            )
+            evolution.to_csv(exportPath, index=False, encoding="utf-8")
+            print("✅ KPIs d'évolution exportés :", exportPath)
+
+    return resultats, evolution
+
 
 # TODO: Faire le regroupement des fichiers exportés
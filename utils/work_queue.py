@@ -0,0 +1,324 @@
+import os
+import json
+import errno
+import time
+import uuid
+import socket
+import logging
+import threading
+from contextlib import contextmanager
+
+import pandas as pd
+
+from utils.functions import chemin_temporaire, debugLog, style
+
+# States of an item of the queue
+PENDING = "pending"
+CLAIMED = "claimed"
+DONE = "done"
+FAILED = "failed"
+
+
+def worker_id() -> str:
+    """Id of the current worker process (host:pid)."""
+    return "{}:{}".format(socket.gethostname(), os.getpid())
+
+
+class WorkQueue:
+    """
+    Work queue on disk shared by independent worker processes (same host or hosts sharing the filesystem).
+
+    - `<queue_dir>/queue.json` : state of each item (commune...) in the order of creation :
+      pending / claimed (worker, lease) / done / failed, attempts, dates, error
+    - Every change is a read-modify-write of the state under the lock `<queue_dir>/queue.lock`
+      (directory holding the token of its holder, created atomically by rename, broken after
+      `lock_timeout` seconds if its holder died ; a lock is only broken or released after checking its holder),
+      the state is written atomically (temporary file + rename)
+    - A claim holds a lease of `lease_s` seconds renewed by the heartbeat of the worker (see Heartbeat) :
+      the items of a crashed worker are claimed again by the others once their lease expired
+    - A failed item goes back to pending until `max_attempts` attempts
+    - A worker without anything to claim waits (polling every `poll_s` seconds) while other workers
+      still hold claims, so that it takes over the items of a worker that crashed at the end of the queue
+
+    The leases are compared with the clocks of the hosts : they have to be synchronized (NTP).
+    """
+
+    def __init__(
+        self,
+        queue_dir: str,
+        lease_s: float = 600.0,
+        max_attempts: int = 3,
+        lock_timeout: float = 60.0,
+        poll_s: float = 10.0,
+    ) -> None:
+        self.queue_dir = queue_dir
+        self.path = os.path.join(queue_dir, "queue.json")
+        self.lock_path = os.path.join(queue_dir, "queue.lock")
+        self.lease_s = lease_s
+        self.max_attempts = max_attempts
+        self.lock_timeout = lock_timeout
+        self.poll_s = poll_s
+        os.makedirs(queue_dir, exist_ok=True)
+
+    def _lock_owner(self, lock_path: str) -> str | None:
+        """Owner token written in a lock directory (None if missing or not written yet)."""
+        try:
+            with open(os.path.join(lock_path, "owner"), encoding="utf-8") as f:
+                return f.read()
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+
+    def _remove_lock(self, lock_path: str) -> None:
+        try:
+            os.remove(os.path.join(lock_path, "owner"))
+        except FileNotFoundError:
+            pass
+        os.rmdir(lock_path)
+
+    def _remove_lock_of(self, owner: str | None) -> bool:
+        """
+        Remove the lock if it is held by `owner` : renamed first (only one worker can rename it), then its
+        owner is checked again, a lock of another holder renamed in between (stale lock broken and lock
+        taken again by other workers) is put back instead of being removed.
+        """
+        removed_path = "{}.{}.removed".format(self.lock_path, uuid.uuid4().hex)
+        try:
+            os.rename(self.lock_path, removed_path)
+        except FileNotFoundError:
+            return False
+        if self._lock_owner(removed_path) != owner:
+            try:
+                os.rename(removed_path, self.lock_path)
+            except OSError:
+                # Lock taken again meanwhile : the holder of the renamed lock sees it lost at release
+                self._remove_lock(removed_path)
+            return False
+        self._remove_lock(removed_path)
+        return True
+
+    @contextmanager
+    def _lock(self):
+        # Token of this holder (host, pid, uuid) in the lock directory : the directory is prepared with its
+        # owner file then renamed, a lock is therefore never empty and the rename fails while it exists.
+        # A lock is only broken or released after checking that it is still the one of the expected holder
+        token = "{}:{}".format(worker_id(), uuid.uuid4().hex)
+        new_path = "{}.{}.new".format(self.lock_path, uuid.uuid4().hex)
+        os.mkdir(new_path)
+        with open(os.path.join(new_path, "owner"), "w", encoding="utf-8") as f:
+            f.write(token)
+        try:
+            while True:
+                # Age of the lock = mtime of its directory, from the acquisition
+                os.utime(new_path)
+                try:
+                    os.rename(new_path, self.lock_path)
+                    break
+                except OSError as error:
+                    if error.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                        raise
+                owner = self._lock_owner(self.lock_path)
+                try:
+                    age = time.time() - os.path.getmtime(self.lock_path)
+                except FileNotFoundError:
+                    continue
+                if age > self.lock_timeout:
+                    # Holder dead while holding the lock (the state file is never half written)
+                    if self._remove_lock_of(owner):
+                        debugLog(
+                            style.YELLOW,
+                            "Stale lock of the work queue removed : {} ({}, {:.0f} s)".format(
+                                self.lock_path, owner, age
+                            ),
+                            logging.WARN,
+                        )
+                    continue
+                time.sleep(0.05)
+        except BaseException:
+            self._remove_lock(new_path)
+            raise
+        try:
+            yield
+        finally:
+            if not self._remove_lock_of(token):
+                debugLog(
+                    style.RED,
+                    "Lock of the work queue broken while held (held more than {} s) : {}".format(
+                        self.lock_timeout, self.lock_path
+                    ),
+                    logging.ERROR,
+                )
+
+    def _read(self) -> dict:
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def _write(self, items: dict) -> None:
+        tmp_path = chemin_temporaire(self.path)
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(items, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def create(self, items: list[str]) -> int:
+        """Add the items not already in the queue (the workers can all call it), returns the number added."""
+        with self._lock():
+            state = self._read()
+            added = 0
+            for item in items:
+                if item not in state:
+                    state[item] = {
+                        "status": PENDING,
+                        "worker": None,
+                        "lease_until": None,
+                        "attempts": 0,
+                        "started_at": None,
+                        "ended_at": None,
+                        "error": None,
+                    }
+                    added += 1
+            if added:
+                self._write(state)
+        return added
+
+    def claim(
+        self, worker: str, items: list[str] | None = None, wait: bool = True
+    ) -> str | None:
+        """
+        Claim the first pending item (or claimed item whose lease expired), restricted to `items` if given.
+        With `wait`, while items are still claimed by other workers, waits for them to be done or for their
+        lease to expire (crashed worker) instead of returning.
+        Returns None when there is nothing left to claim.
+        """
+        while True:
+            now = time.time()
+            next_expiry = None
+            with self._lock():
+                state = self._read()
+                for item, entry in state.items():
+                    if items is not None and item not in items:
+                        continue
+                    expired = entry["status"] == CLAIMED and entry["lease_until"] < now
+                    if entry["status"] == PENDING or expired:
+                        if expired:
+                            debugLog(
+                                style.YELLOW,
+                                "Lease of {} expired ({}) : claimed again by {}".format(
+                                    item, entry["worker"], worker
+                                ),
+                                logging.WARN,
+                            )
+                        entry.update(
+                            status=CLAIMED,
+                            worker=worker,
+                            lease_until=now + self.lease_s,
+                            attempts=entry["attempts"] + 1,
+                            started_at=now,
+                            ended_at=None,
+                        )
+                        self._write(state)
+                        return item
+                    if entry["status"] == CLAIMED:
+                        next_expiry = min(
+                            entry["lease_until"], next_expiry or entry["lease_until"]
+                        )
+            if not wait or next_expiry is None:
+                return None
+            # Polled : the items may also be given back (fail) before the end of their lease
+            time.sleep(min(max(next_expiry - now, 0.0) + 0.1, self.poll_s))
+
+    def heartbeat(self, item: str, worker: str) -> bool:
+        """Renew the lease of a claimed item, False if the worker lost it (lease expired and claimed again)."""
+        with self._lock():
+            state = self._read()
+            entry = state.get(item)
+            if entry is None or entry["status"] != CLAIMED or entry["worker"] != worker:
+                return False
+            entry["lease_until"] = time.time() + self.lease_s
+            self._write(state)
+        return True
+
+    def _finish(self, item: str, worker: str, status: str, error=None) -> bool:
+        with self._lock():
+            state = self._read()
+            entry = state.get(item)
+            if entry is None or entry["status"] != CLAIMED or entry["worker"] != worker:
+                return False
+            if status == FAILED and entry["attempts"] < self.max_attempts:
+                status = PENDING
+            entry.update(
+                status=status,
+                lease_until=None,
+                ended_at=time.time(),
+                error=error,
+            )
+            self._write(state)
+        return True
+
+    def complete(self, item: str, worker: str) -> bool:
+        """Mark an item as done, False if the worker does not hold it anymore."""
+        return self._finish(item, worker, DONE)
+
+    def fail(self, item: str, worker: str, error: str) -> bool:
+        """Give an item back (pending again until max_attempts, then failed)."""
+        return self._finish(item, worker, FAILED, str(error))
+
+    def reset(self, statuses: tuple = (FAILED,)) -> int:
+        """Put the items of the given states back to pending (ex: failed items after a fix)."""
+        with self._lock():
+            state = self._read()
+            items = [item for item, e in state.items() if e["status"] in statuses]
+            for item in items:
+                state[item].update(
+                    status=PENDING, worker=None, lease_until=None, attempts=0
+                )
+            if items:
+                self._write(state)
+        return len(items)
+
+    def status(self) -> pd.DataFrame:
+        """State of the items (one row by item), `expired` for the claims whose lease is over."""
+        state = self._read()
+        items = pd.DataFrame.from_dict(state, orient="index")
+        if items.empty:
+            return items
+        items.index.name = "item"
+        items["expired"] = (items["status"] == CLAIMED) & (
+            items["lease_until"].astype(float) < time.time()
+        )
+        for column in ("started_at", "ended_at"):
+            items[column] = pd.to_datetime(items[column], unit="s")
+        return items
+
+
+class Heartbeat:
+    """
+    Renew the lease of a claimed item in a background thread every `interval` seconds (default : a third of
+    the lease) while the item is processed. `lost` is True if the lease was lost in the meantime.
+    """
+
+    def __init__(
+        self, queue: WorkQueue, item: str, worker: str, interval: float | None = None
+    ) -> None:
+        self.queue = queue
+        self.item = item
+        self.worker = worker
+        self.interval = interval or queue.lease_s / 3
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            if not self.queue.heartbeat(self.item, self.worker):
+                self.lost = True
+                return
+
+    def __enter__(self) -> "Heartbeat":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._stop.set()
+        self._thread.join()
@@ -0,0 +1,155 @@
+# Vérification locale du mode distribué (file de travail partagée entre processus) :
+# file dans un répertoire temporaire, 2 processus, WFS des communes remplacé par des communes synthétiques
+#   python -m utils.work_queue_example
+import os
+import sys
+import glob
+import tempfile
+import multiprocessing
+
+import numpy as np
+import geopandas as gpd
+import rasterio
+from rasterio.transform import from_origin
+from shapely.geometry import box
+
+import utils.vectorisation_vege_process as vectorisation
+from utils.work_queue import WorkQueue, DONE
+
+NB_PROCESSUS = 2
+X0, Y0 = 842000, 6519400
+
+
+def communesSynthetiques():
+    """
+    Communes synthétiques (colonnes du WFS des communes) : 4 communes en bande + l'entité LYO ignorée
+    """
+    communes = [
+        (
+            "6900{}".format(i + 1),
+            "C{:02d}".format(i + 1),
+            "Commune{}".format(i + 1),
+            box(X0 + 150 * i, Y0 - 300, X0 + 150 * (i + 1), Y0),
+        )
+        for i in range(4)
+    ]
+    communes.append(("69123", "LYO", "Lyon", box(X0, Y0 - 300, X0 + 600, Y0)))
+    insee, trigramme, nom, geometry = zip(*communes)
+    return gpd.GeoDataFrame(
+        {
+            "insee": insee,
+            "trigramme": trigramme,
+            "nom": nom,
+            "communegl": True,
+            "geometry": geometry,
+        },
+        crs="EPSG:2154",
+    )
+
+
+def rasterSynthetique(path):
+    """
+    Raster de végétation stratifiée synthétique (strates 1 à 5 par blocs de 6 m, 255 = pas de végétation)
+    """
+    rng = np.random.default_rng(0)
+    blocs = rng.integers(0, 6, size=(50, 100)).astype(np.uint8)
+    arr = np.kron(blocs, np.ones((6, 6), dtype=np.uint8))
+    arr[arr == 0] = 255
+    with rasterio.open(
+        path,
+        "w",
+        driver="GTiff",
+        width=arr.shape[1],
+        height=arr.shape[0],
+        count=1,
+        dtype="uint8",
+        crs="EPSG:2154",
+        transform=from_origin(X0, Y0, 1, 1),
+        nodata=255,
+    ) as ds:
+        ds.write(arr, 1)
+
+
+def travailleur(repertoire, retour):
+    """
+    Processus de la file : WFS remplacé par les communes synthétiques, exports dans le répertoire temporaire
+    """
+    vectorisation.wfs2gp_df = lambda *args, **kwargs: communesSynthetiques()
+    vectorisation.OUTPUT_DATA_DIR = repertoire
+    file_travail = WorkQueue(os.path.join(repertoire, "queue"), lease_s=30)
+    with rasterio.open(os.path.join(repertoire, "raster.tiff")) as raster:
+        resultats = vectorisation.vegeBigProcess(raster, file_travail=file_travail)
+    retour.put((os.getpid(), sorted(resultats)))
+
+
+class FileBailPerdu(WorkQueue):
+    """
+    File dont la validation échoue toujours : bail repris et commune terminée par un autre processus
+    """
+
+    def complete(self, item, worker):
+        super().complete(item, worker)
+        return False
+
+
+def verifierBailPerdu(repertoire):
+    """
+    Un processus qui a perdu son bail n'écrit pas le Shapefile final et ne rend pas de résultat
+    """
+    vectorisation.OUTPUT_DATA_DIR = repertoire
+    file_travail = FileBailPerdu(os.path.join(repertoire, "queue_perdue"), lease_s=30)
+    with rasterio.open(os.path.join(repertoire, "raster.tiff")) as raster:
+        resultats = vectorisation.vegeBigProcess(
+            raster, communes_larges=communesSynthetiques(), file_travail=file_travail
+        )
+    assert resultats == {}, resultats
+    assert glob.glob(os.path.join(repertoire, "*.shp")) == [], "export d'un bail perdu"
+
+
+def main():
+    with tempfile.TemporaryDirectory() as repertoire:
+        rasterSynthetique(os.path.join(repertoire, "raster.tiff"))
+
+        verifierBailPerdu(repertoire)
+
+        contexte = multiprocessing.get_context("spawn")
+        retour = contexte.Queue()
+        processus = [
+            contexte.Process(target=travailleur, args=(repertoire, retour))
+            for _ in range(NB_PROCESSUS)
+        ]
+        for p in processus:
+            p.start()
+        resultats = dict(retour.get(timeout=600) for _ in processus)
+        for p in processus:
+            p.join()
+            assert p.exitcode == 0, "processus {} en erreur".format(p.pid)
+
+        # Chaque commune traitée une seule fois, par un seul processus
+        attendus = {
+            "vegetation_stratifiee_2018_2154_{}.shp".format(trigramme)
+            for trigramme in communesSynthetiques()["trigramme"]
+            if trigramme != "LYO"
+        }
+        traites = [nom for noms in resultats.values() for nom in noms]
+        assert sorted(traites) == sorted(attendus), traites
+
+        statut = WorkQueue(os.path.join(repertoire, "queue")).status()
+        assert (statut["status"] == DONE).all(), statut
+        assert set(statut["worker"].str.split(":").str[-1].astype(int)) <= set(
+            resultats
+        ), statut
+
+        # Shapefiles finaux écrits, pas d'export temporaire restant
+        shp = {
+            os.path.basename(p) for p in glob.glob(os.path.join(repertoire, "*.shp"))
+        }
+        assert shp == attendus, shp
+
+        for pid, noms in resultats.items():
+            print("✅ Processus", pid, ":", len(noms), "communes", noms)
+    print("✅ File de travail : communes réparties entre", NB_PROCESSUS, "processus")
+
+
+if __name__ == "__main__":
+    sys.exit(main())